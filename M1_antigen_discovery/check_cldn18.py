@@ -1,6 +1,9 @@
 # check_cldn18.py
 import pandas as pd
 from pathlib import Path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from star_reader import read_star_matrix
 
 MATRIX = "TCGA-STAD.star_counts.tsv"
 PROBEMAP = "gencode.v36.annotation.gtf.gene.probemap"
@@ -9,7 +12,7 @@ out_dir = Path("resultstables")
 out_dir.mkdir(parents=True, exist_ok=True)
 
 # 读表达矩阵（行：EnsemblID.version，列：样本）
-df = pd.read_csv(MATRIX, sep="\t", index_col=0)
+df = read_star_matrix(MATRIX, strip_version=False, dtype="float64")
 
 # 读映射表（两列：id<tab>gene）
 pm = pd.read_csv(PROBEMAP, sep="\t", header=None, names=["ensembl","gene"])
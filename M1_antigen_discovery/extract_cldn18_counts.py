@@ -1,8 +1,10 @@
 # extract_cldn18_counts.py
 # 目的：用 Ensembl 基因ID 直接在 TCGA-STAD.star_counts.tsv 中提取 CLDN18 的表达
 # 说明：Xena 的 STAR 矩阵通常是 log2(count+1) 值；第一列为 Ensembl_ID（含版本号）
-import pandas as pd
 from pathlib import Path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from star_reader import read_star_matrix
 
 MATRIX = "TCGA-STAD.star_counts.tsv"
 GENE_ID = "ENSG00000066405"  # CLDN18（基因层）
@@ -11,7 +13,7 @@ out_tables = Path("../resultstables")
 out_tables.mkdir(parents=True, exist_ok=True)
 
 print("[INFO] Loading matrix, this can take some seconds...")
-df = pd.read_csv(MATRIX, sep="\t", index_col=0)  # 行：Ensembl_ID(可能含.版本)；列：样本
+df = read_star_matrix(MATRIX, strip_version=False, dtype="float64")  # 行：Ensembl_ID(可能含.版本)；列：样本
 
 # 去掉行索引中的版本号（如 ENSGxxxx.xx -> ENSGxxxx）
 idx_stripped = df.index.to_series().astype(str).str.split(".").str[0]
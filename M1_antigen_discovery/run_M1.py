@@ -1,5 +1,7 @@
-import pandas as pd
 from pathlib import Path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from star_reader import read_star_matrix
 
 # -------------------- 参数配置 --------------------
 MATRIX = "TCGA-STAD.star_counts.tsv"
@@ -11,7 +13,7 @@ out_tables.mkdir(parents=True, exist_ok=True)
 
 # -------------------- 1. 读取表达矩阵 --------------------
 print("[INFO] Loading matrix, please wait...")
-df = pd.read_csv(MATRIX, sep="\t", index_col=0)
+df = read_star_matrix(MATRIX, strip_version=False, dtype="float64")
 
 # 去除版本号（ENSG00000123456.1 -> ENSG00000123456）
 stripped_idx = df.index.to_series().astype(str).str.split(".").str[0]
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TANK dual-antigen logic gates (AND / OR / AND-NOT, optional triples)
+
+The top-K genes of TANK_ranked.tsv are binarized (expression > threshold) over
+tumor and normal samples (TCGA barcode sample-type codes) and packed into uint64
+bitsets, one row per gene. For a pair (A, B) only the co-positive popcounts
+|A & B| are computed; everything else follows from the single-gene counts:
+
+    AND      |A & B|
+    OR       |A| + |B| - |A & B|
+    A AND NOT B   |A| - |A & B|
+
+Blocks of rows are popcounted against all K genes in a thread pool (numpy
+releases the GIL), so K in the thousands takes seconds. A gate is scored as
+tumor coverage - penalty * normal positivity; with --triples the best pairs are
+extended by a third gene (AND / OR / AND NOT) from their materialized bitsets.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
+from star_reader import read_star_matrix, is_matrix_cache, read_cache_meta, default_workers
+from tcga_samples import assign_groups
+
+DEFAULT_TOPK = 1000
+DEFAULT_THRESH = 1.0          # same default as tank_rank --detect_thresh
+DEFAULT_PENALTY = 1.0
+DEFAULT_TOP = 50
+DEFAULT_BEAM = 200
+BLOCK_BYTES = 64 << 20
+GATES = ('AND', 'OR', 'ANDNOT')
+
+
+def popcount(words):
+    """Set bits along the last axis of a uint64 array."""
+    import numpy as np
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return table[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def pack_bits(B):
+    """Boolean genes x samples -> uint64 genes x words (padding bits are 0)."""
+    import numpy as np
+    nbytes = -(-B.shape[1] // 64) * 8
+    out = np.zeros((B.shape[0], nbytes), dtype=np.uint8)
+    out[:, :(B.shape[1] + 7) // 8] = np.packbits(B, axis=1)
+    return out.view(np.uint64)
+
+
+def binarize(X, thresh=DEFAULT_THRESH, normal_quantile=None, normal_mask=None):
+    """Positive = value > max(thresh, per-gene normal quantile)."""
+    import numpy as np
+    thr = np.full(X.shape[0], float(thresh))
+    if normal_quantile is not None:
+        thr = np.maximum(thr, np.nanquantile(X[:, normal_mask], normal_quantile, axis=1))
+    return X > thr[:, None], thr
+
+
+def _row_blocks(n_rows, k, words):
+    b = max(1, int(BLOCK_BYTES // max(1, k * words * 8)))
+    return [slice(i, min(i + b, n_rows)) for i in range(0, n_rows, b)]
+
+
+def _top_flat(score, top):
+    """Indices of the `top` largest finite entries of a 2-D score block."""
+    import numpy as np
+    flat = score.ravel()
+    ok = np.flatnonzero(np.isfinite(flat))
+    if len(ok) > top:
+        ok = ok[np.argpartition(-flat[ok], top - 1)[:top]]
+    return np.unravel_index(ok, score.shape)
+
+
+def pair_search(TB, NB, n_tumor, n_normal, penalty=DEFAULT_PENALTY, top=DEFAULT_TOP, workers=1, max_normal=None):
+    """
+    All pairs of K genes for every gate in GATES. TB / NB are the tumor / normal
+    bitsets (K x words). Returns a list of (gate, i, j, tumor_pos, normal_pos, score),
+    the best `top` per gate.
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    K = TB.shape[0]
+    ct, cn = popcount(TB), popcount(NB)
+
+    def block(s):
+        tt = popcount(TB[s, None, :] & TB[None, :, :])
+        nn = popcount(NB[s, None, :] & NB[None, :, :])
+        i = np.arange(s.start, s.stop)[:, None]
+        j = np.arange(K)[None, :]
+        counts = {'AND': (tt, nn, j > i),
+                  'OR': (ct[i] + ct[j] - tt, cn[i] + cn[j] - nn, j > i),
+                  'ANDNOT': (ct[i] - tt, cn[i] - nn, j != i)}
+        rows = []
+        for gate, (t, n, ok) in counts.items():
+            score = t / n_tumor - penalty * n / max(n_normal, 1)
+            if max_normal is not None:
+                ok = ok & (n / max(n_normal, 1) <= max_normal)
+            score = np.where(ok, score, -np.inf)
+            bi, bj = _top_flat(score, top)
+            rows += [(gate, int(s.start + a), int(b), int(t[a, b]), int(n[a, b]), float(score[a, b]))
+                     for a, b in zip(bi, bj)]
+        return rows
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        rows = [r for part in ex.map(block, _row_blocks(K, K, TB.shape[1] + NB.shape[1])) for r in part]
+    out = []
+    for gate in GATES:
+        g = sorted((r for r in rows if r[0] == gate), key=lambda r: -r[5])
+        out += g[:top]
+    return out
+
+
+def gate_bits(gate, a, b):
+    if gate == 'AND':
+        return a & b
+    if gate == 'OR':
+        return a | b
+    return a & ~b
+
+
+def canonical(terms):
+    """
+    Key for deduplicating equivalent gates: pure conjunctions (AND / AND NOT chains)
+    and pure disjunctions are order-free; everything else keeps its formula.
+    """
+    kind, pos, neg, formula = terms
+    if kind in ('conj', 'disj'):
+        return (kind, frozenset(pos), frozenset(neg))
+    return ('expr', formula)
+
+
+def pair_terms(gate, a, b):
+    if gate == 'AND':
+        return ('conj', (a, b), (), f'{a} AND {b}')
+    if gate == 'OR':
+        return ('disj', (a, b), (), f'{a} OR {b}')
+    return ('conj', (a,), (b,), f'{a} AND NOT {b}')
+
+
+def extend_terms(terms, gate, c):
+    kind, pos, neg, formula = terms
+    if gate == 'AND' and kind == 'conj':
+        return ('conj', pos + (c,), neg, f'{formula} AND {c}')
+    if gate == 'ANDNOT' and kind == 'conj':
+        return ('conj', pos, neg + (c,), f'{formula} AND NOT {c}')
+    if gate == 'OR' and kind == 'disj':
+        return ('disj', pos + (c,), neg, f'{formula} OR {c}')
+    op = {'AND': 'AND', 'OR': 'OR', 'ANDNOT': 'AND NOT'}[gate]
+    return ('expr', pos + neg + (c,), (), f'({formula}) {op} {c}')
+
+
+def triple_search(pairs, genes, TB, NB, n_tumor, n_normal, penalty=DEFAULT_PENALTY, top=DEFAULT_TOP,
+                  beam=DEFAULT_BEAM, workers=1, max_normal=None):
+    """Extend the `beam` best pairs by a third gene; returns (terms, gene idx, tumor_pos, normal_pos, score)."""
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    seeds = sorted(pairs, key=lambda r: -r[5])[:beam]
+    if not seeds:
+        return []
+    PT = np.stack([gate_bits(g, TB[i], TB[j]) for g, i, j, *_ in seeds])
+    PN = np.stack([gate_bits(g, NB[i], NB[j]) for g, i, j, *_ in seeds])
+    cpt, cpn = popcount(PT), popcount(PN)
+    ct, cn = popcount(TB), popcount(NB)
+    K = TB.shape[0]
+
+    def block(s):
+        tt = popcount(PT[s, None, :] & TB[None, :, :])
+        nn = popcount(PN[s, None, :] & NB[None, :, :])
+        p = np.arange(s.start, s.stop)
+        used = np.zeros((len(p), K), dtype=bool)
+        used[np.arange(len(p)), [seeds[q][1] for q in p]] = True
+        used[np.arange(len(p)), [seeds[q][2] for q in p]] = True
+        counts = {'AND': (tt, nn),
+                  'OR': (cpt[p, None] + ct[None, :] - tt, cpn[p, None] + cn[None, :] - nn),
+                  'ANDNOT': (cpt[p, None] - tt, cpn[p, None] - nn)}
+        rows = []
+        for gate, (t, n) in counts.items():
+            score = t / n_tumor - penalty * n / max(n_normal, 1)
+            ok = ~used
+            if max_normal is not None:
+                ok &= n / max(n_normal, 1) <= max_normal
+            score = np.where(ok, score, -np.inf)
+            bi, bk = _top_flat(score, top)
+            rows += [(gate, int(s.start + a), int(k), int(t[a, k]), int(n[a, k]), float(score[a, k]))
+                     for a, k in zip(bi, bk)]
+        return rows
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        rows = [r for part in ex.map(block, _row_blocks(len(seeds), K, TB.shape[1] + NB.shape[1])) for r in part]
+    out, seen = [], set()
+    for gate, q, k, t, n, score in sorted(rows, key=lambda r: -r[5]):
+        g0, i, j = seeds[q][:3]
+        terms = extend_terms(pair_terms(g0, genes[i], genes[j]), gate, genes[k])
+        key = canonical(terms)
+        if key in seen:
+            continue
+        seen.add(key)
+        out.append((terms, (i, j, k), t, n, score))
+        if len(out) >= top * len(GATES):
+            break
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Dual/triple-antigen logic-gate search over TANK top-K genes (packed bitsets)')
+    ap.add_argument('--expr', required=True, help='STAR matrix (log2(count+1)) or matrix cache dir')
+    ap.add_argument('--tank_ranked', required=True, help='TANK_ranked.tsv from tank_rank.py')
+    ap.add_argument('--outdir', help='Output directory (default: directory of --tank_ranked)')
+    ap.add_argument('--topk', type=int, default=DEFAULT_TOPK, help='Number of top TANK genes to combine')
+    ap.add_argument('--thresh', type=float, default=DEFAULT_THRESH, help='Positive if expression > thresh (log scale)')
+    ap.add_argument('--normal_quantile', type=float,
+                    help='Raise each gene threshold to this quantile of its normal expression (e.g. 0.9)')
+    ap.add_argument('--penalty', type=float, default=DEFAULT_PENALTY, help='score = tumor_cov - penalty * normal_pos')
+    ap.add_argument('--max_normal', type=float, help='Drop gates positive in more than this fraction of normals')
+    ap.add_argument('--tumor_codes', nargs='+', default=['01'], help='Barcode sample-type codes for tumor')
+    ap.add_argument('--normal_codes', nargs='+', default=['11'], help='Barcode sample-type codes for normal')
+    ap.add_argument('--top', type=int, default=DEFAULT_TOP, help='Gates kept per gate type')
+    ap.add_argument('--triples', action='store_true', help='Also extend the best pairs by a third gene')
+    ap.add_argument('--beam', type=int, default=DEFAULT_BEAM, help='Pairs extended with --triples')
+    ap.add_argument('--workers', type=int, default=default_workers())
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+    outdir = args.outdir or os.path.dirname(os.path.abspath(args.tank_ranked))
+    os.makedirs(outdir, exist_ok=True)
+
+    import numpy as np
+    import pandas as pd
+
+    with span('load') as sp:
+        ranked = pd.read_csv(args.tank_ranked, sep='\t', index_col=0)
+        expr = read_star_matrix(args.expr, workers=args.workers, mmap=True)
+        expr = expr[~expr.index.duplicated()]
+        genes = [g for g in ranked.index[~ranked.index.duplicated()] if g in expr.index][:args.topk]
+        if len(genes) < 2:
+            raise SystemExit('Fewer than 2 TANK genes found in the expression matrix (check the ID namespace).')
+        groups = assign_groups(expr.columns, set(args.tumor_codes), set(args.normal_codes))
+        n_t, n_n = int((groups == 1).sum()), int((groups == 0).sum())
+        if n_t == 0 or n_n == 0:
+            raise SystemExit(f'Need tumor and normal samples from barcodes (got tumor={n_t}, normal={n_n}).')
+        X = expr.loc[genes].to_numpy(dtype=np.float64)[:, groups >= 0]
+        # linear-scale caches from m1_normalize: threshold on log2(x+1) like the STAR input
+        meta = read_cache_meta(args.expr) if is_matrix_cache(args.expr) else {}
+        if meta.get('normalization') and not meta.get('log_scale'):
+            X = np.log2(X + 1.0)
+        g = groups[groups >= 0]
+        sp.shape(X)
+
+    with span('binarize') as sp:
+        B, _ = binarize(X, args.thresh, args.normal_quantile, g == 0)
+        TB, NB = pack_bits(B[:, g == 1]), pack_bits(B[:, g == 0])
+        sp.shape(B)
+
+    with span('pairs', genes=len(genes)):
+        pairs = pair_search(TB, NB, n_t, n_n, args.penalty, args.top, args.workers, args.max_normal)
+
+    triples = []
+    if args.triples:
+        with span('triples', beam=args.beam):
+            triples = triple_search(pairs, genes, TB, NB, n_t, n_n, args.penalty, args.top, args.beam,
+                                    args.workers, args.max_normal)
+
+    with span('write') as sp:
+        ct, cn = popcount(TB), popcount(NB)
+        rank = {gid: r + 1 for r, gid in enumerate(genes)}
+        rows = []
+        for i, gid in enumerate(genes):
+            rows.append(('SINGLE', gid, (gid,), int(ct[i]), int(cn[i]), ct[i] / n_t - args.penalty * cn[i] / n_n))
+        for gate, i, j, t, n, score in pairs:
+            terms = pair_terms(gate, genes[i], genes[j])
+            rows.append((gate, terms[3], (genes[i], genes[j]), t, n, score))
+        for terms, idx, t, n, score in triples:
+            rows.append(('TRIPLE', terms[3], tuple(genes[k] for k in idx), t, n, score))
+        out = pd.DataFrame(rows, columns=['logic', 'gate', 'genes', 'tumor_pos', 'normal_pos', 'score'])
+        if args.max_normal is not None:
+            out = out[out['normal_pos'] / n_n <= args.max_normal]
+        out['n_genes'] = out['genes'].map(len)
+        out['best_tank_rank'] = out['genes'].map(lambda gs: min(rank[x] for x in gs))
+        out['genes'] = out['genes'].map(','.join)
+        out['tumor_cov'] = out['tumor_pos'] / n_t
+        out['normal_frac'] = out['normal_pos'] / n_n
+        out = out[['gate', 'logic', 'n_genes', 'genes', 'tumor_cov', 'normal_frac', 'score',
+                   'tumor_pos', 'normal_pos', 'best_tank_rank']]
+        out = out.sort_values(['score', 'tumor_cov', 'n_genes'], ascending=[False, False, True]).reset_index(drop=True)
+        out_path = os.path.join(outdir, 'TANK_gates.tsv')
+        sp.shape(out)
+        out.to_csv(out_path, sep='\t', index=False)
+
+    best_single = out[out['logic'] == 'SINGLE'].head(1)
+    print(f'[OK] Logic gates: K={len(genes)} genes, tumor={n_t} normal={n_n}, '
+          f'{len(pairs)} pairs' + (f', {len(triples)} triples' if args.triples else ''))
+    if len(best_single):
+        print(f"  best single: {best_single['gate'].iloc[0]} score={best_single['score'].iloc[0]:.3f}")
+    print(out.head(10)[['gate', 'tumor_cov', 'normal_frac', 'score']].to_string(index=False))
+    print(' -', out_path)
+
+
+if __name__ == '__main__':
+    main()
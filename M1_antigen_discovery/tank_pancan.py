@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TANK pan-cancer runner (many cohorts, one gene x cohort table)
+
+Cohorts come from a directory of expression matrices (files or star_reader cache
+dirs matching --pattern, cohort name = file name up to the first '.') or from a
+manifest (TSV/CSV with columns cohort, expr and optionally sample_keep; relative
+paths are resolved against the manifest). Every cohort is loaded and scored
+exactly like tank_rank.py (same filter / transform / statistic) in a process
+pool. Concurrency is bounded by both --workers and a memory budget: each job's
+peak memory is estimated from the matrix size and jobs are started largest-first
+only while the in-flight estimates fit into --mem_gb (a job larger than the
+budget runs alone).
+
+Outputs (in --outdir):
+  TANK_pancan_rank.tsv     gene x cohort rank (1 = highest score; empty = filtered)
+  TANK_pancan_score.tsv    gene x cohort score
+  TANK_pancan_summary.tsv  per gene: cohorts ranked, median rank / percentile, cohorts in top-K
+  TANK_pancan_targets.tsv  per target: best / median / worst rank and cohort across cohorts
+  TANK_pancan_cohorts.tsv  per cohort: samples, genes, runtime, memory estimate, errors
+"""
+
+import argparse
+import fnmatch
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
+from tank_rank import (DEFAULT_TARGETS, DEFAULT_MIN_DETECT_PROP, DEFAULT_DETECT_THRESH, DEFAULT_STAT,
+                       DEFAULT_WINSOR_ALPHA, DEFAULT_TOPK, DEFAULT_DUP_AGG, load_targets)
+
+DEFAULT_PATTERN = '*star_counts*'
+PEAK_FACTOR = 3.0             # matrix + filtered copy + log1p / score temporaries
+GZ_RATIO = 4.0                # gzip'd text expands ~4x; ~1 byte of text per byte of float64
+
+
+def available_memory():
+    """Bytes of available RAM (MemAvailable on Linux; physical pages elsewhere; 4 GB if unknown)."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 4 << 30
+
+
+def estimate_bytes(path):
+    """Peak memory estimate of one tank_rank pass over `path` (float64 genes x samples)."""
+    from star_reader import is_matrix_cache, read_cache_meta
+    if is_matrix_cache(path):
+        shape = read_cache_meta(path).get('shape') or [0, 0]
+        return int(shape[0] * shape[1] * 8 * PEAK_FACTOR)
+    size = os.path.getsize(path)
+    return int(size * (GZ_RATIO if path.endswith('.gz') else 1.0) * PEAK_FACTOR)
+
+
+def cohort_name(path):
+    return os.path.basename(os.path.normpath(path)).split('.')[0]
+
+
+def discover(path, pattern=DEFAULT_PATTERN):
+    """Directory -> cohorts matching pattern; manifest file -> its rows. Returns a list of job dicts."""
+    import pandas as pd
+    if os.path.isdir(path):
+        from star_reader import is_matrix_cache
+        jobs = []
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if fnmatch.fnmatch(name, pattern) and (os.path.isfile(full) or is_matrix_cache(full)):
+                jobs.append({'cohort': cohort_name(full), 'expr': full, 'sample_keep': None})
+        return jobs
+    sep = ',' if path.endswith('.csv') else '\t'
+    man = pd.read_csv(path, sep=sep, dtype=str).fillna('')
+    if not {'cohort', 'expr'} <= set(man.columns):
+        raise SystemExit(f"Manifest {path} needs columns 'cohort' and 'expr' (optional 'sample_keep').")
+    root = os.path.dirname(os.path.abspath(path))
+    resolve = lambda p: p if not p or os.path.isabs(p) else os.path.join(root, p)
+    return [{'cohort': r['cohort'], 'expr': resolve(r['expr']), 'sample_keep': resolve(r.get('sample_keep', '')) or None}
+            for _, r in man.iterrows()]
+
+
+def run_cohort(job):
+    """One cohort through the tank_rank pipeline; errors are returned, not raised, so one bad file does not stop the run."""
+    import numpy as np
+    from tank_rank import load_matrix, subset_matrix, drop_duplicates, detect_filter, score_frame
+    from star_reader import is_log_scale
+    t0 = time.time()
+    out = {'cohort': job['cohort'], 'expr': job['expr'], 'ranked': None, 'samples': 0, 'genes': 0, 'error': None}
+    try:
+        cfg = job['cfg']
+        log1p = cfg['log1p'] and not is_log_scale(job['expr'])
+        df = load_matrix(job['expr'], workers=job.get('threads'))
+        df = subset_matrix(df, job.get('sample_keep'), cfg.get('gene_list'))
+        df = drop_duplicates(df, how=cfg['dup_agg'])
+        df_filt = detect_filter(df, cfg['detect_thresh'], cfg['min_detect_prop'])
+        if log1p:
+            df_filt = np.log1p(df_filt)
+        scored = score_frame(df_filt, cfg['stat'], cfg['winsor_alpha'], cfg['detect_thresh'], cfg['min_detect_prop'])
+        out.update(ranked=scored.sort_values('score', ascending=False), samples=int(df.shape[1]), genes=int(df.shape[0]))
+    except (Exception, SystemExit) as e:
+        out['error'] = f'{type(e).__name__}: {e}'
+    out['seconds'] = round(time.time() - t0, 3)
+    return out
+
+
+def _failed(job, error):
+    return {'cohort': job['cohort'], 'expr': job['expr'], 'ranked': None, 'samples': 0, 'genes': 0,
+            'error': error, 'seconds': 0.0}
+
+
+def _run_pool(pending, workers, budget, results):
+    """One process pool over `pending`; if a worker dies (e.g. OOM kill) the pool breaks and every in-flight
+    job fails with it -> returns (jobs not yet started, jobs that were in flight)."""
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from concurrent.futures.process import BrokenProcessPool
+    running, used = {}, 0
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        while pending or running:
+            i = 0
+            while i < len(pending) and len(running) < workers:
+                j = pending[i]
+                if not running or used + j['est'] <= budget:
+                    running[ex.submit(run_cohort, j)] = j
+                    used += j['est']
+                    pending.pop(i)
+                else:
+                    i += 1
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for f in done:
+                j = running.pop(f)
+                used -= j['est']
+                try:
+                    results.append(f.result())
+                except BrokenProcessPool:
+                    return pending, [j] + list(running.values())
+    return [], []
+
+
+def _run_isolated(job):
+    """Re-run a job from a broken pool on its own in a single worker process, so another crash only loses this cohort."""
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    with ProcessPoolExecutor(max_workers=1) as ex:
+        try:
+            return ex.submit(run_cohort, job).result()
+        except BrokenProcessPool:
+            return _failed(job, 'BrokenProcessPool: worker process died (out of memory? lower --workers / --mem_gb)')
+
+
+def schedule(jobs, workers, budget):
+    """Largest-first, at most `workers` processes, in-flight estimates <= budget (at least one job always runs).
+    Jobs caught in a broken pool are retried one at a time afterwards; finished cohorts are kept."""
+    pending = sorted(jobs, key=lambda j: -j['est'])
+    if workers <= 1:
+        return [run_cohort(j) for j in pending]
+    results, retry = [], []
+    while pending:
+        pending, broken = _run_pool(pending, workers, budget, results)
+        if broken:
+            print(f"[WARN] worker process died; retrying {', '.join(j['cohort'] for j in broken)} one at a time")
+        retry += broken
+    for j in retry:
+        results.append(_run_isolated(j))
+    return results
+
+
+def merge_results(results, order):
+    """gene x cohort rank / score tables (outer join over genes, columns in manifest order).
+    Duplicate gene IDs within a cohort (dup_agg=none, e.g. version-stripped _PAR_Y rows) keep their first,
+    best-ranked row; ranks stay positions in the full cohort ranking."""
+    import numpy as np
+    import pandas as pd
+    ok = {r['cohort']: r['ranked'] for r in results if r['ranked'] is not None}
+    cols = [c for c in order if c in ok]
+    first = {c: ~ok[c].index.duplicated() for c in cols}
+    rank = pd.concat({c: pd.Series(np.arange(1, len(ok[c]) + 1), index=ok[c].index)[first[c]] for c in cols}, axis=1)
+    score = pd.concat({c: ok[c]['score'][first[c]] for c in cols}, axis=1)
+    n_genes = pd.Series({c: len(ok[c]) for c in cols})
+    return rank, score, n_genes
+
+
+def gene_summary(rank, n_genes, topk):
+    pct = rank / n_genes
+    out = rank.notna().sum(axis=1).to_frame('n_ranked')
+    out['median_rank'] = rank.median(axis=1)
+    out['median_pct'] = pct.median(axis=1)
+    out['best_rank'] = rank.min(axis=1)
+    out[f'n_top{topk}'] = (rank <= topk).sum(axis=1)
+    return out.sort_values(['median_pct', 'n_ranked'], ascending=[True, False])
+
+
+def target_summary(targets, rank, score, n_genes, topk):
+    import numpy as np
+    import pandas as pd
+    rows = []
+    for t in targets:
+        r = rank.loc[t] if t in rank.index else pd.Series(np.nan, index=rank.columns)
+        ranked = r.dropna()
+        row = {'target': t, 'n_cohorts': rank.shape[1], 'n_ranked': int(len(ranked))}
+        if len(ranked):
+            row.update(best_rank=int(ranked.min()), best_cohort=ranked.idxmin(),
+                       median_rank=float(ranked.median()),
+                       median_pct=float((ranked / n_genes[ranked.index]).median()),
+                       worst_rank=int(ranked.max()), worst_cohort=ranked.idxmax(),
+                       mean_score=float(score.loc[t].dropna().mean()))
+            row[f'n_top{topk}'] = int((ranked <= topk).sum())
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="TANK across many cohorts: gene x cohort rank / score tables (process pool, memory-aware)")
+    ap.add_argument('--cohorts', required=True, help='Directory of matrices / caches, or manifest TSV/CSV (cohort, expr[, sample_keep])')
+    ap.add_argument('--pattern', default=DEFAULT_PATTERN, help='File / cache-dir name pattern when --cohorts is a directory')
+    ap.add_argument('--outdir', required=True)
+    ap.add_argument('--targets', nargs='+', help='Targets (same ID namespace as matrices)')
+    ap.add_argument('--targets_file', help='File with targets (one per line)')
+    ap.add_argument('--log1p', action='store_true', help='Apply log1p before scoring (skipped for log-scale caches)')
+    ap.add_argument('--min_detect_prop', type=float, default=DEFAULT_MIN_DETECT_PROP)
+    ap.add_argument('--detect_thresh', type=float, default=DEFAULT_DETECT_THRESH)
+    ap.add_argument('--stat', choices=['var', 'mad', 'winsor'], default=DEFAULT_STAT)
+    ap.add_argument('--winsor_alpha', type=float, default=DEFAULT_WINSOR_ALPHA)
+    ap.add_argument('--dup_agg', choices=['none', 'mean', 'sum', 'max', 'first'], default=DEFAULT_DUP_AGG)
+    ap.add_argument('--gene_list', help='Keep only genes listed in this file (all cohorts)')
+    ap.add_argument('--topk', type=int, default=DEFAULT_TOPK, help='Top-K cutoff for the n_topK summary columns')
+    ap.add_argument('--workers', type=int, default=max(1, min(4, os.cpu_count() or 1)), help='Concurrent cohort processes')
+    ap.add_argument('--mem_gb', type=float, help='Memory budget for in-flight cohorts (default: 70%% of available RAM)')
+    ap.add_argument('--per_cohort', action='store_true', help='Also write the usual TANK outputs under <outdir>/cohorts/<cohort>/')
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    import pandas as pd
+    targets = load_targets(args, DEFAULT_TARGETS)
+    budget = int(args.mem_gb * (1 << 30)) if args.mem_gb else int(0.7 * available_memory())
+    cfg = {'log1p': args.log1p, 'min_detect_prop': args.min_detect_prop, 'detect_thresh': args.detect_thresh,
+           'stat': args.stat, 'winsor_alpha': args.winsor_alpha, 'dup_agg': args.dup_agg, 'gene_list': args.gene_list}
+
+    with span('discover') as sp:
+        jobs = discover(args.cohorts, args.pattern)
+        if not jobs:
+            raise SystemExit(f'No cohorts found in {args.cohorts} (pattern {args.pattern}).')
+        names = [j['cohort'] for j in jobs]
+        dup = sorted({n for n in names if names.count(n) > 1})
+        if dup:
+            raise SystemExit(f'Duplicate cohort names: {", ".join(dup)} (use a manifest to name them).')
+        threads = max(1, (os.cpu_count() or 1) // max(1, min(args.workers, len(jobs))))
+        for j in jobs:
+            if not os.path.exists(j['expr']):
+                raise SystemExit(f"{j['cohort']}: expression file not found: {j['expr']}")
+            j.update(cfg=cfg, est=estimate_bytes(j['expr']), threads=threads)
+        sp.set(cohorts=len(jobs))
+    big = [j['cohort'] for j in jobs if j['est'] > budget]
+    if big:
+        print(f"[WARN] Estimated peak memory exceeds the {budget / (1 << 30):.1f} GB budget; run alone: {', '.join(big)}")
+
+    with span('score', cohorts=len(jobs), workers=args.workers):
+        results = schedule(jobs, args.workers, budget)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    failed = [r for r in results if r['error']]
+    if len(failed) == len(results):
+        raise SystemExit('All cohorts failed:\n' + '\n'.join(f"  {r['cohort']}: {r['error']}" for r in failed))
+
+    with span('merge') as sp:
+        rank, score, n_genes = merge_results(results, names)
+        sp.shape(rank)
+    with span('write'):
+        rank_path = os.path.join(args.outdir, 'TANK_pancan_rank.tsv')
+        score_path = os.path.join(args.outdir, 'TANK_pancan_score.tsv')
+        summary_path = os.path.join(args.outdir, 'TANK_pancan_summary.tsv')
+        targets_path = os.path.join(args.outdir, 'TANK_pancan_targets.tsv')
+        cohorts_path = os.path.join(args.outdir, 'TANK_pancan_cohorts.tsv')
+        rank.index.name = score.index.name = 'gene'
+        rank.astype('Int64').to_csv(rank_path, sep='\t')
+        score.to_csv(score_path, sep='\t')
+        gene_summary(rank, n_genes, args.topk).to_csv(summary_path, sep='\t')
+        tsum = target_summary(targets, rank, score, n_genes, args.topk)
+        tsum.to_csv(targets_path, sep='\t', index=False)
+        by_name = {r['cohort']: r for r in results}
+        est = {j['cohort']: j['est'] for j in jobs}
+        pd.DataFrame([{'cohort': c, 'expr': by_name[c]['expr'], 'samples': by_name[c]['samples'],
+                       'genes': by_name[c]['genes'], 'genes_after_filter': int(n_genes.get(c, 0)),
+                       'seconds': by_name[c]['seconds'], 'est_peak_mb': round(est[c] / (1 << 20), 1),
+                       'error': by_name[c]['error'] or ''} for c in names]).to_csv(cohorts_path, sep='\t', index=False)
+        paths = [rank_path, score_path, summary_path, targets_path, cohorts_path]
+        if args.per_cohort:
+            from tank_rank import write_outputs
+            for c in rank.columns:
+                r = by_name[c]
+                settings = [f"Expression file: {r['expr']}", f"Cohort: {c} (pan-cancer run)",
+                            f"Genes after filter: {len(r['ranked'])}", f"Samples: {r['samples']}",
+                            f"dup_agg: {args.dup_agg}",
+                            f"Preprocessing: log1p={'on' if args.log1p else 'off'}, min_detect_prop={args.min_detect_prop}, detect_thresh={args.detect_thresh}",
+                            f"Statistic: {args.stat} (winsor_alpha={args.winsor_alpha if args.stat == 'winsor' else 'NA'})"]
+                write_outputs(r['ranked'], targets, os.path.join(args.outdir, 'cohorts', c), args.topk, settings)
+            paths.append(os.path.join(args.outdir, 'cohorts'))
+
+    print(f"[TANK] Pan-cancer: {rank.shape[1]}/{len(jobs)} cohorts, {rank.shape[0]} genes, "
+          f"workers={args.workers}, memory budget {budget / (1 << 30):.1f} GB")
+    for r in failed:
+        print(f"[WARN] {r['cohort']} failed: {r['error']}")
+    if len(tsum) and 'best_rank' in tsum.columns:
+        print(tsum.to_string(index=False))
+    print("[TANK] Wrote:")
+    for p in paths:
+        print(" ", p)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,11 @@ Consolidated version (duplicate-index safe)
 import argparse
 import os
 import sys
-import pandas as pd
-import numpy as np
+
+# pandas / numpy are imported inside the functions that need them so that
+# `--help` and the CLI dispatcher (aicar.py) start without loading them.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
 
 # ===== Defaults (edit as needed) =====
 DEFAULT_EXPR = r"C:\Users\surface\Desktop\AI-CAR-Loop-1.0\data\TCGA-STAD.star_counts.tsv.gz"
@@ -41,7 +44,11 @@ def env_list(name, default_list):
     return [s.strip() for s in raw.split(",") if s.strip()] or list(default_list)
 
 def infer_delimiter(path):
-    with open(path, 'rb') as f:
+    opener = open
+    if str(path).endswith('.gz'):
+        import gzip
+        opener = gzip.open
+    with opener(path, 'rb') as f:
         head = f.readline().decode('utf-8', errors='ignore')
     return '\t' if head.count('\t') >= head.count(',') else ','
 
@@ -53,6 +60,7 @@ def strip_ensembl_version_idx(idx):
     try:
         return idx.map(_strip)
     except Exception:
+        import pandas as pd
         return pd.Index([_strip(x) for x in idx])
 
 def guess_id_type(index_like):
@@ -80,6 +88,27 @@ def compute_score(df, stat='var', winsor_alpha=0.01):
     else:
         raise ValueError("stat must be one of {'var','mad','winsor'}")
 
+def detect_filter(df, detect_thresh, min_detect_prop):
+    """Keep genes detected (> detect_thresh on the ORIGINAL scale) in >= min_detect_prop of samples."""
+    if detect_thresh > 0 or min_detect_prop > 0:
+        detect_prop_base = (df > detect_thresh).sum(axis=1) / df.shape[1]
+        keep = detect_prop_base >= float(min_detect_prop)
+        return df.loc[keep].copy()
+    return df
+
+def score_frame(df_filt, stat='var', winsor_alpha=0.01, detect_thresh=1.0, min_detect_prop=0.1):
+    """score / mean / detect_prop per gene of the filtered (and transformed) matrix, unsorted."""
+    import pandas as pd
+    score = compute_score(df_filt, stat=stat, winsor_alpha=winsor_alpha)
+    mean = df_filt.mean(axis=1)
+
+    # IMPORTANT: compute detect_prop on the filtered matrix to avoid duplicate-index reindex
+    if detect_thresh > 0 or min_detect_prop > 0:
+        detect_prop_used = (df_filt > detect_thresh).sum(axis=1) / df_filt.shape[1]
+    else:
+        detect_prop_used = pd.Series(1.0, index=df_filt.index)
+    return pd.DataFrame({'score': score, 'mean': mean, 'detect_prop': detect_prop_used})
+
 def load_listfile(path):
     if not path:
         return None
@@ -119,6 +148,7 @@ def drop_duplicates(df, how="none"):
     if how == "first":
         return df[~df.index.duplicated(keep='first')]
     if how == "max":
+        import numpy as np
         v = df.var(axis=1, ddof=1)
         tmp = v.reset_index()
         tmp.columns = ['gene', 'var']
@@ -129,49 +159,15 @@ def drop_duplicates(df, how="none"):
         return df[mask]
     raise ValueError("dup_agg must be one of {'none','mean','sum','max','first'}")
 
-def main():
-    ap = argparse.ArgumentParser(description="TANK consolidated: variance-based ranking + target report (dup-safe)")
-    ap.add_argument('--expr', help='Expression matrix path (.tsv/.csv/.gz)')
-    ap.add_argument('--targets', nargs='+', help='Targets (same ID namespace as matrix)')
-    ap.add_argument('--targets_file', help='File with targets (one per line)')
-    ap.add_argument('--id_type', choices=['auto','ensembl','symbol'], help='ID namespace in expression index')
-    ap.add_argument('--log1p', action='store_true', help='Apply log1p before scoring')
-    ap.add_argument('--min_detect_prop', type=float, help='Keep genes detected in ≥ this fraction of samples (0 disables)')
-    ap.add_argument('--detect_thresh', type=float, help='Detection threshold on ORIGINAL scale (0 disables)')
-    ap.add_argument('--stat', choices=['var','mad','winsor'], help='Score statistic')
-    ap.add_argument('--winsor_alpha', type=float, help='Winsor alpha (for --stat winsor)')
-    ap.add_argument('--dup_agg', choices=['none','mean','sum','max','first'], help='Resolve duplicate gene IDs')
-    ap.add_argument('--gene_list', help='Keep only genes listed in this file')
-    ap.add_argument('--sample_keep', help='Keep only samples (columns) listed here')
-    ap.add_argument('--topk', type=int, help='If >0, also write Top-K table')
-    ap.add_argument('--outdir', help='Output directory')
-    args = ap.parse_args()
-
-    # Defaults + env
-    expr = args.expr or env_or_default("TANK_EXPR", DEFAULT_EXPR, str)
-    outdir = args.outdir or env_or_default("TANK_OUTDIR", DEFAULT_OUTDIR, str)
-    id_type = args.id_type or env_or_default("TANK_IDTYPE", DEFAULT_IDTYPE, str)
-    log1p = args.log1p or bool(int(env_or_default("TANK_LOG1P", "1" if DEFAULT_LOG1P else "0", int)))
-    min_detect_prop = args.min_detect_prop if args.min_detect_prop is not None else float(env_or_default("TANK_MIN_DETECT_PROP", str(DEFAULT_MIN_DETECT_PROP), float))
-    detect_thresh = args.detect_thresh if args.detect_thresh is not None else float(env_or_default("TANK_DETECT_THRESH", str(DEFAULT_DETECT_THRESH), float))
-    stat = args.stat or env_or_default("TANK_STAT", DEFAULT_STAT, str)
-    winsor_alpha = args.winsor_alpha if args.winsor_alpha is not None else float(env_or_default("TANK_WINSOR_ALPHA", str(DEFAULT_WINSOR_ALPHA), float))
-    topk = args.topk if args.topk is not None else int(env_or_default("TANK_TOPK", str(DEFAULT_TOPK), int))
-    dup_agg = args.dup_agg or env_or_default("TANK_DUP_AGG", DEFAULT_DUP_AGG, str)
-    gene_list = args.gene_list or env_or_default("TANK_GENE_LIST", "", str)
-    sample_keep = args.sample_keep or env_or_default("TANK_SAMPLE_KEEP", "", str)
-    targets = load_targets(args, DEFAULT_TARGETS)
-
-    if not expr or not os.path.exists(expr):
-        sys.stderr.write("ERROR: Expression file not found.\n"
-                         f"Provided/Default: {expr}\n")
-        sys.exit(2)
-
-    # Load matrix
-    delim = infer_delimiter(expr)
-    df = pd.read_csv(expr, sep=delim, header=0, index_col=0, compression='infer')
+def load_matrix(path, workers=None):
+    import numpy as np
+    from star_reader import read_star_matrix
+    # Parallel reader (also accepts a star_reader cache dir); float64 keeps scores identical to pd.read_csv
+    df = read_star_matrix(path, workers=workers, dtype=np.float64)
     df.index = strip_ensembl_version_idx(df.index)
+    return df
 
+def subset_matrix(df, sample_keep=None, gene_list=None):
     # Optional sample subset
     if sample_keep:
         keep_cols = set(load_listfile(sample_keep))
@@ -185,42 +181,21 @@ def main():
         keep_rows = set(load_listfile(gene_list))
         keep_rows = {g.split('.')[0] if isinstance(g, str) and g.startswith('ENSG') else g for g in keep_rows}
         df = df.loc[df.index.intersection(keep_rows)]
+    return df
 
-    # ID namespace (informational)
-    id_ns = guess_id_type(df.index) if id_type == 'auto' else id_type
-
-    # Duplicate aggregation
-    df = drop_duplicates(df, how=dup_agg)
-
-    # Detection filter (compute base detect_prop if thresholds active)
-    if detect_thresh > 0 or min_detect_prop > 0:
-        detect_prop_base = (df > detect_thresh).sum(axis=1) / df.shape[1]
-        keep = detect_prop_base >= float(min_detect_prop)
-        df_filt = df.loc[keep].copy()
-    else:
-        df_filt = df
-
-    # Transform
-    if log1p:
-        df_filt = np.log1p(df_filt)
-
-    # Score + mean
-    score = compute_score(df_filt, stat=stat, winsor_alpha=winsor_alpha)
-    mean = df_filt.mean(axis=1)
-
-    # IMPORTANT: compute detect_prop on the filtered matrix to avoid duplicate-index reindex
-    if detect_thresh > 0 or min_detect_prop > 0:
-        detect_prop_used = (df_filt > detect_thresh).sum(axis=1) / df_filt.shape[1]
-    else:
-        detect_prop_used = pd.Series(1.0, index=df_filt.index)
-
-    ranked = pd.DataFrame({'score': score, 'mean': mean, 'detect_prop': detect_prop_used}).sort_values('score', ascending=False)
-
-    # Outputs
+def write_outputs(ranked, targets, outdir, topk, settings, store=True):
+    """Write TANK_ranked / TANK_topK / TANK_targets / README_targets (+ the TANK_ranked.res
+    results store unless store=False); returns the written paths."""
+    import pandas as pd
     os.makedirs(outdir, exist_ok=True)
     ranked_path = os.path.join(outdir, 'TANK_ranked.tsv')
     ranked.to_csv(ranked_path, sep='\t')
 
+    store_dir = None
+    if store:
+        from results_store import write_store, store_path
+        store_dir = write_store(ranked, store_path(ranked_path), kind='tank', sort_by='score desc')
+
     topk_path = None
     if topk and topk > 0:
         topk_path = os.path.join(outdir, f'TANK_top{topk}.tsv')
@@ -251,18 +226,8 @@ def main():
     report_path = os.path.join(outdir, 'README_targets.txt')
     with open(report_path, 'w', encoding='utf-8') as f:
         f.write("TANK target ranking report (Consolidated, dup-safe)\n")
-        f.write(f"Expression file: {expr}\n")
-        f.write(f"Genes after dup_agg/gene_list: {df.shape[0]}\n")
-        f.write(f"Genes after filter: {ranked.shape[0]}\n")
-        f.write(f"Samples: {df.shape[1]}\n")
-        f.write(f"ID namespace: {id_ns}\n")
-        f.write(f"dup_agg: {dup_agg}\n")
-        f.write(f"Preprocessing: log1p={'on' if log1p else 'off'}, min_detect_prop={min_detect_prop}, detect_thresh={detect_thresh}\n")
-        f.write(f"Statistic: {stat} (winsor_alpha={winsor_alpha if stat=='winsor' else 'NA'})\n")
-        if gene_list:
-            f.write(f"Gene whitelist applied: {gene_list}\n")
-        if sample_keep:
-            f.write(f"Sample subset applied: {sample_keep}\n")
+        for line in settings:
+            f.write(line + "\n")
         f.write("\nTop-10 genes by score:\n")
         top10 = ranked.head(10).reset_index()
         for i, row in top10.iterrows():
@@ -279,12 +244,223 @@ def main():
             for t in not_found:
                 f.write(f"  {t}\n")
 
+    return [p for p in (ranked_path, store_dir, topk_path, targets_path, report_path) if p]
+
+def run_sample_qc(df, outdir, sample_keep=None, log1p=False):
+    """PCA outlier screen (scripts/m1_sample_qc.py); writes TANK_sample_qc.tsv + TANK_sample_keep.txt, returns the keep-list path."""
+    from m1_sample_qc import sample_qc, write_lists
+    sub = subset_matrix(df, sample_keep, None)
+    qc, evr, n_genes = sample_qc(sub, log1p=log1p)
+    os.makedirs(outdir, exist_ok=True)
+    qc.sort_values('outlier_score', ascending=False).to_csv(os.path.join(outdir, 'TANK_sample_qc.tsv'), sep='\t')
+    keep_path = os.path.join(outdir, 'TANK_sample_keep.txt')
+    write_lists(qc, keep_path)
+    n_out = int(qc['outlier'].sum())
+    print(f"[TANK] Sample QC: {n_out}/{len(qc)} PCA outlier samples excluded ({n_genes} genes, {len(evr)} PCs)")
+    return keep_path, n_out
+
+def run_update(args, batch, outdir, targets, topk, sample_keep=None, gene_list=None):
+    """Incremental mode: merge a new batch into the stored statistics; cost ~ size of the batch."""
+    import tank_stats
+    spath = tank_stats.stats_path(outdir)
+    if not os.path.exists(spath):
+        sys.stderr.write(f"ERROR: {spath} not found; run a full TANK pass (stat=var, --save_stats) into this outdir first.\n")
+        sys.exit(2)
+    if not os.path.exists(batch):
+        sys.stderr.write(f"ERROR: Batch expression file not found: {batch}\n")
+        sys.exit(2)
+    genes, samples, old, cfg = tank_stats.load_stats(spath)
+
+    # Statistics were accumulated under these settings; they cannot change in update mode
+    stat = args.stat or env_or_default("TANK_STAT", DEFAULT_STAT, str)
+    if stat != 'var':
+        sys.stderr.write("ERROR: --update only supports --stat var (mad/winsor are not decomposable).\n"); sys.exit(2)
+    if cfg['dup_agg'] == 'max':
+        sys.stderr.write("ERROR: dup_agg=max picks rows by global variance and cannot be updated incrementally.\n"); sys.exit(2)
+    if args.detect_thresh is not None and args.detect_thresh != cfg['detect_thresh']:
+        sys.stderr.write(f"ERROR: stored statistics use detect_thresh={cfg['detect_thresh']}.\n"); sys.exit(2)
+    if args.log1p and not cfg['log1p']:
+        sys.stderr.write("ERROR: stored statistics were computed without --log1p.\n"); sys.exit(2)
+    # the detection filter is applied at ranking time from counts, so it may change freely
+    min_detect_prop = args.min_detect_prop if args.min_detect_prop is not None else cfg['min_detect_prop']
+
+    with span('load') as sp:
+        df = sp.shape(load_matrix(batch))
+    with span('filter') as sp:
+        df = subset_matrix(df, sample_keep, gene_list or cfg.get('gene_list'))
+        df = drop_duplicates(df, how=cfg['dup_agg'])
+        dup = set(samples).intersection(map(str, df.columns))
+        if dup:
+            sys.stderr.write(f"ERROR: {len(dup)} batch samples are already in the statistics (e.g. {sorted(dup)[:3]}).\n")
+            sys.exit(3)
+        df = sp.shape(tank_stats.align_batch(df, genes))
+    with span('stats') as sp:
+        new = tank_stats.batch_stats(df, log1p=cfg['log1p'], detect_thresh=cfg['detect_thresh'])
+        merged = tank_stats.merge_stats(old, new)
+        samples = samples + [str(c) for c in df.columns]
+    with span('sort') as sp:
+        ranked = tank_stats.ranked_from_stats(genes, merged, len(samples), min_detect_prop, cfg['detect_thresh'])
+        ranked.index.name = cfg.get('index_name')
+        sp.shape(ranked)
+
+    cfg['min_detect_prop'] = min_detect_prop
+    cfg['sources'].append({'expr': batch, 'samples': int(df.shape[1])})
+    settings = [
+        "Expression file: " + ", ".join(s['expr'] for s in cfg['sources']),
+        f"Incremental update: +{df.shape[1]} samples from {batch} (merged into {spath})",
+        f"Genes after dup_agg/gene_list: {len(genes)}",
+        f"Genes after filter: {ranked.shape[0]}",
+        f"Samples: {len(samples)}",
+        f"ID namespace: {cfg['id_ns']}",
+        f"dup_agg: {cfg['dup_agg']}",
+        f"Preprocessing: log1p={'on' if cfg['log1p'] else 'off'}, min_detect_prop={min_detect_prop}, detect_thresh={cfg['detect_thresh']}",
+        "Statistic: var (winsor_alpha=NA)",
+    ]
+    with span('write'):
+        paths = write_outputs(ranked, targets, outdir, topk, settings, store=not args.no_store)
+        tank_stats.save_stats(spath, genes, samples, merged, cfg)
+        paths.append(spath)
+
+    print("[TANK] Updated:")
+    for p in paths:
+        print(" ", p)
+
+def main():
+    ap = argparse.ArgumentParser(description="TANK consolidated: variance-based ranking + target report (dup-safe)")
+    ap.add_argument('--expr', help='Expression matrix path (.tsv/.csv/.gz)')
+    ap.add_argument('--targets', nargs='+', help='Targets (same ID namespace as matrix)')
+    ap.add_argument('--targets_file', help='File with targets (one per line)')
+    ap.add_argument('--id_type', choices=['auto','ensembl','symbol'], help='ID namespace in expression index')
+    ap.add_argument('--log1p', action='store_true', help='Apply log1p before scoring')
+    ap.add_argument('--min_detect_prop', type=float, help='Keep genes detected in ≥ this fraction of samples (0 disables)')
+    ap.add_argument('--detect_thresh', type=float, help='Detection threshold on ORIGINAL scale (0 disables)')
+    ap.add_argument('--stat', choices=['var','mad','winsor'], help='Score statistic')
+    ap.add_argument('--winsor_alpha', type=float, help='Winsor alpha (for --stat winsor)')
+    ap.add_argument('--dup_agg', choices=['none','mean','sum','max','first'], help='Resolve duplicate gene IDs')
+    ap.add_argument('--gene_list', help='Keep only genes listed in this file')
+    ap.add_argument('--sample_keep', help='Keep only samples (columns) listed here')
+    ap.add_argument('--sample_qc', action='store_true',
+                    help='Drop PCA outlier samples before scoring (keep list written to <outdir>/TANK_sample_keep.txt)')
+    ap.add_argument('--topk', type=int, help='If >0, also write Top-K table')
+    ap.add_argument('--outdir', help='Output directory')
+    ap.add_argument('--update', metavar='BATCH_EXPR',
+                    help='Merge a new batch of sample columns into <outdir>/TANK_stats.npz and re-emit the ranking (stat=var)')
+    ap.add_argument('--save_stats', action='store_true',
+                    help='Also write TANK_stats.npz (stat=var) so later batches can be merged with --update')
+    ap.add_argument('--no_store', action='store_true',
+                    help='Do not write the TANK_ranked.res binary results store (query with aicar query)')
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    # Defaults + env
+    expr = args.expr or env_or_default("TANK_EXPR", DEFAULT_EXPR, str)
+    outdir = args.outdir or env_or_default("TANK_OUTDIR", DEFAULT_OUTDIR, str)
+    id_type = args.id_type or env_or_default("TANK_IDTYPE", DEFAULT_IDTYPE, str)
+    log1p = args.log1p or bool(int(env_or_default("TANK_LOG1P", "1" if DEFAULT_LOG1P else "0", int)))
+    min_detect_prop = args.min_detect_prop if args.min_detect_prop is not None else float(env_or_default("TANK_MIN_DETECT_PROP", str(DEFAULT_MIN_DETECT_PROP), float))
+    detect_thresh = args.detect_thresh if args.detect_thresh is not None else float(env_or_default("TANK_DETECT_THRESH", str(DEFAULT_DETECT_THRESH), float))
+    stat = args.stat or env_or_default("TANK_STAT", DEFAULT_STAT, str)
+    winsor_alpha = args.winsor_alpha if args.winsor_alpha is not None else float(env_or_default("TANK_WINSOR_ALPHA", str(DEFAULT_WINSOR_ALPHA), float))
+    topk = args.topk if args.topk is not None else int(env_or_default("TANK_TOPK", str(DEFAULT_TOPK), int))
+    dup_agg = args.dup_agg or env_or_default("TANK_DUP_AGG", DEFAULT_DUP_AGG, str)
+    gene_list = args.gene_list or env_or_default("TANK_GENE_LIST", "", str)
+    sample_keep = args.sample_keep or env_or_default("TANK_SAMPLE_KEEP", "", str)
+    sample_qc = args.sample_qc or bool(int(env_or_default("TANK_SAMPLE_QC", "0", int)))
+    save_stats = args.save_stats or bool(int(env_or_default("TANK_SAVE_STATS", "0", int)))
+    targets = load_targets(args, DEFAULT_TARGETS)
+
+    if args.update:
+        if args.sample_qc:
+            sys.stderr.write("ERROR: --sample_qc needs the full matrix; run m1_sample_qc.py on the batch and pass --sample_keep.\n")
+            sys.exit(2)
+        run_update(args, args.update, outdir, targets, topk, sample_keep, gene_list)
+        return
+
+    if not expr or not os.path.exists(expr):
+        sys.stderr.write("ERROR: Expression file not found.\n"
+                         f"Provided/Default: {expr}\n")
+        sys.exit(2)
+
+    import pandas as pd
+    import numpy as np
+    import tank_stats
+    from star_reader import is_log_scale
+
+    # m1_normalize caches are already on a log / VST scale; do not transform twice
+    if log1p and is_log_scale(expr):
+        print("[TANK] Input is an already log-scaled matrix cache; skipping log1p.")
+        log1p = False
+
+    # Load matrix
+    with span('load') as sp:
+        df = sp.shape(load_matrix(expr))
+
+    n_qc_out = None
+    if sample_qc:
+        with span('sample_qc'):
+            sample_keep, n_qc_out = run_sample_qc(df, outdir, sample_keep, log1p)
+
+    with span('filter') as sp:
+        df = subset_matrix(df, sample_keep, gene_list)
+
+        # ID namespace (informational)
+        id_ns = guess_id_type(df.index) if id_type == 'auto' else id_type
+
+        # Duplicate aggregation
+        df = drop_duplicates(df, how=dup_agg)
+
+        df_filt = sp.shape(detect_filter(df, detect_thresh, min_detect_prop))
+
+    # Sufficient statistics over all genes (pre-filter) so that --update can merge new samples later
+    gene_stats = None
+    if stat == 'var' and save_stats:
+        with span('stats') as sp:
+            gene_stats = tank_stats.batch_stats(sp.shape(df), log1p=log1p, detect_thresh=detect_thresh)
+
+    # Transform
+    if log1p:
+        with span('transform') as sp:
+            df_filt = sp.shape(np.log1p(df_filt))
+
+    # Score + mean
+    with span('score', stat=stat) as sp:
+        scored = score_frame(sp.shape(df_filt), stat, winsor_alpha, detect_thresh, min_detect_prop)
+
+    with span('sort') as sp:
+        ranked = sp.shape(scored.sort_values('score', ascending=False))
+
+    # Outputs
+    settings = [
+        f"Expression file: {expr}",
+        f"Genes after dup_agg/gene_list: {df.shape[0]}",
+        f"Genes after filter: {ranked.shape[0]}",
+        f"Samples: {df.shape[1]}",
+        f"ID namespace: {id_ns}",
+        f"dup_agg: {dup_agg}",
+        f"Preprocessing: log1p={'on' if log1p else 'off'}, min_detect_prop={min_detect_prop}, detect_thresh={detect_thresh}",
+        f"Statistic: {stat} (winsor_alpha={winsor_alpha if stat=='winsor' else 'NA'})",
+    ]
+    if gene_list:
+        settings.append(f"Gene whitelist applied: {gene_list}")
+    if sample_keep:
+        settings.append(f"Sample subset applied: {sample_keep}")
+    if n_qc_out is not None:
+        settings.append(f"Sample QC: {n_qc_out} PCA outlier samples excluded (see TANK_sample_qc.tsv)")
+    with span('write'):
+        paths = write_outputs(ranked, targets, outdir, topk, settings, store=not args.no_store)
+        if gene_stats is not None:
+            config = {'stat': stat, 'log1p': log1p, 'detect_thresh': detect_thresh,
+                      'min_detect_prop': min_detect_prop, 'dup_agg': dup_agg, 'id_ns': id_ns,
+                      'index_name': df.index.name, 'gene_list': gene_list or None,
+                      'sources': [{'expr': expr, 'samples': int(df.shape[1])}]}
+            spath = tank_stats.stats_path(outdir)
+            tank_stats.save_stats(spath, df.index, df.columns, gene_stats, config)
+            paths.append(spath)
+
     print("[TANK] Wrote:")
-    print(" ", ranked_path)
-    if topk_path:
-        print(" ", topk_path)
-    print(" ", targets_path)
-    print(" ", report_path)
+    for p in paths:
+        print(" ", p)
 
 if __name__ == '__main__':
     main()
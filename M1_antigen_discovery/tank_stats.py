@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TANK sufficient statistics (for incremental updates)
+
+Per gene we keep: non-missing count n, mean and M2 (Welford state) on the scoring
+scale (log1p or raw), and two detection counts: on the ORIGINAL scale (used by the
+min_detect_prop filter) and on the scoring scale (reported detect_prop, mirroring
+tank_rank.main). A new batch of sample columns is merged with Chan's parallel
+update, so `var`, `mean` and `detect_prop` never need the old samples again.
+Only --stat var is decomposable; mad / winsor need the full matrix.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+STATS_FILE = 'TANK_stats.npz'
+STAT_KEYS = ('n', 'mean', 'm2', 'det_raw', 'det_used')
+
+
+def batch_stats(df, log1p=False, detect_thresh=1.0):
+    """Sufficient statistics of one genes x samples block (NaN-aware, float64 accumulation)."""
+    X = df.to_numpy(dtype=np.float64)
+    det_raw = (X > detect_thresh).sum(axis=1)
+    Xt = np.log1p(X) if log1p else X
+    det_used = (Xt > detect_thresh).sum(axis=1)
+    ok = ~np.isnan(Xt)
+    n = ok.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, np.nansum(Xt, axis=1) / n, np.nan)
+        m2 = np.nansum((Xt - mean[:, None]) ** 2, axis=1)
+    return {'n': n.astype(np.int64), 'mean': mean, 'm2': m2,
+            'det_raw': det_raw.astype(np.int64), 'det_used': det_used.astype(np.int64)}
+
+
+def merge_stats(a, b):
+    """Chan et al. pairwise merge of two Welford states (element-wise over genes)."""
+    n = a['n'] + b['n']
+    delta = b['mean'] - a['mean']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(n > 0, b['n'] / np.maximum(n, 1), 0.0)
+        mean = np.where(a['n'] == 0, b['mean'], np.where(b['n'] == 0, a['mean'], a['mean'] + delta * frac))
+        m2 = a['m2'] + b['m2'] + np.where((a['n'] > 0) & (b['n'] > 0), delta * delta * a['n'] * frac, 0.0)
+    return {'n': n, 'mean': mean, 'm2': m2,
+            'det_raw': a['det_raw'] + b['det_raw'], 'det_used': a['det_used'] + b['det_used']}
+
+
+def save_stats(path, genes, samples, stats, config):
+    np.savez(path, genes=np.asarray(genes, dtype=str), samples=np.asarray(samples, dtype=str),
+             config=np.asarray(json.dumps(config)), **{k: stats[k] for k in STAT_KEYS})
+
+
+def load_stats(path):
+    z = np.load(path, allow_pickle=False)
+    stats = {k: z[k] for k in STAT_KEYS}
+    return list(z['genes']), list(z['samples']), stats, json.loads(str(z['config']))
+
+
+def align_batch(df, genes):
+    """Put the batch rows in the stored gene order (positional if identical; by ID otherwise)."""
+    if len(df.index) == len(genes) and (df.index.astype(str) == pd.Index(genes)).all():
+        return df
+    if pd.Index(genes).has_duplicates or df.index.has_duplicates:
+        raise SystemExit("ERROR: gene IDs are duplicated and batch rows are not in the stored order; "
+                         "use the same --dup_agg as the original run (e.g. mean/first).")
+    missing = pd.Index(genes).difference(df.index)
+    if len(missing):
+        raise SystemExit(f"ERROR: batch lacks {len(missing)} genes present in the stored statistics "
+                         f"(e.g. {', '.join(map(str, missing[:5]))}).")
+    return df.reindex(genes)
+
+
+def ranked_from_stats(genes, stats, n_samples, min_detect_prop, detect_thresh):
+    """Same table as tank_rank (score=var ddof=1, mean, detect_prop), sorted by score."""
+    filt = detect_thresh > 0 or min_detect_prop > 0
+    keep = np.ones(len(genes), dtype=bool)
+    if filt:
+        keep = stats['det_raw'] / n_samples >= float(min_detect_prop)
+    n = stats['n'][keep]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = np.where(n > 1, stats['m2'][keep] / (n - 1), np.nan)
+    detect = stats['det_used'][keep] / n_samples if filt else np.ones(int(keep.sum()))
+    idx = pd.Index(np.asarray(genes, dtype=object)[keep], name=None)
+    ranked = pd.DataFrame({'score': var, 'mean': stats['mean'][keep], 'detect_prop': detect}, index=idx)
+    return ranked.sort_values('score', ascending=False)
+
+
+def stats_path(outdir):
+    return os.path.join(outdir, STATS_FILE)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import argparse, json, os
+import argparse, json, os, sys
 from pathlib import Path
-import numpy as np
-import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
 
 def parse_pairlist(arg):
     # 形如: "LNP:0.65,0.05 TMAB3:0.70,0.06 RNACap:0.60,0.07"
@@ -23,9 +24,117 @@ def parse_scalars(arg):
     return out
 
 def sample_truncnorm(mu, sd, n):
+    import numpy as np
     x = np.random.normal(mu, sd, n)
     return np.clip(x, 0.0, 1.0)
 
+# ---- 房室 PK / 生物分布模型（--model pk）----
+# 状态：C 血浆（载体包裹的 mRNA），T 肿瘤，L 肝，O 其他组织；剂量归一为 1。
+#   dC/dt = -(k_el + k_tumor·pen/(1 + C/km_tumor) + k_liver/sel + k_other/sel)·C + k_back·(T + L + O)
+#   dT/dt = k_tumor·pen/(1 + C/km_tumor)·C - (k_back + k_deg/stab)·T      （肿瘤摄取可饱和，受体介导）
+#   dL/dt = k_liver/sel·C - (k_back + k_deg/stab)·L，O 同理
+# 清除 k_el、降解 k_deg 均除以稳定性乘子；penetration 先验、selectivity / stability 乘子沿用原参数。
+# 每个参数另乘对数正态个体差异（--pk_cv）；全部平台 x 抽样作为一个 (状态, 抽样) 数组，定步长 RK4 一次积分，
+# AUC 作为附加状态同步积分。得分 = 肿瘤 AUC / 总组织 AUC（肿瘤暴露占比）。
+PK_BASE = {"k_el": 0.15, "k_tumor": 0.03, "km_tumor": 0.2, "k_liver": 0.5, "k_other": 0.1,
+           "k_back": 0.05, "k_deg": 0.1}   # 1/h；km_tumor 为剂量分数
+PK_STATES = ["C", "T", "L", "O"]
+
+def parse_pk_params(arg, platforms=None):
+    # 形如: "LNP:k_liver=0.9,k_tumor=0.02 TMAB3:k_tumor=0.06"；参数名必须是 PK_BASE 中的（拼错直接报错）
+    out = {}
+    for token in (arg or "").split():
+        name, sep, vals = token.partition(":")
+        if not sep or not name or not vals:
+            raise SystemExit(f"bad --pk_params token {token!r} (expected PLATFORM:name=value[,name=value])")
+        if platforms is not None and name not in platforms:
+            raise SystemExit(f"--pk_params platform {name!r} not in --platforms ({', '.join(platforms)})")
+        par = out.setdefault(name, {})
+        for kv in vals.split(","):
+            k, sep, v = kv.partition("=")
+            if k not in PK_BASE:
+                raise SystemExit(f"unknown PK parameter {k!r} in {token!r} (known: {', '.join(PK_BASE)})")
+            try:
+                par[k] = float(v)
+            except ValueError:
+                raise SystemExit(f"bad value for {k} in {token!r}: {v!r}")
+    return out
+
+
+def sample_pk(platforms, priors, sel, stab, n, cv=0.3, overrides=None):
+    """每个平台 n 组参数，返回 (labels, penetration, dict[参数 -> (len(platforms)*n,) 数组])"""
+    import numpy as np
+    labels, pen, par = [], [], {k: [] for k in PK_BASE}
+    sigma = np.sqrt(np.log(1 + cv * cv))
+    for p in platforms:
+        base = dict(PK_BASE, **(overrides or {}).get(p, {}))
+        mu, sd = priors[p]
+        pp = sample_truncnorm(mu, sd, n)
+        for k, v in base.items():
+            x = v * np.random.lognormal(-0.5 * sigma * sigma, sigma, n)
+            if k == "k_tumor":
+                x = x * pp
+            elif k in ("k_liver", "k_other"):
+                x = x / sel[p]
+            elif k in ("k_el", "k_deg"):
+                x = x / stab[p]
+            par[k].append(x)
+        labels += [p] * n
+        pen.append(pp)
+    return np.array(labels), np.concatenate(pen), {k: np.concatenate(v) for k, v in par.items()}
+
+def pk_rhs(y, k):
+    """y: (7, N) = [C, T, L, O, AUC_T, AUC_L, AUC_O]（每行一个状态，按抽样连续存放）；k: 参数数组字典"""
+    import numpy as np
+    C, T, L, O = y[0], y[1], y[2], y[3]
+    up_t = k["k_tumor"] / (1.0 + C / k["km_tumor"]) * C
+    up_l = k["k_liver"] * C
+    up_o = k["k_other"] * C
+    out = k["k_back"] + k["k_deg"]
+    dy = np.empty_like(y)
+    dy[0] = k["k_back"] * (T + L + O) - k["k_el"] * C - up_t - up_l - up_o
+    dy[1] = up_t - out * T
+    dy[2] = up_l - out * L
+    dy[3] = up_o - out * O
+    dy[4:7] = y[1:4]
+    return dy
+
+def integrate_pk(k, t_end=72.0, dt=None):
+    """
+    全部抽样同时做定步长 RK4；dt 缺省按最快速率取（λ·dt ≤ 1，RK4 稳定域为 2.78，误差约 1e-6）。
+    返回 (y_end (7, N), cmax_tumor, tmax_tumor)。
+    """
+    import numpy as np
+    N = len(k["k_el"])
+    if dt is None:
+        fast = np.max(k["k_el"] + k["k_tumor"] + k["k_liver"] + k["k_other"] + k["k_back"] + k["k_deg"])
+        dt = min(0.25, 1.0 / fast)
+    steps = int(np.ceil(t_end / dt))
+    dt = t_end / steps
+    y = np.zeros((7, N))
+    y[0] = 1.0
+    cmax, tmax = np.zeros(N), np.zeros(N)
+    for i in range(steps):
+        k1 = pk_rhs(y, k)
+        k2 = pk_rhs(y + 0.5 * dt * k1, k)
+        k3 = pk_rhs(y + 0.5 * dt * k2, k)
+        k4 = pk_rhs(y + dt * k3, k)
+        y += dt / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+        hit = y[1] > cmax
+        cmax[hit] = y[1, hit]
+        tmax[hit] = (i + 1) * dt
+    return y, cmax, tmax
+
+def pk_summary(labels, auc_t, auc_off, share, platforms):
+    import numpy as np
+    rows = []
+    for p in platforms:
+        m = labels == p
+        q = lambda x: np.percentile(x[m], [50, 5, 95])
+        rows.append([p, int(m.sum())] + list(q(auc_t)) + list(q(auc_off)) + list(q(share)))
+    head = ["platform", "n"] + [f"{v}_{s}" for v in ("auc_tumor", "auc_offtarget", "tumor_share") for s in ("median", "p5", "p95")]
+    return head, rows
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--iters", type=int, default=100)
@@ -36,8 +145,18 @@ def main():
     ap.add_argument("--stability", required=True)   # 乘子
     ap.add_argument("--lead_model", default="")
     ap.add_argument("--outdir", required=True)
+    ap.add_argument("--model", choices=["pk", "scalar"], default="pk",
+                    help="pk: compartmental PK/biodistribution ODE, score = tumor share of tissue AUC; scalar: penetration x selectivity x stability")
+    ap.add_argument("--pk_cv", type=float, default=0.3, help="log-normal between-draw CV of every PK rate constant")
+    ap.add_argument("--pk_params", default="", help='per-platform overrides, e.g. "LNP:k_liver=0.9 TMAB3:k_tumor=0.06"')
+    ap.add_argument("--t_end", type=float, default=72.0, help="PK horizon (h)")
+    ap.add_argument("--dt", type=float, default=None, help="RK4 step (h); default from the fastest rate")
+    add_trace_args(ap)
     args = ap.parse_args()
+    setup_trace(args)
 
+    # 数值核心只需要 numpy；matplotlib 在出图阶段再导入（Agg 后端，无需显示器）
+    import numpy as np
     np.random.seed(args.seed)
     platforms = [s.strip() for s in args.platforms.split(",") if s.strip()]
     priors = parse_pairlist(args.priors)
@@ -46,56 +165,117 @@ def main():
 
     Path(args.outdir).mkdir(parents=True, exist_ok=True)
     records = []
-    for p in platforms:
-        mu, sd = priors[p]
-        pen = sample_truncnorm(mu, sd, args.iters)
-        score = (pen * sel[p] * stab[p])  # 简单乘积，已截断0-1
-        for i in range(args.iters):
+    pk_rows = None
+    if args.model == "pk":
+        with span("simulate", rows=args.iters * len(platforms)) as sp:
+            labels, pen, k = sample_pk(platforms, priors, sel, stab, args.iters, args.pk_cv, parse_pk_params(args.pk_params, platforms))
+            y, cmax, tmax = integrate_pk(k, args.t_end, args.dt)
+            auc_t, auc_off = y[4], y[5] + y[6]
+            share = auc_t / (auc_t + auc_off)
+            sp.set(draws=len(labels))
+        for i in range(len(labels)):
+            p = labels[i]
             records.append({
-                "platform": p,
+                "platform": str(p),
                 "penetration": float(pen[i]),
                 "selectivity": float(sel[p]),
                 "stability": float(stab[p]),
-                "score": float(score[i])
+                "auc_tumor": float(auc_t[i]),
+                "auc_offtarget": float(auc_off[i]),
+                "cmax_tumor": float(cmax[i]),
+                "tmax_tumor_h": float(tmax[i]),
+                "score": float(share[i])
             })
+        pk_rows = pk_summary(labels, auc_t, auc_off, share, platforms)
+    else:
+        with span("simulate", rows=args.iters * len(platforms)):
+            for p in platforms:
+                mu, sd = priors[p]
+                pen = sample_truncnorm(mu, sd, args.iters)
+                score = (pen * sel[p] * stab[p])  # 简单乘积，已截断0-1
+                for i in range(args.iters):
+                    records.append({
+                        "platform": p,
+                        "penetration": float(pen[i]),
+                        "selectivity": float(sel[p]),
+                        "stability": float(stab[p]),
+                        "score": float(score[i])
+                    })
 
     # Top-5
-    rec_sorted = sorted(records, key=lambda r: r["score"], reverse=True)
-    top5 = rec_sorted[:5]
-    with open(os.path.join(args.outdir, "delivery_top5.json"), "w") as f:
-        json.dump({
-            "lead_model": args.lead_model,
-            "top5": top5
-        }, f, indent=2)
+    with span("sort"):
+        rec_sorted = sorted(records, key=lambda r: r["score"], reverse=True)
+        top5 = rec_sorted[:5]
+    with span("write"):
+        with open(os.path.join(args.outdir, "delivery_top5.json"), "w") as f:
+            json.dump({
+                "lead_model": args.lead_model,
+                "model": args.model,
+                "top5": top5
+            }, f, indent=2)
+        if pk_rows is not None:
+            head, rows = pk_rows
+            with open(os.path.join(args.outdir, "delivery_pk_summary.tsv"), "w") as f:
+                f.write("\t".join(head) + "\n")
+                for r in rows:
+                    f.write("\t".join([r[0], str(r[1])] + [f"{v:.6g}" for v in r[2:]]) + "\n")
 
     # 直方图
-    plt.figure(figsize=(6,4))
-    plt.hist([r["score"] for r in records], bins=20)
-    plt.xlabel("Composite score"); plt.ylabel("Count"); plt.tight_layout()
-    plt.savefig(os.path.join(args.outdir, "delivery_hist.png"), dpi=160)
-    plt.close()
-
-    # 雷达图（平台均值对比）
-    dims = ["penetration","selectivity","stability"]
-    angles = np.linspace(0, 2*np.pi, len(dims), endpoint=False).tolist()
-    angles += angles[:1]
-    plt.figure(figsize=(5,5))
-    ax = plt.subplot(111, polar=True)
-    for p in platforms:
-        mu, sd = priors[p]
-        vals = [mu, sel[p], stab[p]]
-        vals += vals[:1]
-        ax.plot(angles, vals, label=p)
-        ax.fill(angles, vals, alpha=0.1)
-    ax.set_thetagrids(np.degrees(angles[:-1]), dims)
-    ax.set_ylim(0, max(1.0, max(stab.values())*1.05))
-    ax.legend(loc="upper right", bbox_to_anchor=(1.3, 1.1))
-    plt.tight_layout()
-    plt.savefig(os.path.join(args.outdir, "delivery_radar.png"), dpi=160)
-    plt.close()
+    with span("plot"):
+        os.environ.setdefault("MPLBACKEND", "Agg")
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(6,4))
+        if args.model == "pk":
+            for p in platforms:
+                plt.hist([r["score"] for r in records if r["platform"] == p], bins=30, alpha=0.5, label=p)
+            plt.xlabel("Tumor share of tissue AUC"); plt.legend()
+        else:
+            plt.hist([r["score"] for r in records], bins=20)
+            plt.xlabel("Composite score")
+        plt.ylabel("Count"); plt.tight_layout()
+        plt.savefig(os.path.join(args.outdir, "delivery_hist.png"), dpi=160)
+        plt.close()
+
+        if args.model == "pk":
+            # 肿瘤 vs 脱靶暴露（AUC）分布
+            plt.figure(figsize=(5,4.5))
+            for p in platforms:
+                m = labels == p
+                plt.scatter(auc_off[m], auc_t[m], s=3, alpha=0.3, linewidths=0, label=p)
+            plt.xscale("log"); plt.yscale("log")
+            plt.xlabel("Off-target AUC (liver + other, dose·h)"); plt.ylabel("Tumor AUC (dose·h)")
+            plt.legend(markerscale=4); plt.tight_layout()
+            plt.savefig(os.path.join(args.outdir, "delivery_pk_exposure.png"), dpi=160)
+            plt.close()
+
+        # 雷达图（平台均值对比）
+        dims = ["penetration","selectivity","stability"]
+        angles = np.linspace(0, 2*np.pi, len(dims), endpoint=False).tolist()
+        angles += angles[:1]
+        plt.figure(figsize=(5,5))
+        ax = plt.subplot(111, polar=True)
+        for p in platforms:
+            mu, sd = priors[p]
+            vals = [mu, sel[p], stab[p]]
+            vals += vals[:1]
+            ax.plot(angles, vals, label=p)
+            ax.fill(angles, vals, alpha=0.1)
+        ax.set_thetagrids(np.degrees(angles[:-1]), dims)
+        ax.set_ylim(0, max(1.0, max(stab.values())*1.05))
+        ax.legend(loc="upper right", bbox_to_anchor=(1.3, 1.1))
+        plt.tight_layout()
+        plt.savefig(os.path.join(args.outdir, "delivery_radar.png"), dpi=160)
+        plt.close()
 
     print("[OK] Wrote", os.path.join(args.outdir, "delivery_top5.json"))
-    print("[OK] Figures:", "delivery_hist.png", "delivery_radar.png")
+    if pk_rows is not None:
+        head, rows = pk_rows
+        print("[OK] PK:", len(records), "draws; median tumor share:",
+              ", ".join(f"{r[0]} {r[8]:.4f}" for r in rows))
+        print("[OK] Wrote", os.path.join(args.outdir, "delivery_pk_summary.tsv"))
+        print("[OK] Figures:", "delivery_hist.png", "delivery_radar.png", "delivery_pk_exposure.png")
+    else:
+        print("[OK] Figures:", "delivery_hist.png", "delivery_radar.png")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 表位 / scFv CDR 肽段的脱靶扫描：在本地蛋白组 FASTA（如 UniProt 人类参考蛋白组）中找相似肽段。
+# 索引：蛋白组编码为 uint8 数组，对每个种子模式（连续 k-mer "1111" 与间隔种子 "11011" 等，1 = 参与匹配的位置）
+# 计算所有位置的 20 进制键值，排序后存为 键 / 指针 / 位置 三个 .npy（CSR），目录缓存于 dataprocessed/，
+# 蛋白组未变则直接 memmap 复用（工作进程也只 memmap，不复制）。
+# 查询：肽段每个偏移的种子键 -> 命中位置 -> 对角线（蛋白组起点），去重后整段无空位比对，
+# BLOSUM62（Biopython）打分，按 得分 / 自身得分 排序；间隔种子让有替换的近似肽也能被找到。
+# 肽段来源：--pdb 经 pdb2orf 的序列读取器取链序列，表位链取滑动窗口，scFv 链按 Martin 规则切出 CDR；或 --peptides 直接给出。
+#
+#   python M3_mRNA_design/m3_offtarget_scan.py --proteome UP000005640_9606.fasta.gz \
+#       --pdb M2_structural_modeling/docking2_fullCAR_centroid.pdb --epitope_chain A --scfv_chain B --self_gene CLDN18
+import argparse, os, re, sys, json
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+proc_dir = os.path.join(BASE, 'dataprocessed')
+
+AA = "ARNDCQEGHILKMFPSTWYV"
+X_CODE, SEP_CODE = 20, 21           # 非标准氨基酸 / 蛋白间分隔
+DEFAULT_SEEDS = ["1111", "11011", "110101", "1001011"]
+WINDOW = 9                          # 表位链滑动窗口长度（MHC-I 表位长度量级）
+BATCH_PEPTIDES = 64
+
+
+def read_proteome(path):
+    """FASTA（可 .gz）-> [(accession, gene, 序列)]；UniProt 头 sp|P56856|CLD18_HUMAN ... GN=CLDN18"""
+    import io
+    from star_reader import open_binary
+    out, head, seq = [], None, []
+
+    def flush():
+        if head is not None:
+            first = head.split()[0]
+            parts = first.split("|")
+            acc = parts[1] if len(parts) >= 3 else first
+            m = re.search(r"\bGN=(\S+)", head)
+            out.append((acc, m.group(1) if m else "", "".join(seq).upper()))
+
+    with open_binary(path) as fb, io.TextIOWrapper(fb, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                flush()
+                head, seq = line[1:], []
+            elif line:
+                seq.append(line)
+    flush()
+    return out
+
+
+def encode(seq):
+    import numpy as np
+    lut = np.full(256, X_CODE, dtype=np.uint8)
+    for i, a in enumerate(AA):
+        lut[ord(a)] = i
+        lut[ord(a.lower())] = i
+    return lut[np.frombuffer(seq.encode("ascii", "replace"), dtype=np.uint8)]
+
+
+def seed_keys(codes, seed):
+    """每个起点的种子键（20 进制）；种子覆盖到非标准氨基酸 / 分隔符的位置键为 -1"""
+    import numpy as np
+    offs = [i for i, c in enumerate(seed) if c == "1"]
+    n = len(codes) - len(seed) + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    key = np.zeros(n, dtype=np.int64)
+    bad = np.zeros(n, dtype=bool)
+    for o in offs:
+        c = codes[o:o + n]
+        key = key * 20 + np.minimum(c, 19)
+        bad |= c >= X_CODE
+    key[bad] = -1
+    return key
+
+
+def index_dir_for(proteome):
+    stem = os.path.basename(proteome).split(".")[0]
+    return os.path.join(proc_dir, f"offtarget_{stem}.idx")
+
+
+def build_index(proteome, outdir, seeds=DEFAULT_SEEDS):
+    """
+    蛋白组 -> 索引目录：seq.npy（编码 + 分隔符）、starts.npy（每个蛋白起点）、proteins.tsv、
+    每个种子 <seed>.keys.npy（唯一键）/ .ptr.npy（CSR 指针）/ .pos.npy（int32 位置），meta.json。
+    """
+    import numpy as np
+    prots = read_proteome(proteome)
+    if not prots:
+        raise SystemExit(f"No sequences in {proteome}")
+    os.makedirs(outdir, exist_ok=True)
+    lens = np.array([len(s) for _, _, s in prots], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lens + 1)[:-1]])
+    seq = encode("\x00".join(s for _, _, s in prots))
+    seq[starts[1:] - 1] = SEP_CODE
+    np.save(os.path.join(outdir, "seq.npy"), seq)
+    np.save(os.path.join(outdir, "starts.npy"), starts)
+    with open(os.path.join(outdir, "proteins.tsv"), "w", encoding="utf-8") as f:
+        f.write("accession\tgene\tlength\n")
+        for (acc, gene, _), n in zip(prots, lens):
+            f.write(f"{acc}\t{gene}\t{n}\n")
+    for sd in seeds:
+        key = seed_keys(seq, sd)
+        pos = np.flatnonzero(key >= 0)
+        k = key[pos]
+        order = np.argsort(k, kind="stable")
+        k, pos = k[order], pos[order].astype(np.int32)
+        uniq, first = np.unique(k, return_index=True)
+        np.save(os.path.join(outdir, f"{sd}.keys.npy"), uniq)
+        np.save(os.path.join(outdir, f"{sd}.ptr.npy"), np.append(first, len(k)).astype(np.int64))
+        np.save(os.path.join(outdir, f"{sd}.pos.npy"), pos)
+    meta = {"proteome": os.path.abspath(proteome), "mtime": os.path.getmtime(proteome), "seeds": list(seeds),
+            "n_proteins": len(prots), "n_residues": int(lens.sum())}
+    with open(os.path.join(outdir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def ensure_index(proteome, outdir=None, seeds=DEFAULT_SEEDS, rebuild=False):
+    """已有且与蛋白组 / 种子一致的索引直接复用，否则重建。返回 (索引目录, meta, 是否新建)"""
+    outdir = outdir or index_dir_for(proteome)
+    p = os.path.join(outdir, "meta.json")
+    if not rebuild and os.path.exists(p):
+        with open(p, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("seeds") == list(seeds) and (not os.path.exists(proteome) or
+                                                 meta.get("mtime") == os.path.getmtime(proteome)):
+            return outdir, meta, False
+    if not os.path.exists(proteome):
+        raise SystemExit(f"Proteome FASTA not found: {proteome}")
+    return outdir, build_index(proteome, outdir, seeds), True
+
+
+def load_index(outdir):
+    """索引目录 -> dict（数组全部 memmap）"""
+    import numpy as np
+    with open(os.path.join(outdir, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    ld = lambda n: np.load(os.path.join(outdir, n), mmap_mode="r")
+    idx = {"meta": meta, "seq": ld("seq.npy"), "starts": np.asarray(ld("starts.npy")), "seeds": {}}
+    for sd in meta["seeds"]:
+        idx["seeds"][sd] = (np.asarray(ld(f"{sd}.keys.npy")), ld(f"{sd}.ptr.npy"), ld(f"{sd}.pos.npy"))
+    return idx
+
+
+def blosum62():
+    """BLOSUM62 -> 22 x 22 int 矩阵（AA 顺序 + X；分隔符行列为 -100，比对不会跨蛋白）"""
+    import numpy as np
+    from Bio.Align import substitution_matrices
+    m = substitution_matrices.load("BLOSUM62")
+    S = np.full((22, 22), -100, dtype=np.int32)
+    letters = AA + "X"
+    for i, a in enumerate(letters):
+        for j, b in enumerate(letters):
+            S[i, j] = int(m[a][b])
+    return S
+
+
+def candidates(idx, pep_codes):
+    """
+    所有种子、所有偏移的命中 -> 去重后的对角线（候选比对在蛋白组中的起点）及支持的种子命中数。
+    窗口 seq[d:d+L] 必须落在单个蛋白内：跨分隔符的对角线直接丢弃（不靠分隔符罚分挡住）。
+    """
+    import numpy as np
+    L = len(pep_codes)
+    diags = []
+    for sd, (keys, ptr, pos) in idx["seeds"].items():
+        q = seed_keys(pep_codes, sd)
+        ok = q >= 0
+        off = np.flatnonzero(ok)
+        if not len(off):
+            continue
+        j = np.searchsorted(keys, q[ok])
+        j = np.minimum(j, len(keys) - 1)
+        hit = keys[j] == q[ok]
+        for o, jj in zip(off[hit], j[hit]):
+            diags.append(np.asarray(pos[ptr[jj]:ptr[jj + 1]], dtype=np.int64) - o)
+    if not diags:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    d = np.concatenate(diags)
+    d = d[(d >= 0) & (d + L <= len(idx["seq"]))]
+    # 所在蛋白的终点（下一个蛋白起点前的分隔符位置；最后一个蛋白到序列末尾）
+    starts = idx["starts"]
+    ends = np.append(starts[1:] - 1, len(idx["seq"]))
+    d = d[d + L <= ends[np.searchsorted(starts, d, side="right") - 1]]
+    return np.unique(d, return_counts=True)
+
+
+def scan_peptide(idx, S, pep, top=20, min_seeds=1, min_norm=0.0):
+    """
+    单条肽段：候选对角线整段无空位 BLOSUM62 打分。
+    返回 [(起点, 得分, 自身得分, 一致数, 种子命中数)]，按得分降序，最多 top 条。
+    """
+    import numpy as np
+    c = encode(pep)
+    d, n = candidates(idx, c)
+    keep = n >= min_seeds
+    d, n = d[keep], n[keep]
+    if not len(d):
+        return []
+    L = len(c)
+    win = np.asarray(idx["seq"][d[:, None] + np.arange(L)[None, :]])
+    if (win == SEP_CODE).any():
+        raise RuntimeError(f"candidate window spans a protein boundary for {pep!r}")
+    sc = S[c[None, :], win].sum(axis=1)
+    self_sc = int(S[c, c].sum())
+    ident = (win == c[None, :]).sum(axis=1)
+    ok = (sc > 0) & (sc >= min_norm * self_sc)
+    d, sc, ident, n = d[ok], sc[ok], ident[ok], n[ok]
+    order = np.lexsort((-ident, -sc))[:top]
+    return [(int(d[i]), int(sc[i]), self_sc, int(ident[i]), int(n[i])) for i in order]
+
+
+_W = {}
+
+
+def _init_worker(index_dir):
+    _W["idx"] = load_index(index_dir)
+    _W["S"] = blosum62()
+
+
+def _scan_batch(job):
+    peps, top, min_seeds, min_norm = job
+    return [scan_peptide(_W["idx"], _W["S"], p, top, min_seeds, min_norm) for p in peps]
+
+
+def scan(index_dir, peptides, top=20, min_seeds=1, min_norm=0.0, workers=1):
+    """全部肽段按批分给进程池（每个进程 memmap 同一份索引）-> 与 peptides 同序的命中列表"""
+    from concurrent.futures import ProcessPoolExecutor
+    batches = [peptides[i:i + BATCH_PEPTIDES] for i in range(0, len(peptides), BATCH_PEPTIDES)]
+    jobs = [(b, top, min_seeds, min_norm) for b in batches]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index_dir,)) as ex:
+            parts = list(ex.map(_scan_batch, jobs))
+    else:
+        _init_worker(index_dir)
+        parts = [_scan_batch(j) for j in jobs]
+    return [h for p in parts for h in p]
+
+
+# ---- 肽段来源 ----
+
+# Martin（abYsis）规则的简化正则：CDR 前后的保守框架基序
+_CDR_RULES = {
+    "L1": r"C(?P<cdr>[A-Z]{10,17})W[YLF][QL]",
+    "L3": r"(?<=[A-Z]{40})C(?P<cdr>[A-Z]{7,11})FG[A-Z]G",
+    "H1": r"C[A-Z]{3}(?P<cdr>[A-Z]{10,12})W[VIA][RK]Q",
+    "H3": r"(?<=[A-Z]{80})C[A-Z]{2}(?P<cdr>[A-Z]{3,25})WG[A-Z]G",
+}
+
+
+def padded(seq, s, e, min_len=0):
+    """seq[s:e]，短于 min_len 时两侧补上框架残基（居中）"""
+    extra = max(min_len - (e - s), 0)
+    s = max(s - extra // 2, 0)
+    e = min(max(e, s + min_len), len(seq))
+    s = max(min(s, e - min_len), 0)
+    return seq[s:e]
+
+
+def cdr_peptides(seq, min_len=0):
+    """
+    scFv / VH / VL 序列 -> {CDR 名: 肽段}（按保守基序定位，Kabat 边界近似；H2 / L2 按与 H1 / L1 的固定间距）。
+    scFv 两个可变区各找一次（每条规则取所有匹配，按出现顺序编号）；短于 min_len 的 CDR 带上两侧框架残基。
+    """
+    out = {}
+    for name, rx in _CDR_RULES.items():
+        for k, m in enumerate(re.finditer(rx, seq)):
+            tag = name if k == 0 else f"{name}_{k + 1}"
+            s, e = m.span("cdr")
+            out[tag] = padded(seq, s, e, min_len)
+            if name == "L1" and e + 22 <= len(seq):
+                out[tag.replace("L1", "L2")] = padded(seq, e + 15, e + 22, min_len)
+            elif name == "H1" and e + 31 <= len(seq):
+                out[tag.replace("H1", "H2")] = padded(seq, e + 14, e + 31, min_len)
+    return {k: v for k, v in out.items() if v}
+
+
+def windows(seq, length=WINDOW, step=1):
+    return {f"{i + 1}-{i + length}": seq[i:i + length] for i in range(0, max(len(seq) - length + 1, 1), step)}
+
+
+def peptides_from_args(args):
+    """-> [(构建体, 肽段 ID, 来源, 序列)]"""
+    peps = []
+    if args.peptides:
+        with open(args.peptides, "r", encoding="utf-8") as f:
+            fasta = f.read(1) == ">"
+        if fasta:
+            for name, _, s in read_proteome(args.peptides):
+                peps.append((os.path.basename(args.peptides), name, "peptide", s))
+        else:
+            with open(args.peptides, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and not line.startswith("#"):
+                        peps.append((os.path.basename(args.peptides), parts[0], "peptide", parts[1].upper()))
+    for pdb in args.pdb or []:
+        from pdb2orf import read_pdb_to_sequences
+        seqs = read_pdb_to_sequences(pdb)
+        name = os.path.basename(pdb).rsplit(".", 1)[0]
+        for ch in args.epitope_chain or []:
+            if ch not in seqs:
+                raise SystemExit(f"{pdb}: no chain {ch!r} (chains: {','.join(sorted(seqs))})")
+            s = seqs[ch]
+            if args.epitope_range:
+                a, b = (int(x) for x in args.epitope_range.split("-"))
+                s = s[a - 1:b]
+            for wid, w in windows(s, args.window).items():
+                peps.append((name, f"{ch}:{wid}", "epitope", w))
+        for ch in args.scfv_chain or []:
+            if ch not in seqs:
+                raise SystemExit(f"{pdb}: no chain {ch!r} (chains: {','.join(sorted(seqs))})")
+            cdrs = cdr_peptides(seqs[ch], args.window)
+            if not cdrs:
+                print(f"[WARN] {name} chain {ch}: no CDR motifs found, scanning {args.window}-mer windows instead")
+                cdrs = {f"w{k}": v for k, v in windows(seqs[ch], args.window).items()}
+            for cid, c in cdrs.items():
+                peps.append((name, f"{ch}:{cid}", "cdr", c))
+    return [p for p in peps if len(p[3]) >= min(len(s) for s in DEFAULT_SEEDS)]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Epitope / CDR off-target scan against a proteome (k-mer + spaced-seed index, BLOSUM62)")
+    ap.add_argument("--proteome", required=True, help="protein FASTA (.fa/.fasta[.gz]), e.g. UniProt human reference proteome")
+    ap.add_argument("--index", default="", help="index dir (default: dataprocessed/offtarget_<proteome>.idx)")
+    ap.add_argument("--seeds", default=",".join(DEFAULT_SEEDS), help="seed patterns, 1 = matching position")
+    ap.add_argument("--rebuild", action="store_true")
+    ap.add_argument("--pdb", nargs="*", default=[], help="PDB files (sequences via pdb2orf's reader)")
+    ap.add_argument("--epitope_chain", nargs="*", default=[], help="chains scanned as sliding windows")
+    ap.add_argument("--epitope_range", default="", help="residue range within the epitope chain, e.g. 140-175")
+    ap.add_argument("--scfv_chain", nargs="*", default=[], help="scFv / VH / VL chains: CDR peptides")
+    ap.add_argument("--peptides", default="", help="extra peptides: FASTA or name<TAB>sequence")
+    ap.add_argument("--window", type=int, default=WINDOW, help="epitope window length; shorter CDRs are padded with framework flanks to it")
+    ap.add_argument("--top", type=int, default=20, help="hits kept per peptide")
+    ap.add_argument("--min_seeds", type=int, default=1, help="seed hits required on a diagonal")
+    ap.add_argument("--min_norm", type=float, default=0.3, help="minimum score / self-score")
+    ap.add_argument("--self_gene", nargs="*", default=["CLDN18"], help="on-target genes (flagged, not counted as off-target)")
+    ap.add_argument("--workers", type=int, default=max(1, min(8, os.cpu_count() or 1)))
+    ap.add_argument("--out", default=os.path.join("M3_mRNA_design", "out", "offtarget_hits.tsv"))
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    import numpy as np
+    import pandas as pd
+    seeds = [s.strip() for s in args.seeds.split(",") if s.strip()]
+    if any(set(s) - {"0", "1"} or s[0] != "1" or s[-1] != "1" for s in seeds):
+        raise SystemExit("--seeds: patterns of 0/1 starting and ending with 1, e.g. 1111,11011")
+    with span("index") as sp:
+        index_dir, meta, built = ensure_index(args.proteome, args.index or None, seeds, args.rebuild)
+        sp.set(built=built, proteins=meta["n_proteins"], residues=meta["n_residues"])
+    with span("peptides") as sp:
+        peps = sp.shape(peptides_from_args(args))
+    if not peps:
+        raise SystemExit("No peptides to scan (give --pdb with --epitope_chain / --scfv_chain, or --peptides).")
+
+    with span("scan", rows=len(peps)):
+        hits = scan(index_dir, [p[3] for p in peps], args.top, args.min_seeds, args.min_norm, args.workers)
+
+    with span("write"):
+        prots = pd.read_csv(os.path.join(index_dir, "proteins.tsv"), sep="\t", dtype=str, keep_default_na=False)
+        starts = np.load(os.path.join(index_dir, "starts.npy"))
+        seq = np.load(os.path.join(index_dir, "seq.npy"), mmap_mode="r")
+        selfs = set(args.self_gene or [])
+        rows = []
+        for (construct, pid, source, pep), hs in zip(peps, hits):
+            for rank, (pos, sc, self_sc, ident, n) in enumerate(hs, 1):
+                k = int(np.searchsorted(starts, pos, side="right") - 1)
+                match = "".join((AA + "X")[c] for c in seq[pos:pos + len(pep)])
+                gene = prots["gene"].iat[k]
+                rows.append({"construct": construct, "peptide_id": pid, "source": source, "peptide": pep,
+                             "rank": rank, "accession": prots["accession"].iat[k], "gene": gene,
+                             "start": int(pos - starts[k] + 1), "match": match, "score": sc, "self_score": self_sc,
+                             "norm_score": sc / self_sc if self_sc else 0.0, "identity": ident / len(pep),
+                             "seed_hits": n, "on_target": gene in selfs})
+        cols = ["construct", "peptide_id", "source", "peptide", "rank", "accession", "gene", "start", "match",
+                "score", "self_score", "norm_score", "identity", "seed_hits", "on_target"]
+        tab = pd.DataFrame(rows, columns=cols)
+        Path(os.path.dirname(os.path.abspath(args.out))).mkdir(parents=True, exist_ok=True)
+        tab.to_csv(args.out, sep="\t", index=False, float_format="%.4g")
+        off = tab[~tab["on_target"]].sort_values(["norm_score", "identity"], ascending=False)
+        summ = off.drop_duplicates(["construct", "peptide_id"]).sort_values(["construct", "norm_score"], ascending=[True, False])
+        s_path = os.path.splitext(args.out)[0] + "_summary.tsv"
+        summ.to_csv(s_path, sep="\t", index=False, float_format="%.4g")
+
+    print(f"[OK] Index: {meta['n_proteins']} proteins, {meta['n_residues']} residues, seeds {','.join(seeds)}"
+          f" ({'built' if built else 'reused'}: {index_dir})")
+    print(f"[OK] Scanned {len(peps)} peptides -> {len(tab)} hits ({len(off)} off-target)")
+    if len(summ):
+        print(summ.head(10)[["construct", "peptide_id", "peptide", "gene", "match", "norm_score", "identity"]].to_string(index=False))
+    print("[OK] Wrote", args.out)
+    print("[OK] Wrote", s_path)
+
+
+if __name__ == "__main__":
+    main()
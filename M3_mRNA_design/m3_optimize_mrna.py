@@ -3,6 +3,9 @@
 import argparse, sys, os, re, subprocess, shutil
 from pathlib import Path
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
+
 def read_fasta(p):
     if not p: return ""
     seq = []
@@ -67,43 +70,91 @@ def main():
     ap.add_argument("--check_mfe", default="false")  # "true"/"false"
     ap.add_argument("--out", required=True)
     ap.add_argument("--lead_model", default="")  # 仅记录来源，非必需
+    ap.add_argument("--translation", default="false")  # "true": 核糖体流模型估计翻译速率 / 碰撞热点
+    ap.add_argument("--codon_opt_rounds", type=int, default=0)  # >0: 按核糖体流模型贪心替换同义密码子（隐含 --translation true）
+    ap.add_argument("--codon_rates", default="")  # codon<TAB>rate；默认按人类密码子使用频率
+    ap.add_argument("--init_rate", type=float, default=1.0)
+    add_trace_args(ap)
     args = ap.parse_args()
+    setup_trace(args)
 
-    utr5 = read_fasta(args.utr5)
-    orf  = read_fasta(args.orf)
-    utr3 = read_fasta(args.utr3)
+    with span("load"):
+        utr5 = read_fasta(args.utr5)
+        orf  = read_fasta(args.orf)
+        utr3 = read_fasta(args.utr3)
     if not orf:
         print("ERROR: ORF fasta is empty or not found.", file=sys.stderr); sys.exit(2)
 
+    translation = None
+    if str(args.translation).lower() == "true" or args.codon_opt_rounds > 0:
+        import m3_translation_sim as ts
+        rates = ts.load_codon_rates(args.codon_rates or None)
+        if args.codon_opt_rounds > 0:
+            # 起始序列已超出 GC ±0.1 / 已有长同聚物时，约束放宽为“不比起始更差”，否则每个候选都被拒、优化不生效
+            m0 = (utr5 + orf + utr3).replace("T","U")
+            gc_tol = max(0.1, abs(gc_content(m0) - args.target_gc))
+            rep0 = has_long_repeat(m0, args.avoid_repeats)
+            if gc_tol > 0.1:
+                print(f"[WARN] input GC {gc_content(m0):.3f} is already outside target {args.target_gc:.2f}±0.1; "
+                      f"codon optimization only keeps the deviation from growing")
+            def accept(o):
+                m = (utr5 + o + utr3).replace("T","U")
+                return abs(gc_content(m) - args.target_gc) <= gc_tol and (rep0 or not has_long_repeat(m, args.avoid_repeats))
+            with span("codon_opt", rows=args.codon_opt_rounds):
+                orf, swaps = ts.optimize_codons(utr5, orf, rates, args.codon_opt_rounds, accept, args.init_rate)
+        with span("translation"):
+            res = ts.simulate([(utr5, orf)], rates, args.init_rate)
+            cods = ts.codons_of(orf)
+            translation = {"rate": float(res["rate"][0]), "ribosomes": float(res["ribosomes"][0]),
+                           "collisions": float(res["collisions"][0]),
+                           "hotspots": ts.hotspots(res["site_collisions"][0], cods, rates, top=3)}
+            if args.codon_opt_rounds > 0:
+                translation["swaps"] = swaps
+
     mrna = (utr5 + orf + utr3).replace("T","U")
-    gc = gc_content(mrna)
     warn = []
-    if gc < args.target_gc-0.1 or gc > args.target_gc+0.1:
-        warn.append(f"GC {gc:.3f} deviates from target ~{args.target_gc:.2f}")
-    if has_long_repeat(mrna, args.avoid_repeats):
-        warn.append(f"Has >= {args.avoid_repeats} homopolymer run")
+    with span("score", rows=len(mrna)):
+        gc = gc_content(mrna)
+        if gc < args.target_gc-0.1 or gc > args.target_gc+0.1:
+            warn.append(f"GC {gc:.3f} deviates from target ~{args.target_gc:.2f}")
+        if has_long_repeat(mrna, args.avoid_repeats):
+            warn.append(f"Has >= {args.avoid_repeats} homopolymer run")
 
     mfe = None
     if str(args.check_mfe).lower() == "true":
-        mfe = check_mfe_with_tool(mrna, tool="auto")
+        with span("mfe"):
+            mfe = check_mfe_with_tool(mrna, tool="auto")
         if mfe is None:
             warn.append("MFE tool not found (RNAfold/Fold). Skipped ΔG check.")
 
-    Path(os.path.dirname(args.out)).mkdir(parents=True, exist_ok=True)
-    with open(args.out, "w") as f:
-        f.write(">CLDN18_2-CAR_mRNA\n")
-        f.write(mrna+"\n")
+    with span("write"):
+        Path(os.path.dirname(args.out)).mkdir(parents=True, exist_ok=True)
+        with open(args.out, "w") as f:
+            f.write(">CLDN18_2-CAR_mRNA\n")
+            f.write(mrna+"\n")
 
-    # 同时写一份小日志
-    meta = args.out.replace(".fasta", ".log.txt")
-    with open(meta, "w") as f:
-        f.write(f"lead_model={args.lead_model}\n")
-        f.write(f"len={len(mrna)} gc={gc:.4f}\n")
-        if mfe is not None:
-            f.write(f"MFE_approx={mfe}\n")
-        if warn:
-            f.write("WARN="+" | ".join(warn)+"\n")
+        # 同时写一份小日志
+        meta = args.out.replace(".fasta", ".log.txt")
+        with open(meta, "w") as f:
+            f.write(f"lead_model={args.lead_model}\n")
+            f.write(f"len={len(mrna)} gc={gc:.4f}\n")
+            if mfe is not None:
+                f.write(f"MFE_approx={mfe}\n")
+            if translation is not None:
+                f.write(f"translation_rate={translation['rate']:.6g} ribosomes={translation['ribosomes']:.3f} "
+                        f"collisions_per_protein={translation['collisions']:.4f}\n")
+                f.write("collision_hotspots=" + ";".join(f"{a}-{b}:{c:.3f}({s})" for a, b, c, s in translation["hotspots"]) + "\n")
+                if "swaps" in translation:
+                    f.write(f"codon_swaps={len(translation['swaps'])} " +
+                            ";".join(f"{p}:{o}>{n}" for _, p, o, n, _ in translation["swaps"]) + "\n")
+            if warn:
+                f.write("WARN="+" | ".join(warn)+"\n")
     print(f"[OK] Wrote {args.out}")
+    if translation is not None:
+        msg = f"[OK] Translation rate {translation['rate']:.4g}/s, {translation['collisions']:.3f} collisions/protein"
+        if "swaps" in translation:
+            msg += f", {len(translation['swaps'])} codon swaps"
+        print(msg)
     if warn:
         print("[WARN]", " | ".join(warn))
 
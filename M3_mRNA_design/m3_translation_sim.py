@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 翻译动力学：核糖体流模型（RFM，TASEP 的平均场近似，Reuveni 等 2011），估计每条 mRNA 的蛋白产出速率与核糖体碰撞热点。
+# ORF 按核糖体足迹（默认 10 个密码子）分块，每块速率 = 1 / Σ(1/密码子延伸速率)；起始速率由 --init_rate 乘以 5'UTR 修正
+# （上游 AUG、Kozak 上下文，经验系数）。稳态满足
+#   J = α(1 - x1) = λ1 x1 (1 - x2) = ... = λn xn
+# 给定 J 可从 3' 端反推各块占据率 x，α(1 - x1) - J 随 J 单调，二分求根；
+# 多条候选构建体左侧补齐成 (构建体 x 块) 数组一起二分，一次调用即可评估成百上千条候选，可直接放进密码子优化循环。
+# 碰撞（被阻挡的跳跃）速率：块 i 为 λi xi x(i+1)，起始处为 α x1；除以 J 即每产出一条肽链的平均碰撞次数。
+import argparse, os, sys
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
+
+# 人类密码子使用频率（每千密码子，Kazusa / GenBank），作为相对延伸速率的默认近似
+HUMAN_USAGE = {
+ "UUU":17.6,"UCU":15.2,"UAU":12.2,"UGU":10.6,"UUC":20.3,"UCC":17.7,"UAC":15.3,"UGC":12.6,
+ "UUA":7.7,"UCA":12.2,"UAA":1.0,"UGA":1.6,"UUG":12.9,"UCG":4.4,"UAG":0.8,"UGG":13.2,
+ "CUU":13.2,"CCU":17.5,"CAU":10.9,"CGU":4.5,"CUC":19.6,"CCC":19.8,"CAC":15.1,"CGC":10.4,
+ "CUA":7.2,"CCA":16.9,"CAA":12.3,"CGA":6.2,"CUG":39.6,"CCG":6.9,"CAG":34.2,"CGG":11.4,
+ "AUU":16.0,"ACU":13.1,"AAU":17.0,"AGU":12.1,"AUC":20.8,"ACC":18.9,"AAC":19.1,"AGC":19.5,
+ "AUA":7.5,"ACA":15.1,"AAA":24.4,"AGA":12.2,"AUG":22.0,"ACG":6.1,"AAG":31.9,"AGG":12.0,
+ "GUU":11.0,"GCU":18.4,"GAU":21.8,"GGU":10.8,"GUC":14.5,"GCC":27.7,"GAC":25.1,"GGC":22.2,
+ "GUA":7.1,"GCA":15.8,"GAA":29.0,"GGA":16.5,"GUG":28.1,"GCG":7.4,"GAG":39.6,"GGG":16.5,
+}
+STOPS = ("UAA", "UAG", "UGA")
+GENETIC_CODE = {
+ "F":"UUU UUC","L":"UUA UUG CUU CUC CUA CUG","I":"AUU AUC AUA","M":"AUG","V":"GUU GUC GUA GUG",
+ "S":"UCU UCC UCA UCG AGU AGC","P":"CCU CCC CCA CCG","T":"ACU ACC ACA ACG","A":"GCU GCC GCA GCG",
+ "Y":"UAU UAC","H":"CAU CAC","Q":"CAA CAG","N":"AAU AAC","K":"AAA AAG","D":"GAU GAC","E":"GAA GAG",
+ "C":"UGU UGC","W":"UGG","R":"CGU CGC CGA CGG AGA AGG","G":"GGU GGC GGA GGG","*":"UAA UAG UGA",
+}
+AA_OF = {c: aa for aa, cs in GENETIC_CODE.items() for c in cs.split()}
+
+ELONGATION_MEAN = 5.6   # 哺乳动物平均延伸速率，密码子/秒
+TERMINATION_RATE = 5.6
+INIT_RATE = 1.0         # 起始速率，次/秒（相对量）
+FOOTPRINT = 10          # 核糖体足迹，密码子
+UAUG_PENALTY = 0.5      # 每个上游 AUG 的起始效率折扣
+BISECT_ITERS = 60
+
+
+def read_fasta_records(p):
+    """多条记录的 FASTA -> [(名字, 序列)]（大写，T->U）"""
+    recs, name, seq = [], None, []
+    with open(p, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    recs.append((name, "".join(seq)))
+                name, seq = line[1:].split()[0] if len(line) > 1 else f"seq{len(recs) + 1}", []
+            elif line:
+                seq.append(line.upper().replace("T", "U"))
+    if name is not None:
+        recs.append((name, "".join(seq)))
+    return recs
+
+
+def load_codon_rates(path=None, mean_rate=ELONGATION_MEAN):
+    """
+    密码子 -> 延伸速率（密码子/秒）。默认按人类密码子使用频率线性缩放，使有义密码子平均为 mean_rate；
+    path 为 codon<TAB>rate 两列表时直接使用（未列出的密码子取表内均值）。终止密码子取 TERMINATION_RATE。
+    """
+    if path:
+        rates = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and not line.startswith('#'):
+                    try:
+                        rates[parts[0].upper().replace("T", "U")] = float(parts[1])
+                    except ValueError:
+                        continue
+        fill = sum(rates.values()) / len(rates)
+        return {c: rates.get(c, fill) for c in HUMAN_USAGE}
+    sense = [v for c, v in HUMAN_USAGE.items() if c not in STOPS]
+    scale = mean_rate / (sum(sense) / len(sense))
+    return {c: (TERMINATION_RATE if c in STOPS else v * scale) for c, v in HUMAN_USAGE.items()}
+
+
+def codons_of(orf):
+    """ORF -> 密码子列表（到第一个终止密码子为止，含终止）"""
+    orf = orf.upper().replace("T", "U")
+    out = []
+    for i in range(0, len(orf) - 2, 3):
+        c = orf[i:i + 3]
+        out.append(c)
+        if c in STOPS:
+            break
+    return out
+
+
+def init_efficiency(utr5, orf):
+    """
+    5'UTR 对起始的经验修正：每个上游 AUG 乘 UAUG_PENALTY；
+    Kozak（-3 位 A/G、+4 位 G）两者都有 1.0，只有其一 0.6，都没有 0.3。
+    """
+    utr5 = utr5.upper().replace("T", "U")
+    orf = orf.upper().replace("T", "U")
+    eff = UAUG_PENALTY ** utr5.count("AUG")
+    m3 = len(utr5) >= 3 and utr5[-3] in "AG"
+    p4 = len(orf) >= 4 and orf[3] == "G"
+    return eff * (1.0 if m3 and p4 else 0.6 if (m3 or p4) else 0.3)
+
+
+def site_rates(codons, rates, footprint=FOOTPRINT):
+    """密码子速率按足迹分块：块速率 = 1 / Σ 1/λ（块内停留时间之和）"""
+    import numpy as np
+    lam = np.array([rates.get(c, ELONGATION_MEAN) for c in codons], dtype=np.float64)
+    n = -(-len(lam) // footprint)
+    t = np.zeros(n * footprint)
+    t[:len(lam)] = 1.0 / lam
+    return 1.0 / t.reshape(n, footprint).sum(axis=1)
+
+
+def steady_state(alpha, lam, iters=BISECT_ITERS):
+    """
+    批量 RFM 稳态。alpha: (C,) 起始速率；lam: (C, S) 块速率，左侧补 inf 对齐到 3' 端。
+    返回 (J, x)：J 为翻译速率（肽链/秒/mRNA），x 为 (C, S) 占据率（补齐处为 0）。
+    """
+    import numpy as np
+    C, S = lam.shape
+    first = np.argmax(np.isfinite(lam), axis=1)
+    lo = np.zeros(C)
+    hi = np.minimum(alpha, np.min(lam, axis=1))
+
+    def backward(J):
+        x = np.zeros((C, S))
+        bad = np.zeros(C, dtype=bool)
+        nxt = np.zeros(C)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i in range(S - 1, -1, -1):
+                xi = np.where(bad, 1.0, J / (lam[:, i] * (1.0 - nxt)))
+                bad |= xi >= 1.0
+                xi = np.minimum(xi, 1.0)
+                x[:, i] = xi
+                nxt = xi
+        return x, bad
+
+    for _ in range(iters):
+        J = 0.5 * (lo + hi)
+        x, bad = backward(J)
+        x1 = x[np.arange(C), first]
+        up = ~bad & (alpha * (1.0 - x1) > J)
+        lo = np.where(up, J, lo)
+        hi = np.where(up, hi, J)
+    J = lo
+    x, _ = backward(J)
+    return J, x
+
+
+def pad_left(rows):
+    import numpy as np
+    S = max(len(r) for r in rows)
+    lam = np.full((len(rows), S), np.inf)
+    for k, r in enumerate(rows):
+        lam[k, S - len(r):] = r
+    return lam
+
+
+def simulate(constructs, rates, init_rate=INIT_RATE, footprint=FOOTPRINT):
+    """
+    constructs: [(utr5, orf)]。一次性计算全部构建体，返回 dict：
+    rate / init_eff / density（平均占据率）/ ribosomes（每条 mRNA 上的核糖体数）/
+    collisions（每条肽链的平均碰撞次数）/ site_collisions（每个构建体按块的碰撞率 / J，起始处在 [0]）。
+    """
+    import numpy as np
+    cods = [codons_of(orf) for _, orf in constructs]
+    alpha = np.array([init_rate * init_efficiency(u, o) for u, o in constructs])
+    rows = [site_rates(c, rates, footprint) for c in cods]
+    lam = pad_left(rows)
+    J, x = steady_state(alpha, lam)
+    S = lam.shape[1]
+    site_coll = []
+    for k, r in enumerate(rows):
+        xs = x[k, S - len(r):]
+        blocked = np.concatenate([[alpha[k] * xs[0]], r[:-1] * xs[:-1] * xs[1:]])
+        site_coll.append(blocked / J[k] if J[k] > 0 else blocked)
+    return {
+        'rate': J, 'init_eff': alpha / init_rate, 'n_codons': np.array([len(c) for c in cods]),
+        'density': np.array([x[k, S - len(r):].mean() for k, r in enumerate(rows)]),
+        'ribosomes': x.sum(axis=1), 'collisions': np.array([s.sum() for s in site_coll]),
+        'site_collisions': site_coll,
+    }
+
+
+def hotspots(site_coll, codons, rates, footprint=FOOTPRINT, top=5):
+    """
+    碰撞最多的块：[(起始密码子位置(1-based), 结束位置, 碰撞/肽链, 阻挡者)]；起始处位置记为 0。
+    块 i 的碰撞由下游块 i+1 占据造成，阻挡者为下游块内最慢的密码子。
+    """
+    import numpy as np
+    out = []
+    for i in np.argsort(-site_coll, kind='stable')[:top]:
+        if site_coll[i] <= 0:
+            break
+        a, b = max(i - 1, 0) * footprint, min(i * footprint, len(codons))
+        j = blocker_range(i, len(codons), footprint)
+        slow = min(j, key=lambda k: rates.get(codons[k], ELONGATION_MEAN))
+        out.append((a + 1 if i else 0, b if i else 0, float(site_coll[i]), f"{codons[slow]}@{slow + 1}"))
+    return out
+
+
+def blocker_range(i, n_codons, footprint=FOOTPRINT):
+    """site_collisions[i] 对应的下游（造成阻挡的）块的密码子下标范围"""
+    return range(i * footprint, min((i + 1) * footprint, n_codons))
+
+
+def optimize_codons(utr5, orf, rates, rounds=10, accept=None, init_rate=INIT_RATE, footprint=FOOTPRINT, top=3,
+                    min_gain=1e-4):
+    """
+    贪心密码子优化：每轮在碰撞最多的 top 处的阻挡块与限速块内，把每个密码子换成每个更快的同义密码子，
+    全部候选一次批量求稳态，取翻译速率最高且通过 accept(orf) 约束（如 GC / 同聚物）的一个；
+    相对提升不足 min_gain 则停止。
+    返回 (新 ORF, [(轮次, 位置, 旧密码子, 新密码子, 速率)])。
+    """
+    import numpy as np
+    cods = codons_of(orf)
+    tail = orf.upper().replace("T", "U")[3 * len(cods):]
+    syn = {aa: cs.split() for aa, cs in GENETIC_CODE.items()}
+    res = simulate([(utr5, orf)], rates, init_rate, footprint)
+    best, coll = float(res['rate'][0]), res['site_collisions'][0]
+    log = []
+    for r in range(1, rounds + 1):
+        cands = []
+        # 碰撞最多处的下游块 + 速率最慢（限速）的块
+        sites = {int(i) for i in np.argsort(-coll, kind='stable')[:top] if coll[i] > 0}
+        sites.add(int(np.argmin(site_rates(cods, rates, footprint))))
+        for i in sorted(sites):
+            for j in blocker_range(i, len(cods), footprint):
+                if j == 0 or cods[j] not in AA_OF or cods[j] in STOPS:
+                    continue
+                for c in syn[AA_OF[cods[j]]]:
+                    if rates[c] > rates[cods[j]]:
+                        cands.append((j, c))
+        seqs = []
+        for j, c in cands:
+            new = cods[:j] + [c] + cods[j + 1:]
+            seqs.append("".join(new) + tail)
+        keep = [k for k, s in enumerate(seqs) if accept is None or accept(s)]
+        if not keep:
+            break
+        res = simulate([(utr5, seqs[k]) for k in keep], rates, init_rate, footprint)
+        k = int(res['rate'].argmax())
+        if res['rate'][k] <= best * (1 + min_gain):
+            break
+        j, c = cands[keep[k]]
+        log.append((r, j + 1, cods[j], c, float(res['rate'][k])))
+        cods[j] = c
+        best, coll = float(res['rate'][k]), res['site_collisions'][k]
+    return "".join(cods) + tail, log
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Ribosome flow (TASEP mean-field) translation rate + collision hotspots for many constructs")
+    ap.add_argument("--orf", required=True, help="FASTA; every record is one candidate ORF")
+    ap.add_argument("--utr5", default="", help="5'UTR FASTA shared by all constructs")
+    ap.add_argument("--utr3", default="", help="3'UTR FASTA (recorded only; the flow model ends at the stop codon)")
+    ap.add_argument("--codon_rates", default="", help="codon<TAB>rate table (codons/s); default: scaled human codon usage")
+    ap.add_argument("--init_rate", type=float, default=INIT_RATE, help="initiation rate before 5'UTR adjustments (1/s)")
+    ap.add_argument("--footprint", type=int, default=FOOTPRINT, help="ribosome footprint in codons (site size)")
+    ap.add_argument("--top_hotspots", type=int, default=5)
+    ap.add_argument("--out", default=os.path.join("M3_mRNA_design", "out", "translation_sim.tsv"))
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    import pandas as pd
+    with span("load") as sp:
+        recs = sp.shape(read_fasta_records(args.orf))
+        utr5 = "".join(s for _, s in read_fasta_records(args.utr5)) if args.utr5 else ""
+        utr3 = "".join(s for _, s in read_fasta_records(args.utr3)) if args.utr3 else ""
+        rates = load_codon_rates(args.codon_rates or None)
+    if not recs:
+        raise SystemExit("ERROR: ORF fasta is empty or not found.")
+
+    with span("simulate", rows=len(recs)):
+        res = simulate([(utr5, s) for _, s in recs], rates, args.init_rate, args.footprint)
+
+    rows, hot = [], []
+    for k, (name, seq) in enumerate(recs):
+        cods = codons_of(seq)
+        hs = hotspots(res['site_collisions'][k], cods, rates, args.footprint, args.top_hotspots)
+        rows.append({'construct': name, 'mrna_len': len(utr5) + len(seq) + len(utr3), 'n_codons': len(cods),
+                     'stop': cods[-1] in STOPS if cods else False, 'init_eff': res['init_eff'][k],
+                     'rate_per_s': res['rate'][k], 'ribosomes': res['ribosomes'][k], 'density': res['density'][k],
+                     'collisions_per_protein': res['collisions'][k],
+                     'top_hotspot': f"{hs[0][0]}-{hs[0][1]}" if hs else ""})
+        hot += [{'construct': name, 'codon_start': a, 'codon_end': b, 'collisions_per_protein': c, 'slowest': s}
+                for a, b, c, s in hs]
+    tab = pd.DataFrame(rows).sort_values('rate_per_s', ascending=False)
+
+    with span("write"):
+        Path(os.path.dirname(os.path.abspath(args.out))).mkdir(parents=True, exist_ok=True)
+        tab.to_csv(args.out, sep="\t", index=False, float_format="%.6g")
+        hot_path = os.path.splitext(args.out)[0] + "_hotspots.tsv"
+        pd.DataFrame(hot, columns=['construct', 'codon_start', 'codon_end', 'collisions_per_protein', 'slowest']) \
+            .to_csv(hot_path, sep="\t", index=False, float_format="%.6g")
+    print(f"[OK] Ribosome flow: {len(recs)} constructs (footprint {args.footprint} codons, init {args.init_rate}/s)")
+    print(tab.head(10).to_string(index=False))
+    if not tab['stop'].all():
+        print("[WARN] constructs without an in-frame stop codon:", ", ".join(tab.loc[~tab['stop'], 'construct']))
+    print("[OK] Wrote", args.out)
+    print("[OK] Wrote", hot_path)
+
+
+if __name__ == "__main__":
+    main()
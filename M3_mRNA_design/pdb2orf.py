@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import argparse, os, re
+import argparse, os, re, sys
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
+
 # 3-letter AA -> 1-letter
 AA3 = {
  "ALA":"A","ARG":"R","ASN":"N","ASP":"D","CYS":"C","GLN":"Q","GLU":"E","GLY":"G",
@@ -64,9 +67,12 @@ def main():
     ap.add_argument("--out_protein", required=True, help="output AA FASTA")
     ap.add_argument("--out_orf", required=True, help="output ORF FASTA")
     ap.add_argument("--name", default="CLDN18_2-CAR_scfv", help="FASTA entry name")
+    add_trace_args(ap)
     args = ap.parse_args()
+    setup_trace(args)
 
-    seqs = read_pdb_to_sequences(args.pdb)
+    with span("load") as sp:
+        seqs = sp.shape(read_pdb_to_sequences(args.pdb))
     if not seqs:
         raise SystemExit("No sequences parsed from PDB (check file).")
 
@@ -75,11 +81,14 @@ def main():
     aa_concat = "".join(seqs[ch] for ch in chains_sorted)
 
     # 写蛋白FASTA（拼接版，链名版本可自己扩展）
-    write_fasta(args.out_protein, args.name+"_AA", aa_concat)
+    with span("write", kind="protein"):
+        write_fasta(args.out_protein, args.name+"_AA", aa_concat)
 
     # 2) 反向翻译为 ORF（DNA），再保存
-    dna = back_translate(aa_concat)
-    write_fasta(args.out_orf, args.name+"_ORF", dna)
+    with span("transform", rows=len(aa_concat)):
+        dna = back_translate(aa_concat)
+    with span("write", kind="orf"):
+        write_fasta(args.out_orf, args.name+"_ORF", dna)
 
     print("[OK] AA FASTA:", args.out_protein)
     print("[OK] ORF FASTA:", args.out_orf)
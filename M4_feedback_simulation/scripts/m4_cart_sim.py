@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CAR-T / tumor population dynamics over a whole cohort and many parameter scenarios.
+
+Every (patient, scenario) pair is one trajectory of four coupled ODEs (time in days):
+
+    T  tumor burden (1 = baseline)     dT = r T (1 - T/T_max) - kill_T
+    E  CAR-T effectors (dose E0)       dE = rho * stim * E / (1 + E/E_max) - delta E
+    N  antigen+ normal tissue (1 = intact)
+                                       dN = r_N (1 - N) - kill_N
+    I  cytokine level (CRS proxy)      dI = s (kill_T + kill_N) - d_I I
+
+    kill_T = kappa f(a_T) E T / (T + h)         kill_N = phi kappa f(a_N) E N / (N + h)
+    stim   = f(a_T) T / (T + g) + phi f(a_N) N / (N + g)
+    f(a)   = a^n / (a^n + K50^n)                (antigen-density dependent engagement)
+
+Antigen density per patient comes from the CLDN18 values written by m4_safety_boxplot.py
+(M4_Safety_values.tsv): a = linear count / median tumor value. From the default STAR input
+(log2(count+1)) that script writes log1p(log2(count+1)), so both transforms are undone
+(--input_scale log1p_log2p1, the default; log1p for a counts matrix). The normal-tissue
+density is the patient's matched Solid Tissue Normal when present, otherwise a draw from
+the cohort's normals (re-drawn per scenario). Killing drives expansion and expansion drives
+killing of both tumor and normal tissue - this is the feedback loop; phi is the accessibility
+of antigen in normal tissue (e.g. CLDN18.2 buried in gastric tight junctions).
+
+A scenario is one log-normal draw of all rate constants (--cv) applied to every patient, so
+each scenario gives a cohort response / toxicity rate. All trajectories are integrated
+together: state arrays are (patients x scenarios), fixed-step RK4, scenario blocks run
+across a process pool.
+
+  python M4_feedback_simulation/scripts/m4_cart_sim.py --values M4_feedback_simulation/out/M4_Safety_values.tsv \
+      --scenarios 2000 --outdir M4_feedback_simulation/out
+"""
+import os, sys, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "scripts"))
+from stage_trace import span, add_trace_args, setup_trace
+from tcga_samples import patient_id, TUMOR, NORMAL
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+VALUES = os.path.join(BASE, "M4_feedback_simulation", "out", "M4_Safety_values.tsv")
+
+# rates per day; T / N / E / I in relative units. Illustrative defaults: with STAD CLDN18 values
+# they give a cohort response rate around 50% (in the range reported for CLDN18.2 CAR-T in
+# gastric cancer) and a low on-target/off-tumor rate; override with --params.
+PARAMS = {
+    "r": 0.05, "T_max": 10.0, "kappa": 0.5, "h": 1.0, "rho": 1.0, "g": 0.1, "delta": 0.15,
+    "E_max": 5.0, "E0": 0.01, "K50": 1.5, "hill": 2.0, "phi": 0.25, "r_N": 0.2, "s": 1.0, "d_I": 0.7,
+}
+FIXED = ("T_max", "hill")           # not varied between scenarios
+STATES = ["T", "E", "N", "I"]
+CHUNK_SCENARIOS = 128
+DT_MAX = 0.25                       # days
+DT_SCALE = 1.5                      # lambda_max * dt (RK4 is stable up to 2.78)
+
+
+def parse_params(arg):
+    """"kappa=1.5,phi=0.1" -> dict (unknown names are an error)"""
+    out = {}
+    for kv in (arg or "").replace(" ", ",").split(","):
+        if not kv:
+            continue
+        k, sep, v = kv.partition("=")
+        if not sep:
+            raise SystemExit(f"bad --params entry {kv!r} (expected name=value)")
+        if k not in PARAMS:
+            raise SystemExit(f"unknown parameter {k!r} (known: {', '.join(PARAMS)})")
+        try:
+            out[k] = float(v)
+        except ValueError:
+            raise SystemExit(f"bad value for {k}: {v!r}")
+    return out
+
+
+def load_antigen(path, scale="log1p_log2p1"):
+    """
+    M4_Safety_values.tsv -> (tumor table, normal values by patient, pooled normal values), all on a
+    linear scale relative to the median tumor value.
+    """
+    import numpy as np
+    import pandas as pd
+    df = pd.read_csv(path, sep="\t")
+    lin = {"log1p_log2p1": lambda x: np.exp2(np.expm1(x)) - 1.0, "log1p": np.expm1,
+           "log2p1": lambda x: np.exp2(x) - 1.0, "linear": lambda x: x}[scale]
+    df["linear"] = np.clip(lin(df["expr"].to_numpy(dtype=np.float64)), 0.0, None)
+    df["patient"] = [patient_id(s) for s in df["sample"]]
+    tum = df[df["sample_type"] == TUMOR].drop_duplicates("sample").reset_index(drop=True)
+    nor = df[df["sample_type"] == NORMAL]
+    if tum.empty:
+        raise SystemExit(f"No '{TUMOR}' rows in {path}.")
+    ref = float(np.median(tum["linear"]))
+    if ref <= 0:
+        raise SystemExit("Median tumor expression is 0; antigen density cannot be normalized.")
+    tum["antigen"] = tum["linear"] / ref
+    matched = (nor.groupby("patient")["linear"].mean() / ref).to_dict()
+    return tum, matched, nor["linear"].to_numpy() / ref
+
+
+def sample_scenarios(n, cv=0.3, overrides=None, seed=42):
+    """n log-normal draws (median = base value) of every rate constant -> dict of (n,) arrays"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    sigma = np.sqrt(np.log(1 + cv * cv))
+    base = dict(PARAMS, **(overrides or {}))
+    return {k: (np.full(n, v) if k in FIXED or cv <= 0 else v * rng.lognormal(0.0, sigma, n))
+            for k, v in base.items()}
+
+
+def rhs(y, p, c):
+    """y: (4, P, D); p: parameters as (1, D); c: precomputed (P, D) coefficients from simulate_block"""
+    import numpy as np
+    T, E, N, I = y[0], y[1], y[2], y[3]
+    kill_t = c["kT"] * E * T / (T + p["h"])
+    kill_n = c["kN"] * E * N / (N + p["h"])
+    stim = c["fT"] * T / (T + p["g"]) + c["sN"] * N / (N + p["g"])
+    dy = np.empty_like(y)
+    dy[0] = p["r"] * T * (1.0 - T / p["T_max"]) - kill_t
+    dy[1] = p["rho"] * stim * E / (1.0 + E / p["E_max"]) - p["delta"] * E
+    dy[2] = p["r_N"] * (1.0 - N) - kill_n
+    dy[3] = p["s"] * (kill_t + kill_n) - p["d_I"] * I
+    return dy
+
+
+def stiffness(p):
+    """upper bound of the fastest rate of every scenario (sets the RK4 step)"""
+    return p["kappa"] * p["E_max"] / p["h"] + p["rho"] + p["r_N"] + p["d_I"]
+
+
+def engagement(a, K50, hill):
+    import numpy as np
+    an = np.power(a, hill)
+    return an / (an + np.power(K50, hill))
+
+
+def simulate_block(aT, aN, p, days=60.0, dt=None):
+    """
+    aT: (P,) tumor antigen; aN: (P, D) normal antigen; p: dict of (D,) parameters.
+    Returns dict of (P, D) read-outs: T_end, T_min, E_peak, t_E_peak, N_min, I_peak.
+    """
+    import numpy as np
+    q = {k: v[None, :] for k, v in p.items()}
+    fT = engagement(aT[:, None], q["K50"], q["hill"])
+    fN = engagement(aN, q["K50"], q["hill"])
+    c = {"fT": fT, "kT": q["kappa"] * fT, "kN": q["phi"] * q["kappa"] * fN, "sN": q["phi"] * fN}
+    if dt is None:
+        dt = min(DT_MAX, DT_SCALE / np.max(stiffness(p)))
+    steps = int(np.ceil(days / dt))
+    dt = days / steps
+    P, D = aN.shape
+    y = np.empty((4, P, D))
+    y[0], y[1], y[2], y[3] = 1.0, q["E0"], 1.0, 0.0
+    t_min, n_min = np.ones((P, D)), np.ones((P, D))
+    e_peak, i_peak, t_peak = y[1].copy(), np.zeros((P, D)), np.zeros((P, D))
+    for i in range(steps):
+        k1 = rhs(y, q, c)
+        k2 = rhs(y + 0.5 * dt * k1, q, c)
+        k3 = rhs(y + 0.5 * dt * k2, q, c)
+        k4 = rhs(y + dt * k3, q, c)
+        y += dt / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+        np.maximum(y, 0.0, out=y)
+        np.minimum(t_min, y[0], out=t_min)
+        np.minimum(n_min, y[2], out=n_min)
+        np.maximum(i_peak, y[3], out=i_peak)
+        hit = y[1] > e_peak
+        e_peak[hit] = y[1][hit]
+        t_peak[hit] = (i + 1) * dt
+    return {"T_end": y[0].copy(), "T_min": t_min, "E_peak": e_peak, "t_E_peak": t_peak,
+            "N_min": n_min, "I_peak": i_peak}
+
+
+def _run_block(job):
+    aT, aN, p, days = job
+    return simulate_block(aT, aN, p, days)
+
+
+def simulate_cohort(tum, matched, pooled, scen, days=60.0, seed=42, workers=1):
+    """All patients x all scenarios, scenario blocks across processes -> dict of (P, D) arrays"""
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+    rng = np.random.default_rng(seed + 1)
+    P, D = len(tum), len(next(iter(scen.values())))
+    aT = tum["antigen"].to_numpy()
+    own = np.array([matched.get(pt, np.nan) for pt in tum["patient"]])
+    if len(pooled):
+        aN = np.where(np.isnan(own)[:, None], rng.choice(pooled, size=(P, D)), own[:, None])
+    else:
+        aN = np.zeros((P, D))
+    # blocks of similar stiffness, so each block integrates with its own (largest stable) step
+    order = np.argsort(stiffness(scen), kind="stable")
+    chunk = max(1, min(CHUNK_SCENARIOS, -(-D // workers)))
+    jobs = [(aT, aN[:, s], {k: v[s] for k, v in scen.items()}, days)
+            for s in (order[i:i + chunk] for i in range(0, D, chunk))]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            parts = list(ex.map(_run_block, jobs))
+    else:
+        parts = [_run_block(j) for j in jobs]
+    inv = np.argsort(order)
+    out = {k: np.concatenate([r[k] for r in parts], axis=1)[:, inv] for k in parts[0]}
+    out["a_N"] = aN
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="CAR-T / tumor / normal-tissue dynamics, patients x parameter scenarios")
+    ap.add_argument("--values", default=VALUES, help="M4_Safety_values.tsv (sample, sample_type, expr)")
+    ap.add_argument("--input_scale", choices=["log1p_log2p1", "log1p", "log2p1", "linear"], default="log1p_log2p1",
+                    help="scale of the expr column (m4_safety_boxplot.py writes log1p of the matrix values: "
+                         "log1p_log2p1 for the log2(count+1) STAR matrix, log1p for a counts matrix)")
+    ap.add_argument("--scenarios", type=int, default=1000, help="parameter draws; each is applied to the whole cohort")
+    ap.add_argument("--cv", type=float, default=0.3, help="log-normal CV of every rate constant across scenarios")
+    ap.add_argument("--params", default="", help='base-value overrides, e.g. "kappa=1.5,phi=0.1,E0=0.02"')
+    ap.add_argument("--days", type=float, default=60.0)
+    ap.add_argument("--response_cut", type=float, default=0.34, help="responder: tumor burden at end <= this (x baseline)")
+    ap.add_argument("--cr_cut", type=float, default=1e-3, help="complete response: burden at end <= this")
+    ap.add_argument("--tox_cut", type=float, default=0.5, help="on-target/off-tumor toxicity: normal tissue min <= this")
+    ap.add_argument("--crs_cut", type=float, default=0.5, help="CRS: cytokine peak >= this")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--workers", type=int, default=max(1, min(8, os.cpu_count() or 1)))
+    ap.add_argument("--outdir", default=os.path.join(BASE, "M4_feedback_simulation", "out"))
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import numpy as np
+    import pandas as pd
+    import matplotlib.pyplot as plt
+
+    with span("load") as sp:
+        tum, matched, pooled = load_antigen(args.values, args.input_scale)
+        sp.shape(tum)
+    if not len(pooled):
+        print("[WARN] no Solid Tissue Normal values: normal-tissue antigen set to 0 (no on-target/off-tumor toxicity).")
+
+    with span("simulate", rows=len(tum) * args.scenarios) as sp:
+        scen = sample_scenarios(args.scenarios, args.cv, parse_params(args.params), args.seed)
+        res = simulate_cohort(tum, matched, pooled, scen, args.days, args.seed, args.workers)
+        sp.set(patients=len(tum), scenarios=args.scenarios)
+
+    resp = res["T_end"] <= args.response_cut
+    cr = res["T_end"] <= args.cr_cut
+    tox = res["N_min"] <= args.tox_cut
+    crs = res["I_peak"] >= args.crs_cut
+
+    with span("write"):
+        os.makedirs(args.outdir, exist_ok=True)
+        pat = pd.DataFrame({
+            "sample": tum["sample"], "patient": tum["patient"], "expr": tum["expr"], "antigen_tumor": tum["antigen"],
+            "normal_source": ["matched" if p in matched else "pooled" for p in tum["patient"]],
+            "antigen_normal_median": np.median(res["a_N"], axis=1),
+            "p_response": resp.mean(axis=1), "p_cr": cr.mean(axis=1), "p_tox": tox.mean(axis=1),
+            "p_crs": crs.mean(axis=1), "p_response_no_tox": (resp & ~tox).mean(axis=1),
+            "T_end_median": np.median(res["T_end"], axis=1), "E_peak_median": np.median(res["E_peak"], axis=1),
+            "t_E_peak_median": np.median(res["t_E_peak"], axis=1), "N_min_median": np.median(res["N_min"], axis=1),
+        }).sort_values("antigen_tumor", ascending=False)
+        p_path = os.path.join(args.outdir, "M4_CART_sim_patients.tsv")
+        pat.to_csv(p_path, sep="\t", index=False, float_format="%.6g")
+
+        sc = pd.DataFrame({k: v for k, v in scen.items() if k not in FIXED})
+        sc.insert(0, "scenario", np.arange(len(sc)))
+        sc["response_rate"] = resp.mean(axis=0)
+        sc["cr_rate"] = cr.mean(axis=0)
+        sc["tox_rate"] = tox.mean(axis=0)
+        sc["crs_rate"] = crs.mean(axis=0)
+        s_path = os.path.join(args.outdir, "M4_CART_sim_scenarios.tsv")
+        sc.to_csv(s_path, sep="\t", index=False, float_format="%.6g")
+
+    with span("plot"):
+        fig, ax = plt.subplots(1, 2, figsize=(9.6, 4.2))
+        ax[0].scatter(pat["antigen_tumor"], pat["p_response"], s=10, alpha=0.7, label="response")
+        ax[0].scatter(pat["antigen_tumor"], pat["p_tox"], s=10, alpha=0.7, marker="x", label="toxicity")
+        ax[0].set_xscale("symlog", linthresh=0.01)
+        ax[0].set_xlabel("Tumor antigen (x cohort median)"); ax[0].set_ylabel("Probability over scenarios")
+        ax[0].legend(fontsize=8)
+        ax[1].scatter(sc["tox_rate"], sc["response_rate"], s=6, alpha=0.4, linewidths=0)
+        ax[1].set_xlabel("Cohort toxicity rate"); ax[1].set_ylabel("Cohort response rate")
+        ax[1].set_title(f"{len(sc)} scenarios x {len(pat)} patients", fontsize=9)
+        plt.tight_layout()
+        f_path = os.path.join(args.outdir, "M4_CART_sim.png")
+        plt.savefig(f_path, dpi=160)
+        plt.close()
+
+    q = lambda x: " / ".join(f"{v:.3f}" for v in np.percentile(x, [5, 50, 95]))
+    print(f"[OK] CAR-T simulation: {len(pat)} patients x {args.scenarios} scenarios "
+          f"({int((pat['normal_source'] == 'matched').sum())} with matched normal)")
+    print("  response rate  p5/median/p95:", q(sc["response_rate"]))
+    print("  CR rate        p5/median/p95:", q(sc["cr_rate"]))
+    print("  toxicity rate  p5/median/p95:", q(sc["tox_rate"]))
+    print("  CRS rate       p5/median/p95:", q(sc["crs_rate"]))
+    for p in (p_path, s_path, f_path):
+        print(" -", p)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Genome-wide tumor vs normal differential expression (safety / specificity table).
+
+Sample groups come from the TCGA barcode sample-type code (01 = Primary Tumor,
+11 = Solid Tissue Normal by default). For every gene: group means, log2 fold change,
+Welch t, limma-style moderated t (empirical-Bayes variance prior fitted across all
+genes), p-values and Benjamini-Hochberg FDR. Everything is a handful of matrix
+reductions over gene blocks (group sums / sums of squares via indicator products),
+so 60k genes x 450 samples take seconds.
+
+Output M4_DE_tumor_vs_normal.tsv is indexed by the matrix gene ID (Ensembl, version
+stripped) and can be joined directly to tank_out/TANK_ranked.tsv; --tank_ranked adds
+the TANK rank/score columns (from the TSV or, without reparsing it, from the
+TANK_ranked.res results store). The table is also written as the columnar store
+M4_DE_tumor_vs_normal.res (scripts/results_store.py) for gene / top-K / join queries.
+"""
+import os, sys, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "scripts"))
+from stage_trace import span, add_trace_args, setup_trace
+from star_reader import read_star_matrix, is_matrix_cache, read_cache_meta, default_workers
+from tcga_samples import assign_groups
+from multitest import bh_fdr
+from results_store import write_store, store_path, is_store, ResultStore
+
+CHUNK_GENES = 8192
+
+
+def group_moments(X, groups, workers=1, log2p1=False):
+    """
+    X: 基因 x 样本；groups: 长度为样本数的 0/1/-1（1=tumor, 0=normal, -1=不参与）。
+    返回每组 n、均值、方差(ddof=1)、检出率(>0)，均为 (genes, 2)，列顺序 [normal, tumor]。
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    G = np.zeros((X.shape[1], 2))
+    G[groups == 0, 0] = 1.0
+    G[groups == 1, 1] = 1.0
+    n = G.sum(axis=0)
+    sl = [slice(i, min(i + CHUNK_GENES, X.shape[0])) for i in range(0, X.shape[0], CHUNK_GENES)]
+
+    def block(s):
+        x = np.asarray(X[s], dtype=np.float64)
+        if log2p1:
+            x = np.log2(x + 1.0)
+        ok = ~np.isnan(x)
+        x0 = np.where(ok, x, 0.0)
+        cnt = ok.astype(np.float64) @ G
+        s1 = x0 @ G
+        s2 = (x0 * x0) @ G
+        det = (x0 > 0).astype(np.float64) @ G
+        return cnt, s1, s2, det
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        parts = list(ex.map(block, sl))
+    cnt, s1, s2, det = (np.vstack([p[i] for p in parts]) for i in range(4))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / cnt
+        var = np.maximum(s2 - cnt * mean * mean, 0.0) / (cnt - 1)
+    return cnt, mean, var, det / np.maximum(n, 1)
+
+
+def trigamma_inverse(x):
+    """limma::trigammaInverse 的 Newton 迭代"""
+    import numpy as np
+    from scipy.special import polygamma
+    x = np.asarray(x, dtype=float)
+    if x > 1e7:
+        return 1.0 / np.sqrt(x)
+    if x < 1e-6:
+        return 1.0 / x
+    y = 0.5 + 1.0 / x
+    for _ in range(50):
+        tri = polygamma(1, y)
+        dif = tri * (1 - tri / x) / polygamma(2, y)
+        y = y + dif
+        if -dif / y < 1e-8:
+            break
+    return float(y)
+
+
+def fit_f_dist(s2, df):
+    """limma::fitFDist（矩估计）：返回先验 (d0, s0²)；证据不足时 d0=inf"""
+    import numpy as np
+    from scipy.special import digamma, polygamma
+    s2 = np.asarray(s2, dtype=float)
+    ok = np.isfinite(s2) & (s2 > 0)
+    if ok.sum() < 3:
+        return np.inf, float(np.nanmedian(s2)) if np.isfinite(s2).any() else 1.0
+    med = np.median(s2[ok])
+    ok &= s2 > 1e-5 * med
+    z = np.log(s2[ok])
+    e = z - digamma(df / 2.0) + np.log(df / 2.0)
+    emean = e.mean()
+    evar = ((e - emean) ** 2).sum() / (len(e) - 1) - polygamma(1, df / 2.0)
+    if evar > 0:
+        d0 = 2.0 * trigamma_inverse(evar)
+        s0 = np.exp(emean + digamma(d0 / 2.0) - np.log(d0 / 2.0))
+    else:
+        d0, s0 = np.inf, np.exp(emean)
+    return float(d0), float(s0)
+
+
+def de_tests(cnt, mean, var):
+    """Welch t 与 moderated t（pooled 方差 + 经验贝叶斯收缩）"""
+    import numpy as np
+    from scipy import stats
+    n0, n1 = cnt[:, 0], cnt[:, 1]
+    v0, v1 = var[:, 0], var[:, 1]
+    lfc = mean[:, 1] - mean[:, 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        se2 = v1 / n1 + v0 / n0
+        t_w = lfc / np.sqrt(se2)
+        df_w = se2 ** 2 / ((v1 / n1) ** 2 / (n1 - 1) + (v0 / n0) ** 2 / (n0 - 1))
+        p_w = 2 * stats.t.sf(np.abs(t_w), df_w)
+
+        d = n0 + n1 - 2
+        s2 = ((n0 - 1) * v0 + (n1 - 1) * v1) / d
+        d0, s0 = fit_f_dist(s2, float(np.nanmedian(d)))
+        if np.isinf(d0):
+            # 先验无限强：所有基因共用 s0²，t 近似正态
+            t_m = lfc / np.sqrt(s0 * (1.0 / n0 + 1.0 / n1))
+            df_m = np.full_like(t_m, np.inf)
+            p_m = 2 * stats.norm.sf(np.abs(t_m))
+        else:
+            s2_post = (d0 * s0 + d * s2) / (d0 + d)
+            t_m = lfc / np.sqrt(s2_post * (1.0 / n0 + 1.0 / n1))
+            df_m = d + d0
+            p_m = 2 * stats.t.sf(np.abs(t_m), df_m)
+    return {'logFC': lfc, 't_welch': t_w, 'df_welch': df_w, 'p_welch': p_w,
+            't_mod': t_m, 'df_mod': df_m, 'p_mod': p_m}, (d0, s0)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Genome-wide tumor vs normal DE (Welch / moderated t, BH FDR)")
+    ap.add_argument("--expr", required=True, help="TCGA-STAD star_counts tsv.gz (log2(count+1)) or matrix cache dir")
+    ap.add_argument("--outdir", required=True)
+    ap.add_argument("--input_scale", choices=["log2p1", "counts"], default="log2p1",
+                    help="counts: apply log2(x+1) first (linear caches are detected automatically)")
+    ap.add_argument("--tumor_codes", nargs="+", default=["01"], help="barcode sample-type codes for tumor")
+    ap.add_argument("--normal_codes", nargs="+", default=["11"], help="barcode sample-type codes for normal")
+    ap.add_argument("--tank_ranked", default="",
+                    help="optional TANK_ranked.tsv or TANK_ranked.res store to join (adds tank_rank/tank_score)")
+    ap.add_argument("--gene", default="ENSG00000066405", help="gene to highlight in the volcano plot (CLDN18)")
+    ap.add_argument("--fdr", type=float, default=0.05)
+    ap.add_argument("--workers", type=int, default=default_workers())
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+    os.makedirs(args.outdir, exist_ok=True)
+
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import numpy as np
+    import pandas as pd
+
+    with span("load") as sp:
+        expr = sp.shape(read_star_matrix(args.expr, workers=args.workers, mmap=True))
+    # m1_normalize 写出的线性尺度缓存（--linear）同样先取 log2(x+1)
+    meta = read_cache_meta(args.expr) if is_matrix_cache(args.expr) else {}
+    log2p1 = args.input_scale == "counts" or (bool(meta.get("normalization")) and not meta.get("log_scale"))
+
+    groups = assign_groups(expr.columns, set(args.tumor_codes), set(args.normal_codes))
+    n_t, n_n = int((groups == 1).sum()), int((groups == 0).sum())
+    if n_t < 2 or n_n < 2:
+        raise SystemExit(f"Need >=2 tumor and >=2 normal samples from barcodes (got tumor={n_t}, normal={n_n}). "
+                         "请确认列名为标准 TCGA 条形码（如 TCGA-XX-XXXX-01A-...）。")
+
+    with span("moments") as sp:
+        cnt, mean, var, det = group_moments(expr.to_numpy(), groups, workers=args.workers, log2p1=log2p1)
+        sp.shape(expr)
+    with span("tests"):
+        res, (d0, s0) = de_tests(cnt, mean, var)
+        res["fdr_welch"] = bh_fdr(res["p_welch"])
+        res["fdr_mod"] = bh_fdr(res["p_mod"])
+
+    with span("write") as sp:
+        out = pd.DataFrame({"mean_tumor": mean[:, 1], "mean_normal": mean[:, 0], **res,
+                            "detect_tumor": det[:, 1], "detect_normal": det[:, 0]},
+                           index=pd.Index(expr.index, name=expr.index.name or "Ensembl_ID"))
+        if args.tank_ranked and is_store(args.tank_ranked):
+            tk = ResultStore(args.tank_ranked)
+            rows = tk.rows_of(out.index)
+            out["tank_rank"] = np.where(rows >= 0, rows + 1, np.nan)
+            out["tank_score"] = np.where(rows >= 0, tk.column("score")[np.maximum(rows, 0)], np.nan)
+        elif args.tank_ranked:
+            tk = pd.read_csv(args.tank_ranked, sep="\t", index_col=0)
+            tk = tk[~tk.index.duplicated()]
+            out["tank_rank"] = pd.Series(np.arange(1, len(tk) + 1), index=tk.index).reindex(out.index)
+            out["tank_score"] = tk["score"].reindex(out.index)
+        out = sp.shape(out.sort_values(["fdr_mod", "t_mod"], ascending=[True, False]))
+        out_tsv = os.path.join(args.outdir, "M4_DE_tumor_vs_normal.tsv")
+        out.to_csv(out_tsv, sep="\t")
+        out_res = write_store(out, store_path(out_tsv), kind="de", sort_by="fdr_mod asc, t_mod desc")
+
+    with span("plot"):
+        import matplotlib.pyplot as plt
+        y = -np.log10(np.clip(out["p_mod"].to_numpy(), 1e-300, 1))
+        sig = (out["fdr_mod"] < args.fdr).to_numpy()
+        plt.figure(figsize=(4.8, 4.2))
+        plt.scatter(out["logFC"][~sig], y[~sig], s=3, c="0.6", alpha=0.5, linewidths=0)
+        plt.scatter(out["logFC"][sig], y[sig], s=3, c="tab:red", alpha=0.6, linewidths=0)
+        if args.gene in out.index:
+            k = out.index.get_loc(args.gene)
+            k = k if isinstance(k, (int, np.integer)) else np.flatnonzero(k)[0]
+            plt.scatter([out["logFC"].iloc[k]], [y[k]], s=30, c="k", marker="x")
+            plt.annotate(args.gene, (out["logFC"].iloc[k], y[k]), fontsize=7)
+        plt.xlabel("log2FC (tumor - normal)"); plt.ylabel("-log10 p (moderated t)")
+        plt.title(f"Tumor {n_t} vs Normal {n_n}: {int(sig.sum())} genes FDR<{args.fdr}")
+        plt.tight_layout()
+        out_png = os.path.join(args.outdir, "M4_DE_volcano.png")
+        plt.savefig(out_png, dpi=160); plt.close()
+
+    prior = "d0=inf" if np.isinf(d0) else f"d0={d0:.2f}"
+    print(f"[OK] DE done: {out.shape[0]} genes, tumor={n_t} normal={n_n}, prior {prior} s0^2={s0:.4g}, "
+          f"FDR<{args.fdr}: {int(sig.sum())}")
+    if args.gene in out.index:
+        r = out.loc[[args.gene]].iloc[0]
+        print(f"  {args.gene}: logFC={r['logFC']:.3f} t_mod={r['t_mod']:.2f} FDR={r['fdr_mod']:.3g}")
+    print(" -", out_tsv)
+    print(" -", out_res)
+    print(" -", out_png)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os, argparse, pandas as pd, numpy as np, matplotlib.pyplot as plt
-from lifelines import KaplanMeierFitter, CoxPHFitter
-from lifelines.statistics import logrank_test
+import os, sys, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
+from star_reader import read_star_matrix, is_log_scale
 
 def read_table_any(path):
+    import pandas as pd
     return pd.read_csv(path, sep="\t", header=0, index_col=0, compression="infer")
 
 def tcga_barcode15(x): 
@@ -17,27 +20,10 @@ def pick_surv_cols(df):
     vital   = cols.get("vital_status")
     return os_flag, os_time, vital
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--expr", required=True)
-    ap.add_argument("--pheno", required=True)
-    ap.add_argument("--gene", default="ENSG00000066405")  # CLDN18
-    ap.add_argument("--outdir", required=True)
-    args = ap.parse_args()
-    os.makedirs(args.outdir, exist_ok=True)
-
-    # 读取表达矩阵
-    expr = read_table_any(args.expr)
-    expr.index = expr.index.to_series().astype(str).str.replace(r"\.\d+$", "", regex=True)
-    if args.gene not in expr.index:
-        raise SystemExit(f"{args.gene} not in expression matrix")
-    g = expr.loc[args.gene].copy()
-    g.index = [tcga_barcode15(c) for c in g.index]
-    g = np.log1p(g)
-    g = g.groupby(level=0).mean()
-
-    # 读取表型数据
-    ph = read_table_any(args.pheno).copy()
+def load_survival(path):
+    """表型文件 -> 含 barcode15 / event / time（及 sample_type）的表"""
+    import pandas as pd, numpy as np
+    ph = read_table_any(path).copy()
     if "sample" in ph.columns: 
         ph["barcode15"] = ph["sample"].map(tcga_barcode15)
     elif "submitter_id" in ph.columns: 
@@ -62,51 +48,107 @@ def main():
     need_cols = ["barcode15", "event", "time"]
     if "sample_type" in ph.columns:
         need_cols.append("sample_type")
+    return ph[need_cols]
 
-    # 合并
-    df = pd.merge(
-        pd.DataFrame({"expr": g}),
-        ph[need_cols],
-        left_index=True,
-        right_on="barcode15",
-        how="inner"
-    )
-
-    # 缺失值处理 + Primary Tumor 过滤（如有）
+def merge_survival(expr_df, ph):
+    """expr_df 以 barcode15 为索引；合并后去掉缺失生存信息，并只保留 Primary Tumor（如有该列）"""
+    import pandas as pd
+    df = pd.merge(expr_df, ph, left_index=True, right_on="barcode15", how="inner")
     df = df.dropna(subset=["event", "time"])
     if "sample_type" in df.columns:
         df = df[df["sample_type"].str.contains("Primary Tumor", na=False)]
+    return df
 
-    # 分组
-    cut = df["expr"].median()
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--expr", required=True)
+    ap.add_argument("--pheno", required=True)
+    ap.add_argument("--gene", default="ENSG00000066405")  # CLDN18
+    ap.add_argument("--outdir", required=True)
+    ap.add_argument("--cutpoint", choices=["median", "optimal"], default="median",
+                    help="optimal: maximally selected log-rank cut (p corrected per Lausen-Schumacher)")
+    ap.add_argument("--minprop", type=float, default=0.1, help="min fraction of samples per group for --cutpoint optimal")
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+    os.makedirs(args.outdir, exist_ok=True)
+
+    # 重型依赖在参数解析之后再导入（--help 秒开）
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import pandas as pd, numpy as np, matplotlib.pyplot as plt
+    from lifelines import KaplanMeierFitter, CoxPHFitter
+    from lifelines.statistics import logrank_test
+
+    # 读取表达矩阵
+    with span("load") as sp:
+        expr = sp.shape(read_star_matrix(args.expr, dtype="float64"))
+        expr.index = expr.index.to_series().astype(str).str.replace(r"\.\d+$", "", regex=True)
+        if args.gene not in expr.index:
+            raise SystemExit(f"{args.gene} not in expression matrix")
+        g = expr.loc[args.gene].copy()
+        g.index = [tcga_barcode15(c) for c in g.index]
+        if not is_log_scale(args.expr):  # m1_normalize 缓存已是 log / VST 尺度
+            g = np.log1p(g)
+        g = g.groupby(level=0).mean()
+
+        # 读取表型数据
+        ph = load_survival(args.pheno)
+
+    # 合并 + 缺失值处理 + Primary Tumor 过滤（如有）
+    with span("filter") as sp:
+        df = sp.shape(merge_survival(pd.DataFrame({"expr": g}), ph))
+
+    # 分组：中位数，或最大选择 log-rank 统计量的最优切点（Lausen-Schumacher 校正 p）
+    scan = None
+    if args.cutpoint == "optimal":
+        from m4_cutpoint_scan import logrank_scan
+        with span("score", kind="cutpoint_scan"):
+            scan = logrank_scan(df["expr"].to_numpy(), df["time"].to_numpy(), df["event"].to_numpy(),
+                                minprop=args.minprop)
+        if scan is None:
+            raise SystemExit(f"No admissible cutpoint for {args.gene} with minprop={args.minprop}")
+        cut = scan["cutpoint"]
+    else:
+        cut = df["expr"].median()
     df["group"] = np.where(df["expr"] >= cut, "CLDN18-high", "CLDN18-low")
 
     # KM 曲线
-    kmf = KaplanMeierFitter()
-    plt.figure(figsize=(5.5, 4))
-    for label, color in [("CLDN18-high", "tab:red"), ("CLDN18-low", "tab:blue")]:
-        sub = df[df["group"] == label]
-        kmf.fit(sub["time"], sub["event"], label=label)
-        kmf.plot(ci_show=False, color=color)
-    a = df[df["group"] == "CLDN18-high"]
-    b = df[df["group"] == "CLDN18-low"]
-    p = logrank_test(a["time"], b["time"], event_observed_A=a["event"], event_observed_B=b["event"]).p_value
-    plt.title(f"STAD OS by {args.gene} (median split)\nlog-rank p={p:.3g}")
-    plt.xlabel("Days")
-    plt.ylabel("Survival probability")
-    plt.tight_layout()
-    plt.savefig(os.path.join(args.outdir, "M4_KM_STAD_CLDN18.png"), dpi=160)
-    plt.close()
+    with span("score", kind="km_logrank"):
+        kmf = KaplanMeierFitter()
+        plt.figure(figsize=(5.5, 4))
+        for label, color in [("CLDN18-high", "tab:red"), ("CLDN18-low", "tab:blue")]:
+            sub = df[df["group"] == label]
+            kmf.fit(sub["time"], sub["event"], label=label)
+            kmf.plot(ci_show=False, color=color)
+        a = df[df["group"] == "CLDN18-high"]
+        b = df[df["group"] == "CLDN18-low"]
+        p = logrank_test(a["time"], b["time"], event_observed_A=a["event"], event_observed_B=b["event"]).p_value
+        if scan is None:
+            plt.title(f"STAD OS by {args.gene} (median split)\nlog-rank p={p:.3g}")
+        else:
+            plt.title(f"STAD OS by {args.gene} (optimal cut)\nlog-rank p={p:.3g}, adj p={scan['p_lau94']:.3g}")
+        plt.xlabel("Days")
+        plt.ylabel("Survival probability")
+        plt.tight_layout()
+        plt.savefig(os.path.join(args.outdir, "M4_KM_STAD_CLDN18.png"), dpi=160)
+        plt.close()
 
     # Cox 回归
-    cph = CoxPHFitter()
-    cdf = df[["time", "event", "expr"]].copy()
-    cph.fit(cdf, duration_col="time", event_col="event")
-    cph.summary.to_csv(os.path.join(args.outdir, "M4_Cox_summary.tsv"), sep="\t")
+    with span("score", kind="cox"):
+        cph = CoxPHFitter()
+        cdf = df[["time", "event", "expr"]].copy()
+        cph.fit(cdf, duration_col="time", event_col="event")
+        cph.summary.to_csv(os.path.join(args.outdir, "M4_Cox_summary.tsv"), sep="\t")
 
     # Meta 信息
-    with open(os.path.join(args.outdir, "M4_KM_meta.txt"), "w") as f:
-        f.write(f"gene={args.gene}\ncutoff=median={cut:.6g}\nN={len(df)} p_logrank={p:.6g}\n")
+    with span("write"):
+        with open(os.path.join(args.outdir, "M4_KM_meta.txt"), "w") as f:
+            if scan is None:
+                f.write(f"gene={args.gene}\ncutoff=median={cut:.6g}\nN={len(df)} p_logrank={p:.6g}\n")
+            else:
+                f.write(f"gene={args.gene}\ncutoff=optimal={cut:.6g} (minprop={args.minprop}, "
+                        f"{scan['n_cuts']} candidate cuts, n_high={scan['n_high']})\n"
+                        f"N={len(df)} p_logrank={p:.6g} p_lau92={scan['p_lau92']:.6g} p_lau94={scan['p_lau94']:.6g}\n")
 
     print("[OK] KM + Cox done.")
 
@@ -1,35 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os, argparse, re
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
+import os, sys, argparse
 
-def read_table_any(path):
-    return pd.read_csv(path, sep="\t", header=0, index_col=0, compression="infer")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+from stage_trace import span, add_trace_args, setup_trace
+from star_reader import read_star_matrix, is_log_scale
+from tcga_samples import sample_type  # 条形码第四段：01=Primary Tumor, 11=Solid Tissue Normal
 
 def strip_version(x): 
     s = str(x)
     return s.split(".")[0] if "." in s and s.startswith("ENSG") else s
 
-def parse_sample_type_from_tcga_barcode(barcode):
-    """
-    直接从表达矩阵的列名（TCGA 条形码）推断样本类型：
-    第四段的前两位数字：01=Primary Tumor, 11=Solid Tissue Normal
-    例: TCGA-AB-1234-01A-... -> '01' -> Tumor
-        TCGA-AB-1234-11A-... -> '11' -> Normal
-    """
-    b = str(barcode)
-    parts = b.split("-")
-    if len(parts) >= 4:
-        seg = parts[3]  # like '01A' or '11A'
-        code = re.sub(r"[^0-9]", "", seg)[:2]
-        if code == "01":
-            return "Primary Tumor"
-        if code == "11":
-            return "Solid Tissue Normal"
-    return None
-
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--expr", required=True, help="TCGA-STAD star_counts tsv.gz")
@@ -37,40 +18,52 @@ def main():
     ap.add_argument("--outdir", required=True)
     # --pheno 参数保留兼容，但不强制使用
     ap.add_argument("--pheno", default="", help="(optional) phenotype file; not required")
+    add_trace_args(ap)
     args = ap.parse_args()
+    setup_trace(args)
     os.makedirs(args.outdir, exist_ok=True)
 
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import pandas as pd
+    import numpy as np
+    import matplotlib.pyplot as plt
+
     # 读表达矩阵
-    expr = read_table_any(args.expr)
-    # 处理基因 ID
-    expr.index = expr.index.to_series().map(strip_version)
-    if args.gene not in expr.index:
-        raise SystemExit(f"{args.gene} not found in expression matrix.")
-    g = expr.loc[args.gene].copy()
+    with span("load") as sp:
+        expr = sp.shape(read_star_matrix(args.expr, dtype="float64"))
+        # 处理基因 ID
+        expr.index = expr.index.to_series().map(strip_version)
+        if args.gene not in expr.index:
+            raise SystemExit(f"{args.gene} not found in expression matrix.")
+        g = expr.loc[args.gene].copy()
 
     # 直接从列名解析样本类型
-    types = [parse_sample_type_from_tcga_barcode(c) for c in g.index]
-    df = pd.DataFrame({"sample": g.index, "expr": np.log1p(g.values), "sample_type": types})
-    df = df[df["sample_type"].isin(["Primary Tumor", "Solid Tissue Normal"])]
+    with span("filter") as sp:
+        types = [sample_type(c) for c in g.index]
+        vals = g.values if is_log_scale(args.expr) else np.log1p(g.values)  # m1_normalize 缓存已是 log 尺度
+        df = pd.DataFrame({"sample": g.index, "expr": vals, "sample_type": types})
+        df = sp.shape(df[df["sample_type"].isin(["Primary Tumor", "Solid Tissue Normal"])])
 
     if df.empty:
         raise SystemExit("Could not infer any Primary Tumor / Solid Tissue Normal from expression column names. "
                          "请确认表达矩阵列名为标准 TCGA 条形码（如 TCGA-XX-XXXX-01A-...）。")
 
     # 出图
-    plt.figure(figsize=(4.8, 4.2))
-    df.boxplot(column="expr", by="sample_type", grid=False)
-    plt.title(f"{args.gene} expression: Tumor vs Normal (log1p counts)")
-    plt.suptitle("")
-    plt.xlabel("")
-    plt.ylabel("log1p(count)")
-    outp = os.path.join(args.outdir, "M4_Safety_Tumor_vs_Normal.png")
-    plt.tight_layout()
-    plt.savefig(outp, dpi=160)
-    plt.close()
+    with span("plot"):
+        plt.figure(figsize=(4.8, 4.2))
+        df.boxplot(column="expr", by="sample_type", grid=False)
+        plt.title(f"{args.gene} expression: Tumor vs Normal (log1p counts)")
+        plt.suptitle("")
+        plt.xlabel("")
+        plt.ylabel("log1p(count)")
+        outp = os.path.join(args.outdir, "M4_Safety_Tumor_vs_Normal.png")
+        plt.tight_layout()
+        plt.savefig(outp, dpi=160)
+        plt.close()
 
     # 导出数值
-    df[["sample","sample_type","expr"]].to_csv(os.path.join(args.outdir, "M4_Safety_values.tsv"), sep="\t", index=False)
+    with span("write"):
+        df[["sample","sample_type","expr"]].to_csv(os.path.join(args.outdir, "M4_Safety_values.tsv"), sep="\t", index=False)
     print("[OK] Safety plot saved:", outp, " N(Tumor)=", (df.sample_type=="Primary Tumor").sum(), 
           " N(Normal)=", (df.sample_type=="Solid Tissue Normal").sum())
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI-CAR-Loop command line: one entry point for the TANK / M1 / M3 / M4 scripts.
+
+  python aicar.py --help
+  python aicar.py tank --expr data/TCGA-STAD.star_counts.tsv.gz --outdir tank_out
+  python aicar.py m4 km --expr ... --pheno ... --outdir M4_feedback_simulation/out
+  python aicar.py m3 delivery --help
+
+Each subcommand runs the underlying script exactly as `python <script> ...` would.
+Only the standard library is imported here; the scripts import pandas / sklearn /
+lifelines / matplotlib after argument parsing, so --help is fast and every command
+pays only for the libraries it uses. matplotlib defaults to the non-interactive Agg
+backend (override with MPLBACKEND).
+"""
+import os
+import runpy
+import sys
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+
+COMMANDS = {
+    "tank": ("M1_antigen_discovery/tank_rank.py", "TANK variance ranking + target report"),
+    "pancan": ("M1_antigen_discovery/tank_pancan.py", "TANK across many cohorts -> gene x cohort rank / score tables"),
+    "serve": ("scripts/serve.py", "resident localhost HTTP service (rank / summary / survival / immune queries)"),
+    "query": ("scripts/results_store.py", "query a .res results store (gene rank, filtered top-K, join with M4 tables)"),
+    "m1": {
+        "ingest": ("scripts/star_reader.py", "parallel STAR matrix reader -> binary matrix cache"),
+        "tx2gene": ("scripts/tx2gene.py", "transcript -> gene aggregation (sparse map), keeps isoform rows (CLDN18.2)"),
+        "normalize": ("scripts/m1_normalize.py", "size factors / CPM / TPM / VST -> binary matrix cache"),
+        "qc": ("scripts/m1_sample_qc.py", "streaming randomized PCA sample QC -> outlier scores + keep list"),
+        "combat": ("scripts/m1_combat.py", "ComBat empirical-Bayes batch correction (TCGA plates / cohorts) -> matrix cache"),
+        "preprocess": ("scripts/m1_preprocess.py", "normalize expression.tsv + clinical.tsv"),
+        "run": ("scripts/m1_run_full.py", "TSI / 5-fold AUC for the target gene"),
+        "perm": ("scripts/m1_permutation.py", "permutation p-values / FDR for TSI and AUC, all genes"),
+        "coexpr": ("scripts/m1_coexpr.py", "blockwise co-expression: target vs all, top-K matrix, neighbor index"),
+        "gates": ("M1_antigen_discovery/tank_gates.py", "AND / OR / AND-NOT antigen pairs over TANK top-K (bitsets)"),
+        "scrna": ("scripts/m1_scrna.py", "single-cell target expression per cell type (sparse)"),
+        "spatial": ("scripts/m1_spatial.py", "spatial Moran's I + tumor/normal region specificity"),
+    },
+    "m3": {
+        "pdb2orf": ("M3_mRNA_design/pdb2orf.py", "PDB -> protein FASTA + back-translated ORF"),
+        "optimize": ("M3_mRNA_design/m3_optimize_mrna.py", "assemble UTR+ORF mRNA, GC/repeat/MFE checks"),
+        "translate": ("M3_mRNA_design/m3_translation_sim.py", "ribosome flow model: translation rate + collision hotspots, many constructs"),
+        "delivery": ("M3_mRNA_design/m3_delivery_sim.py", "delivery platform simulation"),
+        "offtarget": ("M3_mRNA_design/m3_offtarget_scan.py", "epitope / CDR off-target scan vs a proteome (k-mer + spaced-seed index, BLOSUM62)"),
+    },
+    "m4": {
+        "de": ("M4_feedback_simulation/scripts/m4_de_genome.py", "genome-wide tumor vs normal DE (Welch / moderated t, FDR)"),
+        "km": ("M4_feedback_simulation/scripts/m4_km_stad.py", "KM + Cox survival by gene expression"),
+        "cutscan": ("M4_feedback_simulation/scripts/m4_cutpoint_scan.py", "optimal log-rank cutpoint scan over many genes"),
+        "immune": ("M4_feedback_simulation/scripts/m4_immune_proxy.py", "CD8/GZMB/PRF1 immune proxy correlation"),
+        "safety": ("M4_feedback_simulation/scripts/m4_safety_boxplot.py", "tumor vs normal expression (safety)"),
+        "cartsim": ("M4_feedback_simulation/scripts/m4_cart_sim.py", "CAR-T / tumor / normal-tissue dynamics, patients x parameter scenarios"),
+    },
+}
+
+
+def usage(prefix="", table=None):
+    table = table or COMMANDS
+    lines = [f"usage: aicar.py {prefix}<command> [args...]", "", "commands:"]
+    for name, entry in table.items():
+        if isinstance(entry, dict):
+            lines.append(f"  {prefix}{name} <{'|'.join(entry)}>")
+            for sub, (_, helptext) in entry.items():
+                lines.append(f"      {sub:<11} {helptext}")
+        else:
+            lines.append(f"  {prefix}{name:<13} {entry[1]}")
+    lines += ["", "Run `aicar.py <command> --help` for the options of a command."]
+    return "\n".join(lines)
+
+
+def resolve(argv):
+    """Walk argv through COMMANDS; returns (script_path, remaining_args) or exits with usage."""
+    table, prefix = COMMANDS, ""
+    while True:
+        if not argv or argv[0] in ("-h", "--help"):
+            print(usage(prefix, table))
+            sys.exit(0 if argv else 2)
+        name, argv = argv[0], argv[1:]
+        entry = table.get(name)
+        if entry is None:
+            sys.stderr.write(f"aicar.py: unknown command '{prefix}{name}'\n\n{usage(prefix, table)}\n")
+            sys.exit(2)
+        if isinstance(entry, dict):
+            table, prefix = entry, prefix + name + " "
+            continue
+        return os.path.join(BASE, entry[0]), argv
+
+
+def main(argv=None):
+    script, rest = resolve(list(sys.argv[1:] if argv is None else argv))
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    sys.argv = [script] + rest
+    sys.path.insert(0, os.path.dirname(script))
+    runpy.run_path(script, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
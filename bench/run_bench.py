@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the pipeline hot paths on synthetic inputs (see synth_data.py).
+
+Every job runs in a fresh child process so that wall time, CPU time and peak RSS are
+measured per job (including imports). Results go to a JSON file tagged with the git
+commit, so runs can be compared across commits with --compare.
+
+  python bench/run_bench.py --scale small
+  python bench/run_bench.py --scale stad --jobs tank m4_km --repeat 3
+  python bench/run_bench.py --data /tmp/synth --compare bench/results/old.json
+"""
+import argparse, json, os, platform, runpy, subprocess, sys, time
+from datetime import datetime
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(HERE, 'results')
+
+SCRIPTS = {
+    "tank": os.path.join(BASE, "M1_antigen_discovery", "tank_rank.py"),
+    "tank_gates": os.path.join(BASE, "M1_antigen_discovery", "tank_gates.py"),
+    "m1_perm": os.path.join(BASE, "scripts", "m1_permutation.py"),
+    "m1_coexpr": os.path.join(BASE, "scripts", "m1_coexpr.py"),
+    "m4_km": os.path.join(BASE, "M4_feedback_simulation", "scripts", "m4_km_stad.py"),
+    "m4_cutscan": os.path.join(BASE, "M4_feedback_simulation", "scripts", "m4_cutpoint_scan.py"),
+    "m4_immune": os.path.join(BASE, "M4_feedback_simulation", "scripts", "m4_immune_proxy.py"),
+    "m4_safety": os.path.join(BASE, "M4_feedback_simulation", "scripts", "m4_safety_boxplot.py"),
+    "m4_de": os.path.join(BASE, "M4_feedback_simulation", "scripts", "m4_de_genome.py"),
+    "pdb2orf": os.path.join(BASE, "M3_mRNA_design", "pdb2orf.py"),
+    "m3_optimize": os.path.join(BASE, "M3_mRNA_design", "m3_optimize_mrna.py"),
+    "m3_delivery": os.path.join(BASE, "M3_mRNA_design", "m3_delivery_sim.py"),
+}
+JOB_ORDER = ["tank", "tank_gates", "m1_auc", "m1_perm", "m1_coexpr", "m4_km", "m4_cutscan", "m4_immune", "m4_safety", "m4_de", "pdb2orf", "m3_optimize", "m3_delivery"]
+
+
+def script_argv(name, paths, work, opts):
+    out = os.path.join(work, name)
+    if name == "tank":
+        return ["--expr", paths["expr"], "--outdir", out]
+    if name == "tank_gates":
+        return ["--expr", paths["expr"], "--tank_ranked", os.path.join(work, "tank", "TANK_ranked.tsv"),
+                "--outdir", out, "--triples"]
+    if name == "m1_perm":
+        return ["--expr", paths["expr"], "--permutations", str(opts.get("perm_n", 1000)),
+                "--out", os.path.join(out, "M1_permutation_pvalues.tsv")]
+    if name == "m1_coexpr":
+        return ["--expr", paths["expr"], "--targets", "ENSG00000066405", "--index",
+                "--index_path", os.path.join(out, "M1_coexpr_spearman.npz"), "--outdir", out]
+    if name in ("m4_km", "m4_cutscan"):
+        return ["--expr", paths["expr"], "--pheno", paths["pheno"], "--outdir", out]
+    if name in ("m4_immune", "m4_safety", "m4_de"):
+        return ["--expr", paths["expr"], "--outdir", out]
+    if name == "pdb2orf":
+        return ["--pdb", paths["pdb"], "--out_protein", os.path.join(out, "scfv_AA.fasta"),
+                "--out_orf", os.path.join(out, "scfv_ORF.fasta")]
+    if name == "m3_optimize":
+        return ["--orf", os.path.join(work, "pdb2orf", "scfv_ORF.fasta"), "--out", os.path.join(out, "mrna.fasta")]
+    if name == "m3_delivery":
+        return ["--iters", str(opts.get("delivery_iters", 10000)), "--outdir", out,
+                "--priors", "LNP:0.65,0.05 TMAB3:0.70,0.06 RNACap:0.60,0.07",
+                "--selectivity", "LNP:1.0 TMAB3:1.15 RNACap:1.05",
+                "--stability", "LNP:1.0 TMAB3:1.10 RNACap:0.95"]
+    raise KeyError(name)
+
+
+def run_m1_auc(paths, opts):
+    """m1_run_full 的 TSI + 5-fold AUC，对前 N 个基因循环（原脚本只算一个基因）"""
+    sys.path.insert(0, os.path.join(BASE, "scripts"))
+    import pandas as pd
+    import m1_run_full as m1
+    X = pd.read_csv(os.path.join(paths["processed"], "M1_expr_log2.tsv"), sep="\t", index_col=0)
+    meta = pd.read_csv(os.path.join(paths["processed"], "M1_clinical.tsv"), sep="\t")
+    X = X[meta["SampleID"].tolist()]
+    y = (meta["Group"].astype(str).str.lower() == "tumor").astype(int).values
+    genes = list(X.index[:opts.get("m1_genes", 200)])
+    for g in genes:
+        m1.compute_tsi(X, meta, g)
+        m1.kfold_auc(X, y, g, k=5)
+    return {"genes": len(genes)}
+
+
+def peak_rss_mb():
+    try:
+        import resource
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r / (1024.0 * 1024.0) if sys.platform == "darwin" else r / 1024.0
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / (1024.0 * 1024.0)
+        except Exception:
+            return None
+
+
+def child(name, data_dir, work, opts):
+    """在子进程内执行单个 job，并把测量结果作为最后一行 JSON 打印"""
+    with open(os.path.join(data_dir, "synth_meta.json")) as f:
+        paths = json.load(f)["paths"]
+    os.makedirs(os.path.join(work, name), exist_ok=True)
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    rec = {"name": name, "status": "ok", "extra": {}}
+    t0, c0 = time.perf_counter(), time.process_time()
+    try:
+        if name == "m1_auc":
+            rec["extra"] = run_m1_auc(paths, opts)
+        else:
+            sys.argv = [SCRIPTS[name]] + script_argv(name, paths, work, opts)
+            sys.path.insert(0, os.path.dirname(SCRIPTS[name]))
+            runpy.run_path(SCRIPTS[name], run_name="__main__")
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            rec["status"] = "error"
+            rec["error"] = f"SystemExit({e.code})"
+    except Exception as e:
+        rec["status"] = "error"
+        rec["error"] = f"{type(e).__name__}: {e}"
+    rec["wall_s"] = time.perf_counter() - t0
+    rec["cpu_s"] = time.process_time() - c0
+    rec["peak_rss_mb"] = peak_rss_mb()
+    sys.stdout.flush()
+    print("\n@@BENCH@@" + json.dumps(rec))
+
+
+def run_job(name, data_dir, work, opts, repeat):
+    best = None
+    for _ in range(repeat):
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--data", data_dir, "--work", work,
+               "--opts", json.dumps(opts)]
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=BASE)
+        line = [l for l in proc.stdout.splitlines() if l.startswith("@@BENCH@@")]
+        if not line:
+            rec = {"name": name, "status": "error", "error": (proc.stderr or proc.stdout)[-500:]}
+        else:
+            rec = json.loads(line[-1][len("@@BENCH@@"):])
+        if rec["status"] != "ok":
+            return rec
+        if best is None or rec["wall_s"] < best["wall_s"]:
+            best = rec
+    best["repeat"] = repeat
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(cur, prev_path):
+    with open(prev_path) as f:
+        prev = {r["name"]: r for r in json.load(f)["results"]}
+    print(f"\n[compare] vs {prev_path}")
+    print(f"{'job':<14}{'wall_prev':>11}{'wall_now':>11}{'ratio':>8}{'rss_prev':>10}{'rss_now':>10}")
+    for r in cur["results"]:
+        p = prev.get(r["name"])
+        if not p or r["status"] != "ok" or p.get("status") != "ok":
+            print(f"{r['name']:<14}{'-':>11}{r.get('wall_s', float('nan')):>11.3f}")
+            continue
+        print(f"{r['name']:<14}{p['wall_s']:>11.3f}{r['wall_s']:>11.3f}{r['wall_s'] / p['wall_s']:>8.2f}"
+              f"{(p.get('peak_rss_mb') or 0):>10.0f}{(r.get('peak_rss_mb') or 0):>10.0f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Time + peak-memory benchmarks on synthetic TCGA-like data")
+    ap.add_argument("--data", help="dir from synth_data.py (generated on the fly if missing)")
+    ap.add_argument("--scale", default="small", help="synth scale when generating (small|stad|large|xl)")
+    ap.add_argument("--genes", type=int)
+    ap.add_argument("--samples", type=int)
+    ap.add_argument("--jobs", nargs="+", choices=JOB_ORDER, default=JOB_ORDER)
+    ap.add_argument("--repeat", type=int, default=1, help="runs per job; best wall time is kept")
+    ap.add_argument("--m1_genes", type=int, default=200, help="genes looped through m1 TSI/AUC")
+    ap.add_argument("--delivery_iters", type=int, default=10000)
+    ap.add_argument("--perm_n", type=int, default=1000, help="label permutations for the m1_perm job")
+    ap.add_argument("--work", help="scratch dir for job outputs (default: <data>/work)")
+    ap.add_argument("--out", help="results JSON (default: bench/results/<commit>_<scale>.json)")
+    ap.add_argument("--compare", help="previous results JSON to compare against")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    ap.add_argument("--opts", default="{}", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        child(args.child, args.data, args.work, json.loads(args.opts))
+        return
+
+    import synth_data
+    data = args.data or os.path.join(HERE, "data", args.scale)
+    if not os.path.exists(os.path.join(data, "synth_meta.json")):
+        g, s = synth_data.SCALES[args.scale]
+        print(f"[bench] generating synthetic data in {data} ...")
+        synth_data.generate(data, args.genes or g, args.samples or s)
+    with open(os.path.join(data, "synth_meta.json")) as f:
+        meta = json.load(f)
+    work = args.work or os.path.join(data, "work")
+    opts = {"m1_genes": args.m1_genes, "delivery_iters": args.delivery_iters, "perm_n": args.perm_n}
+
+    jobs = [j for j in JOB_ORDER if j in args.jobs]
+    if "m3_optimize" in jobs and "pdb2orf" not in jobs and \
+            not os.path.exists(os.path.join(work, "pdb2orf", "scfv_ORF.fasta")):
+        jobs.insert(jobs.index("m3_optimize"), "pdb2orf")
+
+    results = []
+    for name in jobs:
+        rec = run_job(name, data, work, opts, args.repeat)
+        results.append(rec)
+        if rec["status"] == "ok":
+            rss = rec.get("peak_rss_mb")
+            print(f"[bench] {name:<12} wall={rec['wall_s']:8.3f}s cpu={rec['cpu_s']:8.3f}s "
+                  f"peak_rss={rss if rss is None else round(rss)}MB")
+        else:
+            print(f"[bench] {name:<12} ERROR: {rec.get('error', '').strip().splitlines()[-1:]}")
+
+    commit = git_commit()
+    doc = {"commit": commit, "timestamp": datetime.now().isoformat(timespec="seconds"),
+           "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+           "data": {k: meta[k] for k in ("genes", "samples", "normal_frac", "seed")}, "results": results}
+    out = args.out or os.path.join(RESULTS_DIR, f"{commit}_{meta['genes']}x{meta['samples']}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(doc, f, indent=2)
+    print("[OK] Wrote", out)
+    if args.compare:
+        compare(doc, args.compare)
+
+
+if __name__ == "__main__":
+    main()
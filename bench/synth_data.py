@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic TCGA-like inputs for benchmarking (no real TCGA download needed).
+
+Writes into --outdir:
+  synth.star_counts.tsv.gz     genes x samples, log2(count+1), Ensembl IDs with version,
+                               full TCGA barcodes (01A tumor / 11A normal, several plates)
+  synth_survival.txt           Xena curated-survival layout (sample, _PATIENT, OS, OS.time, ...)
+  synth_processed/             M1_expr_log2.tsv (symbol x samples) + M1_clinical.tsv (SampleID/Group)
+  synth_scfv.pdb               multi-chain PDB (N/CA/C atoms) for pdb2orf
+"""
+import argparse, gzip, json, os
+import numpy as np
+import pandas as pd
+
+SCALES = {
+    "small": (2000, 60),
+    "stad":  (60660, 450),
+    "large": (60660, 2000),
+    "xl":    (60660, 10000),
+}
+
+# 固定放在最前面，保证 tank / M4 脚本的默认基因都存在
+FIXED_GENES = [
+    ("ENSG00000066405", "CLDN18"), ("ENSG00000141736", "ERBB2"), ("ENSG00000120217", "CD274"),
+    ("ENSG00000153563", "CD8A"), ("ENSG00000172116", "CD8B"), ("ENSG00000100479", "GZMB"),
+    ("ENSG00000180644", "PRF1"),
+]
+AA3 = ["ALA","ARG","ASN","ASP","CYS","GLN","GLU","GLY","HIS","ILE","LEU","LYS","MET","PHE","PRO",
+       "SER","THR","TRP","TYR","VAL"]
+PLATES = ["A29S", "A36D", "A39E", "A414", "A466", "A52X"]
+
+
+def make_genes(n_genes):
+    ids = [g for g, _ in FIXED_GENES]
+    syms = [s for _, s in FIXED_GENES]
+    for i in range(len(ids), n_genes):
+        ids.append(f"ENSG9{i:010d}")
+        syms.append(f"SYN{i}")
+    ver = [f"{g}.{1 + (i % 17)}" for i, g in enumerate(ids)]
+    return ver, syms
+
+
+def make_samples(n_samples, normal_frac, rng):
+    n_norm = max(1, int(round(n_samples * normal_frac)))
+    out, types = [], []
+    for j in range(n_samples):
+        code = "11A" if j < n_norm else "01A"
+        plate = PLATES[j % len(PLATES)]
+        out.append(f"TCGA-S{j // 1000:01d}-{j % 10000:04d}-{code}-11R-{plate}-31")
+        types.append("normal" if code == "11A" else "tumor")
+    order = rng.permutation(n_samples)
+    return [out[i] for i in order], [types[i] for i in order]
+
+
+def write_star_matrix(path, gene_ids, samples, types, rng, chunk_genes=2000, zero_frac=0.2):
+    """按基因块生成 log2(count+1) 矩阵并流式写入 gzip，避免大规模时整块占内存"""
+    tumor = np.array([t == "tumor" for t in types])
+    batch = np.array([PLATES.index(s.split("-")[5]) for s in samples])
+    batch_shift = rng.normal(0, 0.15, len(PLATES))[batch]
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as f:
+        f.write("Ensembl_ID\t" + "\t".join(samples) + "\n")
+        for start in range(0, len(gene_ids), chunk_genes):
+            ids = gene_ids[start:start + chunk_genes]
+            g = len(ids)
+            mu = rng.gamma(2.0, 2.5, size=(g, 1))
+            sd = rng.uniform(0.3, 2.0, size=(g, 1))
+            de = rng.normal(0, 0.5, size=(g, 1)) * (rng.random((g, 1)) < 0.1)
+            x = mu + sd * rng.standard_normal((g, len(samples))) + de * tumor + batch_shift
+            if start == 0:
+                x[0] += 3.0 * tumor  # CLDN18: 肿瘤高表达
+            x[rng.random(x.shape) < zero_frac] = 0.0
+            x = np.maximum(x, 0.0)
+            block = pd.DataFrame(x, index=ids)
+            block.to_csv(f, sep="\t", header=False, float_format="%.4f")
+
+
+def write_survival(path, samples, rng):
+    rows = []
+    for s in samples:
+        b15 = s[:15]
+        if s.split("-")[3].startswith("11"):
+            continue
+        ev = int(rng.random() < 0.4)
+        rows.append({"sample": b15, "_PATIENT": s[:12], "OS": ev, "OS.time": int(rng.exponential(900)) + 1,
+                     "DSS": ev, "DSS.time": "", "DFI": "", "DFI.time": "", "PFI": ev, "PFI.time": "",
+                     "Redaction": ""})
+    pd.DataFrame(rows).to_csv(path, sep="\t", index=False)
+
+
+def write_processed(outdir, star_path, symbols, samples, types, max_genes=5000):
+    """m1_run_full 所需的预处理格式（symbol x 样本 + SampleID/Group 临床表）"""
+    os.makedirs(outdir, exist_ok=True)
+    X = pd.read_csv(star_path, sep="\t", index_col=0, nrows=max_genes)
+    X.index = symbols[:len(X)]
+    X.index.name = "gene"
+    X.to_csv(os.path.join(outdir, "M1_expr_log2.tsv"), sep="\t")
+    pd.DataFrame({"SampleID": samples, "Group": ["Tumor" if t == "tumor" else "Normal" for t in types]}) \
+        .to_csv(os.path.join(outdir, "M1_clinical.tsv"), sep="\t", index=False)
+
+
+def write_pdb(path, chain_lengths, rng):
+    serial = 1
+    with open(path, "w", encoding="utf-8") as f:
+        for ch, n in zip("HLABCDEFG", chain_lengths):
+            xyz = np.cumsum(rng.normal(0, 1.5, size=(n * 3, 3)), axis=0)
+            for r in range(n):
+                resn = AA3[rng.integers(len(AA3))]
+                for k, atom in enumerate(("N", "CA", "C")):
+                    x, y, z = xyz[3 * r + k]
+                    f.write(f"ATOM  {serial:5d}  {atom:<3s} {resn} {ch}{r + 1:4d}    "
+                            f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           {atom[0]}\n")
+                    serial += 1
+            f.write("TER\n")
+        f.write("END\n")
+
+
+def generate(outdir, n_genes, n_samples, normal_frac=0.07, pdb_residues=250, seed=42):
+    rng = np.random.default_rng(seed)
+    os.makedirs(outdir, exist_ok=True)
+    gene_ids, symbols = make_genes(n_genes)
+    samples, types = make_samples(n_samples, normal_frac, rng)
+    paths = {
+        "expr": os.path.join(outdir, "synth.star_counts.tsv.gz"),
+        "pheno": os.path.join(outdir, "synth_survival.txt"),
+        "processed": os.path.join(outdir, "synth_processed"),
+        "pdb": os.path.join(outdir, "synth_scfv.pdb"),
+    }
+    write_star_matrix(paths["expr"], gene_ids, samples, types, rng)
+    write_survival(paths["pheno"], samples, rng)
+    write_processed(paths["processed"], paths["expr"], symbols, samples, types)
+    write_pdb(paths["pdb"], [pdb_residues // 2, pdb_residues - pdb_residues // 2], rng)
+    meta = {"genes": n_genes, "samples": n_samples, "normal_frac": normal_frac, "seed": seed,
+            "pdb_residues": pdb_residues, "paths": paths}
+    with open(os.path.join(outdir, "synth_meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate synthetic TCGA-like benchmark inputs")
+    ap.add_argument("--scale", choices=sorted(SCALES), default="small")
+    ap.add_argument("--genes", type=int, help="override gene count of --scale")
+    ap.add_argument("--samples", type=int, help="override sample count of --scale")
+    ap.add_argument("--normal_frac", type=float, default=0.07, help="fraction of 11A normal samples")
+    ap.add_argument("--pdb_residues", type=int, default=250)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--outdir", required=True)
+    args = ap.parse_args()
+    g, s = SCALES[args.scale]
+    meta = generate(args.outdir, args.genes or g, args.samples or s, args.normal_frac, args.pdb_residues, args.seed)
+    print(f"[OK] Synthetic inputs ({meta['genes']} genes x {meta['samples']} samples) in {args.outdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+# scripts/m1_coexpr.py
+# 全基因组共表达引擎（以候选靶点为锚）。
+# 矩阵只做一次变换：每个基因行（Spearman 先取秩）中心化并缩放到单位范数，得到 Z，
+# 于是任意两组基因的相关系数就是 Z[a] @ Z[b].T —— 一次 BLAS 矩阵乘法，按基因块分块，内存有界。
+#   --targets           靶点 x 全部基因                -> resultstables/M1_coexpr_targets.tsv
+#   --tank_ranked/topk  TANK 前 K 个基因 x 前 K 个基因  -> resultstables/M1_coexpr_topK.tsv
+#   --index             每个基因的前 N 个近邻（按 |r|）-> dataprocessed/M1_coexpr_<method>.npz
+#   --query GENE        读取近邻索引，即时查询（无需再读矩阵）
+# 缺失值以行均值填充（中心化后为 0），零方差基因的相关记为 NaN。
+#
+#   python scripts/m1_coexpr.py --expr data/TCGA-STAD.star_counts.tsv.gz --targets ENSG00000066405 --index
+#   python scripts/m1_coexpr.py --query ENSG00000066405 --neighbors 20
+import os, sys, argparse
+
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+proc_dir = os.path.join(BASE, 'dataprocessed')
+tab_dir = os.path.join(BASE, 'resultstables')
+
+CHUNK_GENES = 4096
+TILE_BYTES = 256 << 20
+DEFAULT_NEIGHBORS = 50
+
+
+def index_path(method):
+    return os.path.join(proc_dir, f'M1_coexpr_{method}.npz')
+
+
+def standardize(X, method='spearman', workers=1, dtype='float32'):
+    """
+    X: 基因 x 样本。返回 (Z, valid)：Z 每行均值 0、范数 1（Spearman 为秩），
+    valid 标记非零方差的基因。按基因块并行。
+    """
+    import numpy as np
+    from scipy.stats import rankdata
+    from concurrent.futures import ThreadPoolExecutor
+    Z = np.empty(X.shape, dtype=dtype)
+    valid = np.zeros(X.shape[0], dtype=bool)
+
+    def block(s):
+        x = np.asarray(X[s], dtype=np.float64)
+        if method == 'spearman':
+            x = rankdata(x, axis=1, nan_policy='omit')
+        with np.errstate(invalid='ignore'):
+            mu = np.nanmean(x, axis=1, keepdims=True) if np.isnan(x).any() else x.mean(axis=1, keepdims=True)
+        x = np.where(np.isnan(x), mu, x) - mu
+        x = np.nan_to_num(x)
+        nrm = np.sqrt((x * x).sum(axis=1, keepdims=True))
+        Z[s] = np.divide(x, nrm, out=np.zeros_like(x), where=nrm > 0)
+        valid[s] = nrm[:, 0] > 0
+
+    chunks = [slice(i, min(i + CHUNK_GENES, X.shape[0])) for i in range(0, X.shape[0], CHUNK_GENES)]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(block, chunks))
+    return Z, valid
+
+
+def correlate(Z, valid, rows, cols=None):
+    """rows x cols 的相关矩阵（cols 默认全部基因），按列分块做矩阵乘法"""
+    import numpy as np
+    rows = np.asarray(rows)
+    cols = np.arange(Z.shape[0]) if cols is None else np.asarray(cols)
+    A = Z[rows]
+    b = max(1, int(TILE_BYTES // max(1, len(rows) * 8)))
+    out = np.empty((len(rows), len(cols)), dtype=np.float64)
+    for s in range(0, len(cols), b):
+        c = cols[s:s + b]
+        out[:, s:s + b] = A @ Z[c].T
+    np.clip(out, -1.0, 1.0, out=out)
+    out[~valid[rows]] = np.nan
+    out[:, ~valid[cols]] = np.nan
+    return out
+
+
+def neighbor_index(Z, valid, n_neighbors=DEFAULT_NEIGHBORS, workers=1):
+    """
+    每个基因按 |r| 取前 N 个近邻（不含自身）。行块 x 全部基因一次乘法，|C| 就地取绝对值后 argpartition，
+    每块只有 C 与 argpartition 的 int64 下标两个 rows x G 缓冲，块大小按 TILE_BYTES / workers 定（总量有界）；
+    近邻的带符号 r 再由 Z 行点积补回。
+    返回 (nbr: genes x N int32, r: genes x N float32)；零方差基因整行为 -1 / NaN。
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    G = Z.shape[0]
+    n = min(n_neighbors, max(1, int(valid.sum()) - 1))
+    nbr = np.full((G, n), -1, dtype=np.int32)
+    rr = np.full((G, n), np.nan, dtype=np.float32)
+    b = max(1, int(TILE_BYTES // max(1, workers * G * (Z.itemsize + 8))))
+
+    def block(s):
+        rows = np.arange(s.start, s.stop)
+        A = Z[rows] @ Z.T
+        np.abs(A, out=A)
+        A[:, ~valid] = -1.0
+        A[np.arange(len(rows)), rows] = -1.0
+        part = np.argpartition(A, G - n, axis=1)[:, G - n:]
+        order = np.argsort(-np.take_along_axis(A, part, axis=1), axis=1, kind='stable')
+        del A
+        idx = np.take_along_axis(part, order, axis=1)
+        del part
+        ok = valid[rows]
+        r = np.einsum('ij,ikj->ik', Z[rows[ok]], Z[idx[ok]])
+        nbr[rows[ok]] = idx[ok]
+        rr[rows[ok]] = np.clip(r, -1.0, 1.0)
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(block, [slice(i, min(i + b, G)) for i in range(0, G, b)]))
+    return nbr, rr
+
+
+def save_index(path, genes, nbr, r, method, n_samples):
+    import numpy as np
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez(path, genes=np.asarray(genes, dtype=str), nbr=nbr, r=r,
+             method=np.asarray(method), n_samples=np.asarray(n_samples))
+
+
+def load_index(path):
+    import numpy as np
+    with np.load(path, allow_pickle=False) as z:
+        return {k: z[k] for k in z.files}
+
+
+def query_index(index, gene, n=None):
+    """近邻表（neighbor / r / rank），gene 不在索引中返回 None"""
+    import numpy as np
+    import pandas as pd
+    genes = index['genes']
+    hit = np.flatnonzero(genes == gene)
+    if not len(hit):
+        return None
+    i = int(hit[0])
+    nb, r = index['nbr'][i], index['r'][i]
+    keep = nb >= 0
+    nb, r = nb[keep][:n], r[keep][:n]
+    return pd.DataFrame({'neighbor': genes[nb], 'r': r.astype(float), 'rank': np.arange(1, len(nb) + 1)})
+
+
+def load_matrix(args):
+    """STAR 矩阵 / 缓存（版本号去除）；可只留肿瘤样本、过滤低检出基因"""
+    import numpy as np
+    from star_reader import read_star_matrix, is_matrix_cache, read_cache_meta
+    X = read_star_matrix(args.expr, workers=args.workers, mmap=True)
+    X = X[~X.index.duplicated()]
+    if args.tumor_only:
+        from tcga_samples import sample_group
+        X = X.loc[:, [sample_group(c) == 'tumor' for c in X.columns]]
+        if X.shape[1] < 3:
+            raise SystemExit('--tumor_only: 条形码中可识别的肿瘤样本不足 3 个。')
+    genes = X.index
+    M = X.to_numpy(dtype=np.float64)
+    # m1_normalize 的线性尺度缓存：Pearson 在 log2(x+1) 上计算（Spearman 不受影响）
+    meta = read_cache_meta(args.expr) if is_matrix_cache(args.expr) else {}
+    if args.method == 'pearson' and meta.get('normalization') and not meta.get('log_scale'):
+        M = np.log2(M + 1.0)
+    if args.min_detect_prop > 0:
+        keep = (M > 0).mean(axis=1) >= args.min_detect_prop
+        M, genes = M[keep], genes[keep]
+    return M, np.asarray(genes)
+
+
+def read_genes(genes, path):
+    out = list(genes or [])
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            out += [s.strip() for s in f if s.strip()]
+    return list(dict.fromkeys(g.split('.')[0] if g.startswith('ENSG') else g for g in out))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Blockwise co-expression: target vs all, top-K x top-K, top-N neighbor index')
+    ap.add_argument('--expr', help='STAR matrix (log2(count+1)) or matrix cache dir')
+    ap.add_argument('--method', choices=['spearman', 'pearson'], default='spearman')
+    ap.add_argument('--targets', nargs='+', help='anchor genes: correlation with every gene')
+    ap.add_argument('--targets_file', help='file with anchor genes (one per line)')
+    ap.add_argument('--tank_ranked', help='TANK_ranked.tsv: correlation matrix of its top --topk genes')
+    ap.add_argument('--topk', type=int, default=500)
+    ap.add_argument('--index', action='store_true', help='build the top-N neighbor index for every gene')
+    ap.add_argument('--neighbors', type=int, default=DEFAULT_NEIGHBORS)
+    ap.add_argument('--index_path', help='neighbor index .npz (default: dataprocessed/M1_coexpr_<method>.npz)')
+    ap.add_argument('--query', nargs='+', help='look genes up in an existing index (no matrix needed)')
+    ap.add_argument('--tumor_only', action='store_true', help='only tumor samples (TCGA barcodes 01-09)')
+    ap.add_argument('--min_detect_prop', type=float, default=0.1, help='drop genes expressed (>0) in fewer samples')
+    ap.add_argument('--workers', type=int, default=max(1, min(8, os.cpu_count() or 1)))
+    ap.add_argument('--outdir', default=tab_dir)
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+    ipath = args.index_path or index_path(args.method)
+
+    if args.query and not args.expr:
+        with span('query'):
+            index = load_index(ipath)
+            for g in args.query:
+                tab = query_index(index, g.split('.')[0], args.neighbors)
+                if tab is None:
+                    print(f'[WARN] {g} 不在索引中: {ipath}')
+                    continue
+                print(f'[OK] {g} 共表达近邻（{index["method"]}, N={int(index["n_samples"])}）')
+                print(tab.to_string(index=False))
+        return
+
+    targets = read_genes(args.targets, args.targets_file)
+    if not args.expr or not (targets or args.tank_ranked or args.index):
+        ap.error('需要 --expr 以及 --targets / --tank_ranked / --index 之一（或仅用 --query 查询已有索引）')
+
+    import numpy as np
+    import pandas as pd
+    os.makedirs(args.outdir, exist_ok=True)
+    written = []
+
+    with span('load') as sp:
+        M, genes = load_matrix(args)
+        pos = pd.Series(np.arange(len(genes)), index=genes)
+        sp.shape(M)
+    with span('standardize', method=args.method) as sp:
+        Z, valid = standardize(M, args.method, args.workers)
+        del M
+        sp.shape(Z)
+
+    if targets:
+        with span('targets', n=len(targets)):
+            found = [g for g in targets if g in pos.index]
+            missing = [g for g in targets if g not in pos.index]
+            if missing:
+                print('[WARN] 不在矩阵中（或被检出率过滤）的靶点:', ', '.join(missing))
+            if found:
+                C = correlate(Z, valid, pos[found].to_numpy())
+                out = pd.DataFrame(C.T, index=pd.Index(genes, name='gene'), columns=found)
+                out = out.drop(index=found).sort_values(found[0], ascending=False, key=np.abs)
+                path = os.path.join(args.outdir, 'M1_coexpr_targets.tsv')
+                out.to_csv(path, sep='\t')
+                written.append(path)
+                print(f'[OK] {found[0]} 共表达 |r| 前 5：')
+                print(out.head(5).to_string())
+
+    if args.tank_ranked:
+        with span('topk', k=args.topk):
+            tk = pd.read_csv(args.tank_ranked, sep='\t', index_col=0)
+            top = [g for g in tk.index[~tk.index.duplicated()] if g in pos.index][:args.topk]
+            rows = pos[top].to_numpy()
+            C = correlate(Z, valid, rows, rows)
+            path = os.path.join(args.outdir, f'M1_coexpr_top{len(top)}.tsv')
+            pd.DataFrame(C, index=top, columns=top).to_csv(path, sep='\t')
+            written.append(path)
+
+    if args.index:
+        with span('index', neighbors=args.neighbors) as sp:
+            nbr, r = neighbor_index(Z, valid, args.neighbors, args.workers)
+            save_index(ipath, genes, nbr, r, args.method, Z.shape[1])
+            written.append(ipath)
+            sp.shape(nbr)
+        if args.query:
+            index = load_index(ipath)
+            for g in args.query:
+                tab = query_index(index, g.split('.')[0], args.neighbors)
+                if tab is not None:
+                    print(f'[OK] {g} 共表达近邻：')
+                    print(tab.head(10).to_string(index=False))
+
+    print(f'[OK] 共表达（{args.method}）：{Z.shape[0]} 基因 x {Z.shape[1]} 样本')
+    for p in written:
+        print(' -', p)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+# scripts/m1_combat.py
+# 批次效应校正：参数化 ComBat（Johnson 等 2007，经验贝叶斯，同 sva::ComBat 的 par.prior 版本）。
+# 批次标签默认取 TCGA 条形码第 6 段（测序板号，tcga_samples.plate_id）；多个队列合并时可按队列或 队列:板号 分批，
+# 或用 --batch_file 给出 样本<TAB>批次 表。默认把 tumor/normal 作为协变量保留，校正不会抹掉肿瘤-正常差异。
+# 全部按批次的归约都写成指示矩阵乘法（Y @ Z，Z 为 样本 x 批次 的 0/1 矩阵），按基因块在线程池中并行：
+#   第一遍：每块回归出批次均值 + 协变量效应、合并方差，并累计标准化数据的批内一阶 / 二阶矩；
+#   先验（γ̄、τ²、逆伽马 a / b）由全部基因的 γ̂、δ̂ 矩估计，EB 迭代只用到批内矩，对 基因 x 批次 一次性向量化；
+#   第二遍：每块重新标准化、减 γ*、除 √δ*、还原尺度，直接写入输出缓存（memmap）。
+# 输出为 star_reader 缓存目录，与输入同一尺度（log_scale / normalization 元信息原样带过去），
+# tank_rank.py / M4 脚本可直接用 --expr 读入。
+#
+#   python scripts/m1_combat.py --expr data/TCGA-STAD.star_counts.tsv.gz
+#   python scripts/m1_combat.py --expr data/TCGA-STAD.star_counts.mat data/TCGA-ESCA.star_counts.mat --batch cohort
+#   python M1_antigen_discovery/tank_rank.py --expr dataprocessed/M1_expr_combat.mat --outdir tank_out
+import os, sys, argparse
+
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+proc_dir = os.path.join(BASE, 'dataprocessed')
+
+CHUNK_GENES = 4096
+EB_TOL = 1e-4
+EB_MAX_ITER = 1000
+BATCHES = 'batches.tsv'
+
+
+def _chunks(n, chunk=CHUNK_GENES):
+    return [slice(i, min(i + chunk, n)) for i in range(0, n, chunk)]
+
+
+def cohort_name(path):
+    return os.path.basename(path.rstrip('/\\')).split('.')[0]
+
+
+def batch_labels(samples, how='plate', cohorts=None, batch_file=None):
+    """
+    每个样本的批次标签：plate（条形码板号）/ cohort（来源矩阵）/ cohort_plate / file（--batch_file 两列表）。
+    板号缺失（非 TCGA 条形码）的样本记为 'NA'，单独成批。
+    """
+    import pandas as pd
+    from tcga_samples import plate_id
+    if how == 'file':
+        t = pd.read_csv(batch_file, sep='\t', dtype=str)
+        m = dict(zip(t.iloc[:, 0], t.iloc[:, 1]))
+        missing = [s for s in samples if s not in m]
+        if missing:
+            raise SystemExit(f'--batch_file 缺少 {len(missing)} 个样本的批次（如 {missing[0]}）')
+        return [m[s] for s in samples]
+    plates = [plate_id(s) or 'NA' for s in samples]
+    if how == 'plate':
+        return plates
+    if how == 'cohort':
+        return list(cohorts)
+    return [f'{c}:{p}' for c, p in zip(cohorts, plates)]
+
+
+def design(batches, covariates=None):
+    """
+    设计矩阵 X = [批次指示 | 协变量]（不含截距，批次指示已张成截距）。
+    返回 (X, Z, levels, n_batch)：Z 为 样本 x 批次 的 0/1 指示矩阵。
+    """
+    import numpy as np
+    import pandas as pd
+    codes, levels = pd.factorize(pd.Series(batches), sort=True)
+    Z = np.zeros((len(codes), len(levels)))
+    Z[np.arange(len(codes)), codes] = 1.0
+    X = Z if covariates is None or covariates.shape[1] == 0 else np.hstack([Z, covariates])
+    if np.linalg.matrix_rank(X) < X.shape[1]:
+        raise SystemExit('协变量与批次共线（如某批次只有肿瘤样本且只有该批次有正常样本），请改用 --covariates none 或合并批次。')
+    return X, Z, np.asarray(levels), Z.sum(axis=0)
+
+
+def group_covariates(samples):
+    """tumor/normal 指示列（两组都存在时才返回一列，否则为空）"""
+    import numpy as np
+    from tcga_samples import sample_group
+    g = np.array([sample_group(s) == 'normal' for s in samples], dtype=np.float64)
+    return g[:, None] if 0 < g.sum() < len(g) else np.zeros((len(samples), 0))
+
+
+def fit_moments(Y, X, Z, n_batch, workers=1):
+    """
+    第一遍（按基因块）：B̂ = Y Xᵀ(XᵀX)⁻¹，合并方差 σ²（残差平方均值），
+    标准化数据 s = (Y - 标准均值)/σ 的批内和 S1 = s Z、平方和 S2 = s² Z。
+    返回 dict(B, var, S1, S2)，均为 基因 x ·。
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    P = np.linalg.solve(X.T @ X, X.T)          # p x n
+    nb = Z.shape[1]
+    w = n_batch / n_batch.sum()
+
+    def block(s):
+        y = np.asarray(Y[s], dtype=np.float64)
+        B = y @ P.T
+        r = y - B @ X.T
+        var = (r * r).mean(axis=1)
+        stand = (B[:, :nb] @ w)[:, None] + B[:, nb:] @ X[:, nb:].T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = (y - stand) / np.sqrt(var)[:, None]
+        z[var == 0] = 0.0
+        return B, var, z @ Z, (z * z) @ Z
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        parts = list(ex.map(block, _chunks(Y.shape[0])))
+    return {k: np.concatenate([p[i] for p in parts]) for i, k in enumerate(('B', 'var', 'S1', 'S2'))}
+
+
+def eb_priors(gamma_hat, delta_hat):
+    """γ 的正态先验 (γ̄, τ²) 与 δ 的逆伽马先验 (a, b)，按批次对全部基因做矩估计"""
+    import numpy as np
+    gbar = gamma_hat.mean(axis=0)
+    t2 = gamma_hat.var(axis=0, ddof=1)
+    m = delta_hat.mean(axis=0)
+    s2 = delta_hat.var(axis=0, ddof=1)
+    a = (2 * s2 + m * m) / s2
+    b = (m * s2 + m ** 3) / s2
+    return gbar, t2, a, b
+
+
+def eb_solve(S1, S2, n_batch, gamma_hat, delta_hat, gbar, t2, a, b, tol=EB_TOL, max_iter=EB_MAX_ITER):
+    """
+    EB 后验迭代（sva 的 it.sol），对 基因 x 批次 整体向量化：
+      γ* = (n τ² γ̂ + δ γ̄) / (n τ² + δ)
+      δ* = (½ Σ(s - γ*)² + b) / (n/2 + a - 1)，Σ(s - γ*)² = S2 - 2γ* S1 + n γ*²
+    返回 (γ*, δ*, 迭代次数)。
+    """
+    import numpy as np
+    g_old, d_old = gamma_hat, delta_hat
+    for it in range(1, max_iter + 1):
+        g_new = (t2 * n_batch * gamma_hat + d_old * gbar) / (t2 * n_batch + d_old)
+        sum2 = np.maximum(S2 - 2 * g_new * S1 + n_batch * g_new * g_new, 0.0)
+        d_new = (0.5 * sum2 + b) / (n_batch / 2 + a - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            change = max(np.nanmax(np.abs(g_new - g_old) / np.abs(g_old)),
+                         np.nanmax(np.abs(d_new - d_old) / np.abs(d_old)))
+        g_old, d_old = g_new, d_new
+        if change < tol:
+            break
+    return g_new, d_new, it
+
+
+def combat(Y, batches, covariates=None, mean_only=False, out=None, workers=1):
+    """
+    Y: 基因 x 样本（ndarray / memmap，对数尺度）；batches: 每个样本的批次标签。
+    out 给出时（同形状 memmap）校正结果按基因块写入 out，否则返回新数组。
+    返回 (out, info)：info 含批次表、先验、被原样保留的基因数等。
+    只有 1 个样本的批次无法估计批内方差，此时与 sva 相同自动改为 mean_only。
+    """
+    import numpy as np
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+    X, Z, levels, n_batch = design(batches, covariates)
+    if len(levels) < 2:
+        raise SystemExit(f'只有 1 个批次（{levels[0]}），无需校正。')
+    if not mean_only and (n_batch < 2).any():
+        print(f'[WARN] {int((n_batch < 2).sum())} 个批次只有 1 个样本，改为只校正均值（mean_only）。')
+        mean_only = True
+
+    with span('fit') as sp:
+        m = fit_moments(Y, X, Z, n_batch, workers)
+        gamma_hat = m['S1'] / n_batch
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta_hat = (m['S2'] - n_batch * gamma_hat * gamma_hat) / (n_batch - 1)
+        # 合并方差为 0，或某批次内为常数的基因不参与先验估计，原样输出
+        ok = m['var'] > 0
+        if not mean_only:
+            ok &= (delta_hat > 0).all(axis=1)
+        sp.set(n_fixed=int((~ok).sum()))
+
+    with span('eb') as sp, np.errstate(invalid='ignore', divide='ignore'):
+        gbar, t2, a, b = eb_priors(gamma_hat[ok], delta_hat[ok])
+        gamma_star, delta_star, n_iter = np.zeros_like(gamma_hat), np.ones_like(gamma_hat), 0
+        if mean_only:
+            gamma_star[ok] = (t2 * gamma_hat[ok] + gbar) / (t2 + 1)
+        else:
+            gamma_star[ok], delta_star[ok], n_iter = eb_solve(m['S1'][ok], m['S2'][ok], n_batch, gamma_hat[ok],
+                                                              delta_hat[ok], gbar, t2, a, b)
+        sp.set(iterations=n_iter)
+
+    if out is None:
+        out = np.empty(Y.shape, dtype=np.float32)
+    nb = Z.shape[1]
+    w = n_batch / n_batch.sum()
+    code = Z.argmax(axis=1)
+
+    def block(s):
+        y = np.asarray(Y[s], dtype=np.float64)
+        B, sd = m['B'][s], np.sqrt(m['var'][s])[:, None]
+        stand = (B[:, :nb] @ w)[:, None] + B[:, nb:] @ X[:, nb:].T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = (y - stand) / sd
+            adj = (z - gamma_star[s][:, code]) / np.sqrt(delta_star[s][:, code]) * sd + stand
+        keep = ~ok[s]
+        adj[keep] = y[keep]
+        out[s] = adj
+
+    with span('adjust') as sp:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(block, _chunks(Y.shape[0])))
+        sp.shape(out)
+
+    table = pd.DataFrame({'batch': levels, 'n': n_batch.astype(int), 'gamma_bar': gbar, 'tau2': t2,
+                          'a_prior': a if not mean_only else np.nan, 'b_prior': b if not mean_only else np.nan,
+                          'mean_abs_gamma': np.abs(gamma_star[ok]).mean(axis=0),
+                          'mean_delta': delta_star[ok].mean(axis=0)})
+    info = {'table': table, 'mean_only': mean_only, 'n_iter': n_iter, 'n_fixed': int((~ok).sum()),
+            'n_covariates': int(X.shape[1] - nb)}
+    return out, info
+
+
+def load_inputs(paths, workers):
+    """一个矩阵时直接 memmap；多个队列取共同基因按列拼接。返回 (Y, genes, samples, cohorts, meta)"""
+    import numpy as np
+    from star_reader import read_star_matrix, read_cache_meta
+    meta = read_cache_meta(paths[0])
+    if len(paths) == 1:
+        df = read_star_matrix(paths[0], workers=workers, mmap=True)
+        return df.to_numpy(), list(df.index), list(df.columns), [cohort_name(paths[0])] * df.shape[1], meta
+    dfs = [read_star_matrix(p, workers=workers, mmap=True) for p in paths]
+    for p, d in zip(paths[1:], dfs[1:]):
+        if read_cache_meta(p).get('log_scale') != meta.get('log_scale'):
+            raise SystemExit(f'{p} 与 {paths[0]} 的尺度不同（log_scale），不能合并校正。')
+    genes = dfs[0].index
+    for d in dfs[1:]:
+        genes = genes.intersection(d.index, sort=False)
+    if genes.has_duplicates:
+        genes = genes.drop_duplicates()
+    Y = np.empty((len(genes), sum(d.shape[1] for d in dfs)), dtype=np.float32)
+    samples, cohorts, j = [], [], 0
+    for p, d in zip(paths, dfs):
+        k = d.shape[1]
+        Y[:, j:j + k] = d.loc[genes].to_numpy()
+        samples += list(d.columns)
+        cohorts += [cohort_name(p)] * k
+        j += k
+    if len(set(samples)) < len(samples):
+        raise SystemExit('多个输入矩阵之间存在重复样本名。')
+    return Y, list(genes), samples, cohorts, meta
+
+
+def main():
+    ap = argparse.ArgumentParser(description='ComBat (parametric empirical Bayes) batch correction -> binary matrix cache')
+    ap.add_argument('--expr', nargs='+', required=True,
+                    help='log-scale STAR matrix / star_reader cache dir; several cohorts are merged on common genes')
+    ap.add_argument('--batch', choices=['plate', 'cohort', 'cohort_plate', 'file'], default='plate',
+                    help='plate: TCGA barcode plate (field 6); cohort: input matrix; file: --batch_file')
+    ap.add_argument('--batch_file', help='sample<TAB>batch table (with header) for --batch file')
+    ap.add_argument('--covariates', choices=['group', 'none'], default='group',
+                    help='group: keep the tumor vs normal difference (barcode sample type) in the design')
+    ap.add_argument('--mean_only', action='store_true', help='adjust batch means only (no variance scaling)')
+    ap.add_argument('--out', default=os.path.join(proc_dir, 'M1_expr_combat.mat'), help='output cache dir')
+    ap.add_argument('--workers', type=int, default=max(1, min(8, os.cpu_count() or 1)))
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+    if args.batch == 'file' and not args.batch_file:
+        raise SystemExit('--batch file 需要 --batch_file')
+
+    import numpy as np
+    from star_reader import create_matrix_cache
+    with span('load') as sp:
+        Y, genes, samples, cohorts, meta = load_inputs(args.expr, args.workers)
+        sp.shape(Y)
+    batches = batch_labels(samples, args.batch, cohorts, args.batch_file)
+    cov = group_covariates(samples) if args.covariates == 'group' else None
+
+    extra = {k: meta[k] for k in ('normalization', 'log_scale') if k in meta}
+    extra.update({'source': [os.path.abspath(p) for p in args.expr],
+                  'combat': {'batch': args.batch, 'covariates': args.covariates, 'n_batches': len(set(batches))}})
+    O = create_matrix_cache(args.out, genes, samples, dtype='float32', index_name='Ensembl_ID', extra=extra)
+    O, info = combat(Y, batches, cov, args.mean_only, out=O, workers=args.workers)
+    O.flush()
+    del O
+
+    tab = info['table']
+    tab.to_csv(os.path.join(args.out, BATCHES), sep='\t', index=False, float_format='%.6g')
+    mode = '只校正均值' if info['mean_only'] else f'均值 + 方差，EB 迭代 {info["n_iter"]} 次'
+    print(f'[OK] ComBat：{len(genes)} 基因 x {len(samples)} 样本，{len(tab)} 个批次（{args.batch}），{mode}，'
+          f'协变量 {info["n_covariates"]} 列')
+    if info['n_fixed']:
+        print(f'[WARN] {info["n_fixed"]} 个基因方差为 0（整体或某批次内），原样保留。')
+    print(tab.sort_values('mean_abs_gamma', ascending=False).head(10).to_string(index=False))
+    print(' -', args.out)
+
+
+if __name__ == '__main__':
+    main()
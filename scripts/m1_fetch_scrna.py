@@ -9,6 +9,7 @@ def main():
     print(f' - {os.path.join(d,"sc_counts.tsv")}   # 细胞x基因 计数矩阵')
     print(f' - {os.path.join(d,"sc_meta.tsv")}     # 细胞元数据（样本/细胞类型等）')
     print('[提示] 若暂无，可先跳过。')
+    print('[下一步] python scripts/m1_scrna.py  # 稀疏读入（缓存为 sc_counts.csr.npz）并按细胞类型统计靶点表达')
 
 if __name__ == '__main__':
     main()
@@ -9,6 +9,7 @@ def main():
     print(f' - {os.path.join(d,"sp_counts.tsv")}   # spotx基因 矩阵')
     print(f' - {os.path.join(d,"sp_meta.tsv")}     # spot元数据（坐标/组织区域）')
     print('[提示] 若暂无，可先跳过。')
+    print('[下一步] python scripts/m1_spatial.py  # KD 树近邻图 + Moran\'s I + 肿瘤/正常区特异性（多切片并行）')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,280 @@
+# scripts/m1_normalize.py
+# 表达矩阵归一化：median-of-ratios 大小因子（DESeq2）、CPM / TPM（基因长度取自 gencode probemap）、
+# 参数化方差稳定变换（VST）。按基因块向量化计算、线程池并行，结果一次性写成二进制矩阵缓存
+# （star_reader 格式，meta.json 标明 log_scale），TANK / M4 读取缓存时不再重复做 log1p。
+#
+#   python scripts/m1_normalize.py --expr data/TCGA-STAD.star_counts.tsv.gz --method vst
+#   python aicar.py m1 normalize --expr data/TCGA-STAD.star_counts.mat --method tpm
+import os, sys, argparse
+
+from star_reader import read_star_matrix, create_matrix_cache, default_workers
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+out_dir = os.path.join(BASE, 'dataprocessed')
+PROBEMAP = os.path.join(BASE, 'M1_antigen_discovery', 'gencode.v36.annotation.gtf.gene.probemap')
+
+METHODS = ['log2', 'cpm', 'tpm', 'mor', 'vst']
+CHUNK_GENES = 4096
+
+
+def gene_chunks(n, chunk=CHUNK_GENES):
+    return [slice(i, min(i + chunk, n)) for i in range(0, n, chunk)]
+
+
+def to_counts(block, input_scale):
+    """Xena STAR 矩阵是 log2(count+1)；统一还原成线性 counts（float64 计算）"""
+    import numpy as np
+    block = np.asarray(block, dtype=np.float64)
+    if input_scale == 'log2p1':
+        block = np.exp2(block) - 1.0
+    return np.clip(block, 0.0, None)
+
+
+def load_gene_lengths(genes, probemap=PROBEMAP):
+    """
+    基因长度（bp，chromEnd - chromStart + 1，即基因组跨度）。行名可以是 Ensembl ID 或 symbol。
+    probemap 里找不到的基因用已知长度的中位数代替，返回 (lengths, n_missing)。
+    """
+    import numpy as np
+    import pandas as pd
+    pm = pd.read_csv(probemap, sep='\t', usecols=['id', 'gene', 'chromStart', 'chromEnd'])
+    span_bp = (pm['chromEnd'] - pm['chromStart'] + 1).astype(float)
+    by_id = pd.Series(span_bp.values, index=pm['id'].astype(str).str.split('.').str[0])
+    by_sym = pd.Series(span_bp.values, index=pm['gene'].astype(str))
+    by_id = by_id[~by_id.index.duplicated()]
+    by_sym = by_sym[~by_sym.index.duplicated()]
+    keys = pd.Index([str(g).split('.')[0] if str(g).startswith('ENSG') else str(g) for g in genes])
+    lengths = by_id.reindex(keys).to_numpy()
+    miss = np.isnan(lengths)
+    if miss.any():
+        lengths[miss] = by_sym.reindex(keys[miss]).to_numpy()
+        miss = np.isnan(lengths)
+    if miss.all():
+        raise SystemExit(f"No gene lengths found in {probemap} for this matrix (TPM needs them).")
+    lengths[miss] = np.nanmedian(lengths)
+    return lengths, int(miss.sum())
+
+
+def _column_pass(X, sl, input_scale, lengths):
+    """
+    一个基因块的列统计：库大小、长度归一后的速率和，以及 median-of-ratios 用的 log 比值
+    （几何均值按 DESeq2 poscounts 定义：正值的 log 和 / 样本数；全正基因上与经典定义相同，0 记为 NaN）。
+    """
+    import numpy as np
+    c = to_counts(X[sl], input_scale)
+    lib = c.sum(axis=0)
+    rate = (c / (lengths[sl, None] / 1e3)).sum(axis=0) if lengths is not None else None
+    keep = (c > 0).any(axis=1)
+    c = c[keep]
+    with np.errstate(divide='ignore'):
+        logc = np.where(c > 0, np.log(c), np.nan)
+    lgm = np.nansum(logc, axis=1, keepdims=True) / c.shape[1]
+    lr = (logc - lgm).astype(np.float32)
+    return lib, rate, lr, (c > 0).all(axis=1)
+
+
+def size_factors(X, input_scale='log2p1', lengths=None, workers=1, min_genes=100):
+    """
+    一遍扫描得到三类样本因子：
+      mor  —— DESeq2 median-of-ratios（只用所有样本都 >0 的基因；不足 min_genes 个时退回 poscounts）
+      lib  —— 库大小（CPM 分母）
+      rate —— sum(count / 长度kb)（TPM 分母，需要 lengths）
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    chunks = gene_chunks(X.shape[0])
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        parts = list(ex.map(lambda sl: _column_pass(X, sl, input_scale, lengths), chunks))
+    lib = np.sum([p[0] for p in parts], axis=0)
+    rate = np.sum([p[1] for p in parts], axis=0) if lengths is not None else None
+    lr = np.vstack([p[2] for p in parts])
+    allpos = np.concatenate([p[3] for p in parts])
+    if allpos.sum() >= min_genes:
+        mor_type, n_used = 'ratio', int(allpos.sum())
+        mor = np.exp(np.median(lr[allpos], axis=0).astype(np.float64))
+    elif lr.shape[0]:
+        # poscounts：每个样本只在自身 >0 的基因上取中位数，再把几何均值归一到 1
+        mor_type, n_used = 'poscounts', int(lr.shape[0])
+        mor = np.exp(np.nanmedian(lr, axis=0).astype(np.float64))
+        mor = mor / np.exp(np.mean(np.log(mor)))
+    else:
+        mor_type, n_used, mor = 'none', 0, np.ones(X.shape[1])
+    return {'mor': mor, 'lib': lib, 'rate': rate, 'mor_type': mor_type, 'n_mor_genes': n_used}
+
+
+def _moments(X, sl, input_scale, sf):
+    import numpy as np
+    q = to_counts(X[sl], input_scale) / sf
+    return q.mean(axis=1), q.var(axis=1, ddof=1)
+
+
+def fit_dispersion_trend(mu, disp, max_iter=30):
+    """
+    DESeq2 的参数化离散度趋势 disp(mu) = asymptDisp + extraPois / mu：
+    gamma 族、identity 链接的 IRLS（权重 1/fit²），每轮剔除 disp/fit 不在 (1e-4, 15) 的基因。
+    extraPois 拟合为负（离散度不随均值下降，如已过度处理的数据）时约束为 0，只拟合常数项。
+    """
+    import numpy as np
+    ok = (mu > 0) & np.isfinite(disp) & (disp > 1e-8)
+    coef = np.array([0.1, 1.0])                         # asymptDisp, extraPois
+    for _ in range(max_iter):
+        fit = coef[0] + coef[1] / mu
+        use = ok & (disp / fit > 1e-4) & (disp / fit < 15)
+        if use.sum() < 3:
+            break
+        A = np.column_stack([np.ones(int(use.sum())), 1.0 / mu[use]])
+        w = 1.0 / fit[use]
+        new = np.linalg.lstsq(A * w[:, None], disp[use] * w, rcond=None)[0]
+        if new[1] <= 0:
+            new = np.array([np.sum(disp[use] * w * w) / np.sum(w * w), 0.0])
+        if new[0] <= 0:
+            raise SystemExit("VST: parametric dispersion fit gave a non-positive asymptotic dispersion; "
+                             "try --method mor or cpm.")
+        done = np.allclose(new, coef, rtol=1e-3, atol=1e-8)
+        coef = new
+        if done:
+            break
+    return float(coef[0]), float(coef[1])
+
+
+def vst_transform(q, asympt_disp, extra_pois):
+    """DESeq2 getVarianceStabilizedData(fitType='parametric') 的闭式变换（log2 尺度）"""
+    import numpy as np
+    a1, a0 = asympt_disp, extra_pois
+    return np.log2((1 + a0 + 2 * a1 * q + 2 * np.sqrt(a1 * q * (1 + a0 + a1 * q))) / (4 * a1))
+
+
+def _transform_block(X, sl, input_scale, method, scale, lengths, vst_coef, linear):
+    import numpy as np
+    c = to_counts(X[sl], input_scale)
+    if method == 'tpm':
+        c = c / (lengths[sl, None] / 1e3)
+    q = c / scale if scale is not None else c
+    if method == 'vst':
+        return vst_transform(q, *vst_coef)
+    return q if linear else np.log2(q + 1.0)
+
+
+def fit_normalization(X, method='vst', input_scale='log2p1', lengths=None, linear=False, workers=1):
+    """估计大小因子（及 VST 离散度趋势），返回 (params, sf 字典, meta)；params 供 transform_into 使用"""
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    if method == 'tpm' and lengths is None:
+        raise SystemExit("TPM needs gene lengths (--probemap).")
+    with span('size_factors'):
+        sf = size_factors(X, input_scale, lengths if method == 'tpm' else None, workers)
+    if method in ('mor', 'vst') and sf['mor_type'] == 'none':
+        raise SystemExit("median-of-ratios: matrix has no expressed genes.")
+    scale = {'log2': None, 'cpm': sf['lib'] / 1e6, 'tpm': (sf['rate'] / 1e6) if sf['rate'] is not None else None,
+             'mor': sf['mor'], 'vst': sf['mor']}[method]
+
+    vst_coef = None
+    if method == 'vst':
+        with span('dispersion'):
+            chunks = gene_chunks(X.shape[0])
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                mom = list(ex.map(lambda sl: _moments(X, sl, input_scale, sf['mor']), chunks))
+            mu = np.concatenate([m for m, _ in mom])
+            var = np.concatenate([v for _, v in mom])
+            xim = float(np.mean(1.0 / sf['mor']))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                disp = (var - xim * mu) / mu ** 2
+            vst_coef = fit_dispersion_trend(mu, disp)
+
+    log_scale = method in ('log2', 'vst') or not linear
+    meta = {'normalization': method, 'input_scale': input_scale, 'log_scale': log_scale,
+            'size_factor_type': sf['mor_type'],
+            'value': {'log2': 'log2(count+1)', 'vst': 'vst'}.get(method, ('log2(%s+1)' % method) if log_scale else method)}
+    if vst_coef:
+        meta['vst'] = {'asymptDisp': vst_coef[0], 'extraPois': vst_coef[1]}
+    params = (input_scale, method, scale, lengths, vst_coef, linear)
+    return params, sf, meta
+
+
+def transform_into(X, out, params, workers=1):
+    """按基因块把 X 变换写入 out（ndarray 或 memmap，形状相同），线程池并行"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def work(sl):
+        out[sl] = _transform_block(X, sl, *params)
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(work, gene_chunks(X.shape[0])))
+    return out
+
+
+def normalize_frame(df, method='vst', input_scale='counts', lengths=None, linear=False, workers=1):
+    """内存版：DataFrame(基因 x 样本) -> 归一化后的 DataFrame（float64），以及 (sf, meta)"""
+    import numpy as np
+    import pandas as pd
+    X = df.to_numpy(dtype=np.float64)
+    params, sf, meta = fit_normalization(X, method, input_scale, lengths, linear, workers)
+    Y = transform_into(X, np.empty_like(X), params, workers)
+    return pd.DataFrame(Y, index=df.index, columns=df.columns), sf, meta
+
+
+def normalize_to_cache(X, genes, samples, out, method='vst', input_scale='log2p1', lengths=None,
+                       linear=False, workers=1, index_name=None, extra=None):
+    """按基因块归一化 X（基因 x 样本，可为 memmap），写入 out 缓存目录；返回 (sf 字典, meta)"""
+    params, sf, meta = fit_normalization(X, method, input_scale, lengths, linear, workers)
+    meta.update(extra or {})
+    with span('write', method=method) as sp:
+        M = create_matrix_cache(out, genes, samples, dtype='float32', index_name=index_name, extra=meta)
+        transform_into(X, M, params, workers)
+        M.flush()
+        sp.shape(M)
+        del M
+    return sf, meta
+
+
+def write_size_factors(path, samples, sf):
+    import pandas as pd
+    df = pd.DataFrame({'size_factor_mor': sf['mor'], 'library_size': sf['lib']}, index=pd.Index(samples, name='sample'))
+    if sf.get('rate') is not None:
+        df['tpm_rate_sum'] = sf['rate']
+    df.to_csv(path, sep='\t')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Normalize a genes x samples count matrix (size factors / CPM / TPM / VST) into a binary matrix cache')
+    ap.add_argument('--expr', required=True, help='STAR matrix (.tsv/.tsv.gz) or star_reader cache dir')
+    ap.add_argument('--method', choices=METHODS, default='vst',
+                    help='log2: log2(count+1); cpm/tpm/mor: log2(x+1) of normalized counts; vst: DESeq2-style parametric VST')
+    ap.add_argument('--input_scale', choices=['log2p1', 'counts'], default='log2p1',
+                    help='log2p1 = Xena STAR log2(count+1) values (default); counts = raw counts')
+    ap.add_argument('--linear', action='store_true', help='write cpm/tpm/mor on the linear scale (no log2)')
+    ap.add_argument('--probemap', default=PROBEMAP, help='gencode probemap with chromStart/chromEnd (TPM gene lengths)')
+    ap.add_argument('--out', help='output cache dir (default: dataprocessed/M1_expr_<method>.mat)')
+    ap.add_argument('--workers', type=int, default=default_workers())
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    with span('load') as sp:
+        df = sp.shape(read_star_matrix(args.expr, workers=args.workers, mmap=True))
+    lengths, n_miss = (None, 0)
+    if args.method == 'tpm':
+        lengths, n_miss = load_gene_lengths(df.index, args.probemap)
+
+    out = args.out or os.path.join(out_dir, f'M1_expr_{args.method}.mat')
+    sf, meta = normalize_to_cache(df.to_numpy(), df.index, df.columns, out, method=args.method,
+                                  input_scale=args.input_scale, lengths=lengths, linear=args.linear,
+                                  workers=args.workers, index_name=df.index.name,
+                                  extra={'source': os.path.abspath(args.expr)})
+    sf_path = os.path.join(out, 'size_factors.tsv')
+    write_size_factors(sf_path, df.columns, sf)
+
+    print(f'[OK] 归一化完成：{args.method} ({meta["value"]})，{df.shape[0]} 基因 x {df.shape[1]} 样本')
+    print(f'  median-of-ratios ({sf["mor_type"]}) 使用 {sf["n_mor_genes"]} 个基因；大小因子范围 '
+          f'{sf["mor"].min():.3f} – {sf["mor"].max():.3f}')
+    if 'vst' in meta:
+        print(f'  VST 离散度趋势: asymptDisp={meta["vst"]["asymptDisp"]:.4g} extraPois={meta["vst"]["extraPois"]:.4g}')
+    if n_miss:
+        print(f'[WARN] {n_miss} 个基因在 probemap 中没有长度，TPM 用中位长度代替。')
+    print(' -', out)
+    print(' -', sf_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# scripts/m1_permutation.py
+# 置换检验引擎：为 TSI 与 AUC 提供经验 p 值 / FDR。
+# 一次性生成 B 组 tumor/normal 标签置换（uint8 紧凑矩阵，样本 x 置换），
+# 每个基因只排一次秩：秩和 AUC = (R @ P - n1(n1+1)/2) / (n1·n0)，TSI 的肿瘤组均值 = X @ P / n1，
+# 全部基因 x 置换 用分块矩阵乘法完成（基因块 x 置换块，内存有界），线程池跨基因块并行（BLAS 释放 GIL）。
+# 所有基因共用同一组置换，保留基因间相关结构。
+#
+#   python scripts/m1_permutation.py --permutations 10000                  # dataprocessed/M1_expr_log2.tsv
+#   python scripts/m1_permutation.py --expr data/TCGA-STAD.star_counts.tsv.gz --genes ENSG00000066405
+import os, sys, argparse
+
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+proc_dir = os.path.join(BASE, 'dataprocessed')
+tab_dir = os.path.join(BASE, 'resultstables')
+EXPR = os.path.join(proc_dir, 'M1_expr_log2.tsv')
+CLI = os.path.join(proc_dir, 'M1_clinical.tsv')
+
+CHUNK_GENES = 2048
+CHUNK_PERMS = 1024
+
+
+def permutation_matrix(y, n_perm, seed=42):
+    """(样本 x 置换) 的 uint8 矩阵，每列是 y 的一次随机重排（肿瘤数固定为 n1）"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    y = np.asarray(y, dtype=np.uint8)
+    P = np.empty((len(y), n_perm), dtype=np.uint8)
+    for s in range(0, n_perm, CHUNK_PERMS):
+        b = min(CHUNK_PERMS, n_perm - s)
+        P[:, s:s + b] = y[rng.permuted(np.tile(np.arange(len(y)), (b, 1)), axis=1)].T
+    return P
+
+
+def observed_scores(X, R, y):
+    """观测 AUC（秩和，等价 roc_auc_score）与 TSI = mean_t / (mean_t + mean_n)"""
+    import numpy as np
+    y = np.asarray(y, dtype=np.float64)
+    n1, n0 = y.sum(), len(y) - y.sum()
+    auc = (R @ y - n1 * (n1 + 1) / 2.0) / (n1 * n0)
+    mt = X @ y / n1
+    mn = (X.sum(axis=1) - X @ y) / n0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tsi = mt / (mt + mn)
+    return auc, tsi
+
+
+def _exceed_block(X, R, P, sl, y, auc_obs, tsi_obs, alternative):
+    """一个基因块：逐个置换块做 R@P / X@P，累计置换统计量 >= 观测值的次数"""
+    import numpy as np
+    x, r = X[sl], R[sl]
+    n1 = float(np.sum(y)); n0 = len(y) - n1
+    rowsum = x.sum(axis=1, keepdims=True)
+    a_obs, t_obs = auc_obs[sl, None], tsi_obs[sl, None]
+    ca = np.zeros(x.shape[0], dtype=np.int64)
+    ct = np.zeros(x.shape[0], dtype=np.int64)
+    eps = 1e-12
+    for s in range(0, P.shape[1], CHUNK_PERMS):
+        Pc = P[:, s:s + CHUNK_PERMS].astype(np.float64)
+        auc = (r @ Pc - n1 * (n1 + 1) / 2.0) / (n1 * n0)
+        xt = x @ Pc
+        mt, mn = xt / n1, (rowsum - xt) / n0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tsi = mt / (mt + mn)
+        if alternative == 'two-sided':
+            ca += (np.abs(auc - 0.5) >= np.abs(a_obs - 0.5) - eps).sum(axis=1)
+            ct += (np.abs(tsi - 0.5) >= np.abs(t_obs - 0.5) - eps).sum(axis=1)
+        else:
+            ca += (auc >= a_obs - eps).sum(axis=1)
+            ct += (tsi >= t_obs - eps).sum(axis=1)
+    return sl, ca, ct
+
+
+def permutation_test(X, y, n_perm=1000, seed=42, workers=1, alternative='greater'):
+    """
+    X: 基因 x 样本（ndarray），y: 0/1 标签。返回 dict：auc / tsi / p_auc / p_tsi / fdr_auc / fdr_tsi。
+    经验 p = (1 + #{置换 >= 观测}) / (B + 1)；alternative='greater' 检验肿瘤特异（高 AUC / 高 TSI）。
+    """
+    import numpy as np
+    from scipy.stats import rankdata
+    from concurrent.futures import ThreadPoolExecutor
+    from multitest import bh_fdr
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y).astype(np.uint8)
+    if y.sum() == 0 or y.sum() == len(y):
+        raise SystemExit('置换检验需要同时有 Tumor 与 Normal 样本。')
+    R = rankdata(X, axis=1)                             # 每个基因只排一次（并列取平均秩）
+    auc_obs, tsi_obs = observed_scores(X, R, y)
+    P = permutation_matrix(y, n_perm, seed)
+    ca = np.zeros(X.shape[0], dtype=np.int64)
+    ct = np.zeros(X.shape[0], dtype=np.int64)
+    chunks = [slice(i, min(i + CHUNK_GENES, X.shape[0])) for i in range(0, X.shape[0], CHUNK_GENES)]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for sl, a, t in ex.map(lambda s: _exceed_block(X, R, P, s, y, auc_obs, tsi_obs, alternative), chunks):
+            ca[sl], ct[sl] = a, t
+    p_auc = (1.0 + ca) / (n_perm + 1.0)
+    p_tsi = (1.0 + ct) / (n_perm + 1.0)
+    p_tsi[np.isnan(tsi_obs)] = np.nan
+    return {'AUC': auc_obs, 'TSI': tsi_obs, 'p_auc': p_auc, 'p_tsi': p_tsi,
+            'fdr_auc': bh_fdr(p_auc), 'fdr_tsi': bh_fdr(p_tsi)}
+
+
+def load_inputs(args):
+    """dataprocessed 的 M1_expr_log2.tsv + M1_clinical.tsv，或 --expr 的 STAR 矩阵（按条形码分组）"""
+    import numpy as np
+    import pandas as pd
+    if args.expr:
+        from star_reader import read_star_matrix
+        from tcga_samples import sample_group
+        X = read_star_matrix(args.expr, mmap=True)
+        grp = np.array([sample_group(s) for s in X.columns], dtype=object)
+        keep = grp != None  # noqa: E711  (逐元素比较)
+        return X.loc[:, keep], (grp[keep] == 'tumor').astype(int)
+    if not (os.path.exists(EXPR) and os.path.exists(CLI)):
+        print('[错误] 缺少预处理文件，请先运行: python scripts/m1_preprocess.py（或用 --expr 指定 STAR 矩阵）')
+        sys.exit(1)
+    X = pd.read_csv(EXPR, sep='\t', index_col=0)
+    meta = pd.read_csv(CLI, sep='\t')
+    X = X[meta['SampleID'].tolist()]
+    return X, (meta['Group'].astype(str).str.lower() == 'tumor').astype(int).values
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Permutation null for TSI / AUC across genes (empirical p + BH FDR)')
+    ap.add_argument('--expr', help='STAR matrix / cache (groups from TCGA barcodes); default: dataprocessed/M1_expr_log2.tsv')
+    ap.add_argument('--genes', nargs='+', help='restrict to these genes (default: all)')
+    ap.add_argument('--genes_file', help='file with genes (one per line), e.g. candidate antigens')
+    ap.add_argument('--permutations', type=int, default=1000)
+    ap.add_argument('--alternative', choices=['greater', 'two-sided'], default='greater')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--workers', type=int, default=max(1, min(8, os.cpu_count() or 1)))
+    ap.add_argument('--out', default=os.path.join(tab_dir, 'M1_permutation_pvalues.tsv'))
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    import pandas as pd
+    with span('load') as sp:
+        X, y = load_inputs(args)
+        genes = list(args.genes or [])
+        if args.genes_file:
+            with open(args.genes_file, 'r', encoding='utf-8') as f:
+                genes += [s.strip() for s in f if s.strip()]
+        if genes:
+            missing = [g for g in genes if g not in X.index]
+            X = X.loc[[g for g in dict.fromkeys(genes) if g in X.index]]
+            if missing:
+                print('[WARN] 不在矩阵中的基因:', ', '.join(missing))
+        sp.shape(X)
+    with span('permute', perms=args.permutations) as sp:
+        res = permutation_test(X.to_numpy(), y, args.permutations, args.seed, args.workers, args.alternative)
+        sp.shape(X)
+    with span('write'):
+        out = pd.DataFrame(res, index=X.index)
+        out['n_perm'] = args.permutations
+        out = out.sort_values(['fdr_auc', 'AUC'], ascending=[True, False])
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        out.to_csv(args.out, sep='\t')
+
+    print(f'[OK] 置换检验完成：{X.shape[0]} 基因 x {args.permutations} 次置换（tumor={int(y.sum())}, normal={int(len(y) - y.sum())}）')
+    print(out.head(5).to_string())
+    print(' -', args.out)
+
+
+if __name__ == '__main__':
+    main()
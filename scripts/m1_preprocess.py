@@ -1,5 +1,6 @@
 # scripts/m1_preprocess.py
-import os, sys, pandas as pd, numpy as np
+import os, sys, argparse, pandas as pd, numpy as np
+from stage_trace import span
 
 BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 d_tcga = os.path.join(BASE, 'data', 'TCGA_STAD')
@@ -10,36 +11,58 @@ EXP = os.path.join(d_tcga, 'expression.tsv')
 CLI = os.path.join(d_tcga, 'clinical.tsv')
 
 def main():
+    ap = argparse.ArgumentParser(description='M1 预处理：样本对齐 + 归一化，输出 dataprocessed/M1_expr_log2.tsv')
+    ap.add_argument('--norm', choices=['log2', 'cpm', 'tpm', 'mor', 'vst'], default='log2',
+                    help='log2: log2(count+1)（默认，与旧版一致）；cpm/tpm/mor: log2(x+1)；vst: DESeq2 风格 VST（均为 log2 尺度）')
+    ap.add_argument('--cache', action='store_true', help='同时写二进制矩阵缓存 dataprocessed/M1_expr_log2.mat')
+    args = ap.parse_args()
+
     if not (os.path.exists(EXP) and os.path.exists(CLI)):
         print('[错误] 缺少 expression.tsv 或 clinical.tsv，请先按 m1_fetch_tcga.py 的提示放好文件。')
         sys.exit(1)
 
-    expr = pd.read_csv(EXP, sep='\t')
-    # 约定第一列为基因symbol
-    gene_col = expr.columns[0]
-    expr = expr.set_index(gene_col)
+    with span('load') as sp:
+        expr = pd.read_csv(EXP, sep='\t')
+        # 约定第一列为基因symbol
+        gene_col = expr.columns[0]
+        expr = sp.shape(expr.set_index(gene_col))
 
-    cli = pd.read_csv(CLI, sep='\t')
+        cli = pd.read_csv(CLI, sep='\t')
     # 约定包含两列：SampleID, Group(值为Tumor/Normal)
     assert {'SampleID','Group'}.issubset(set(cli.columns)), 'clinical.tsv 必须包含 SampleID / Group 列'
 
     # 交集样本
-    samples = [s for s in cli['SampleID'].tolist() if s in expr.columns]
-    expr = expr[samples]
-    cli = cli[cli['SampleID'].isin(samples)].reset_index(drop=True)
+    with span('filter') as sp:
+        samples = [s for s in cli['SampleID'].tolist() if s in expr.columns]
+        expr = sp.shape(expr[samples])
+        cli = cli[cli['SampleID'].isin(samples)].reset_index(drop=True)
 
-    # 简单log2 转换（避免0）
-    expr = np.log2(expr + 1)
+    # 简单log2 转换（避免0）；其他方法交给 m1_normalize（输入为原始 counts）
+    with span('transform', norm=args.norm) as sp:
+        if args.norm == 'log2':
+            expr = np.log2(expr + 1)
+            meta = {'normalization': 'log2', 'input_scale': 'counts', 'log_scale': True, 'value': 'log2(count+1)'}
+        else:
+            from m1_normalize import normalize_frame, load_gene_lengths
+            lengths = load_gene_lengths(expr.index)[0] if args.norm == 'tpm' else None
+            expr, _, meta = normalize_frame(expr, method=args.norm, input_scale='counts', lengths=lengths)
+        sp.shape(expr)
 
     # 输出标准化文件
     expr_out = os.path.join(out_dir, 'M1_expr_log2.tsv')
     cli_out  = os.path.join(out_dir, 'M1_clinical.tsv')
-    expr.to_csv(expr_out, sep='\t')
-    cli.to_csv(cli_out, sep='\t', index=False)
+    with span('write'):
+        expr.to_csv(expr_out, sep='\t')
+        cli.to_csv(cli_out, sep='\t', index=False)
+        if args.cache:
+            from star_reader import save_matrix_cache
+            cache_out = save_matrix_cache(expr.astype(np.float32), os.path.join(out_dir, 'M1_expr_log2.mat'), extra=meta)
 
-    print('[OK] 预处理完成：')
+    print(f'[OK] 预处理完成（{meta["value"]}）：')
     print(' -', expr_out)
     print(' -', cli_out)
+    if args.cache:
+        print(' -', cache_out)
 
 if __name__ == '__main__':
     main()
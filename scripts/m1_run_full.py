@@ -1,7 +1,7 @@
 # scripts/m1_run_full.py
-import os, sys, pandas as pd, numpy as np
-from sklearn.metrics import roc_auc_score
-from sklearn.model_selection import StratifiedKFold
+import os, sys, argparse, pandas as pd, numpy as np
+from stage_trace import span
+# sklearn 只在 AUC 路径里按需导入（TSI 路径不需要付出 ~1s 的导入开销）
 
 BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 proc_dir = os.path.join(BASE, 'dataprocessed')
@@ -35,8 +35,9 @@ def compute_tsi(X, meta, gene):
     if gene not in X.index:
         return np.nan
     g = X.loc[gene, sids]
-    tumor = g[meta['Group'].str.lower()=='tumor'].values
-    normal = g[meta['Group'].str.lower()=='normal'].values
+    grp = meta['Group'].astype(str).str.lower().values   # 用 ndarray 掩码，避免与样本ID索引对齐出错
+    tumor = g.values[grp=='tumor']
+    normal = g.values[grp=='normal']
     if len(tumor)==0 or len(normal)==0:
         return np.nan
     tmean, nmean = tumor.mean(), normal.mean()
@@ -46,6 +47,7 @@ def compute_tsi(X, meta, gene):
 def compute_auc_for_gene(X, y, gene):
     if gene not in X.index: 
         return np.nan
+    from sklearn.metrics import roc_auc_score
     scores = X.loc[gene].values  # 以表达量作为打分（简单基线）
     try:
         return float(roc_auc_score(y, scores))
@@ -54,6 +56,8 @@ def compute_auc_for_gene(X, y, gene):
 
 def kfold_auc(X, y, gene, k=5):
     if gene not in X.index: return np.nan
+    from sklearn.metrics import roc_auc_score
+    from sklearn.model_selection import StratifiedKFold
     skf = StratifiedKFold(n_splits=min(k, sum(y==0), sum(y==1), 5), shuffle=True, random_state=42)
     vals = []
     for tr, te in skf.split(X.T, y):
@@ -65,7 +69,14 @@ def kfold_auc(X, y, gene, k=5):
     return float(np.mean(vals)) if len(vals)>0 else np.nan
 
 def main():
-    X, y, meta = load_data()
+    ap = argparse.ArgumentParser(description='M1: TSI + 5-fold AUC for the target gene')
+    ap.add_argument('--permutations', type=int, default=0,
+                    help='>0: add permutation p-values for TSI / AUC (m1_permutation engine)')
+    args = ap.parse_args()
+
+    with span('load') as sp:
+        X, y, meta = load_data()
+        sp.shape(X)
 
     # 目标基因（可扩展：你可以在这里放入候选列表做排名）
     genes = list(set([TARGET_GENE]) & set(X.index))
@@ -74,17 +85,30 @@ def main():
         sys.exit(0)
 
     rows = []
-    for g in genes:
-        tsi = compute_tsi(X, meta, g)
-        auc5 = kfold_auc(X, y, g, k=5)
-        rows.append({'gene': g, 'TSI': tsi, 'AUC_5fold': auc5})
+    with span('score', genes=len(genes)):
+        for g in genes:
+            tsi = compute_tsi(X, meta, g)
+            auc5 = kfold_auc(X, y, g, k=5)
+            rows.append({'gene': g, 'TSI': tsi, 'AUC_5fold': auc5})
+    if args.permutations > 0:
+        from m1_permutation import permutation_test
+        with span('permute', perms=args.permutations):
+            perm = permutation_test(X.loc[genes].to_numpy(), y, n_perm=args.permutations)
+        for i, r in enumerate(rows):
+            r['TSI_perm_p'] = perm['p_tsi'][i]
+            r['AUC_perm_p'] = perm['p_auc'][i]
 
-    df = pd.DataFrame(rows).sort_values(['TSI','AUC_5fold'], ascending=False)
+    with span('sort'):
+        df = pd.DataFrame(rows).sort_values(['TSI','AUC_5fold'], ascending=False)
     out_csv = os.path.join(res_dir, 'M1_antigen_ranking.csv')
-    df.to_csv(out_csv, index=False)
-    with open(os.path.join(tab_dir, 'M1_metrics.txt'), 'w', encoding='utf-8') as f:
-        f.write(f'Mean AUC (5-fold): {df["AUC_5fold"].mean():.4f}\n')
-        f.write(f'Target gene {TARGET_GENE} TSI: {df["TSI"].iloc[0]:.4f}\n')
+    with span('write'):
+        df.to_csv(out_csv, index=False)
+        with open(os.path.join(tab_dir, 'M1_metrics.txt'), 'w', encoding='utf-8') as f:
+            f.write(f'Mean AUC (5-fold): {df["AUC_5fold"].mean():.4f}\n')
+            f.write(f'Target gene {TARGET_GENE} TSI: {df["TSI"].iloc[0]:.4f}\n')
+            if args.permutations > 0:
+                f.write(f'Permutation p ({args.permutations}x): TSI={df["TSI_perm_p"].iloc[0]:.4g} '
+                        f'AUC={df["AUC_perm_p"].iloc[0]:.4g}\n')
 
     print('[OK] M1 完成：')
     print(' -', out_csv)
@@ -0,0 +1,213 @@
+# scripts/m1_sample_qc.py
+# 样本 QC：流式随机截断 SVD（Halko 等，带幂迭代）做样本 PCA，给出每个样本的离群分数与排除名单。
+# 不生成中心化副本：中心化矩阵 M = X - mu·1ᵀ 只以乘积形式出现，
+#   M @ W  = X @ W  - mu (1ᵀW)        Mᵀ @ Y = Xᵀ @ Y - 1 (muᵀY)
+# X 按基因块流式读取（缓存目录为 memmap），线程池跨基因块并行；每次乘法只读一遍矩阵。
+# 离群分数：前 k 个 PC 得分的稳健 z（中位数 / MAD），d² = Σz²，p = χ²_k 尾概率，Bonferroni 判定离群。
+# 保留名单可直接给 tank_rank.py --sample_keep；tank_rank.py --sample_qc 会在进程内自动完成这一步。
+#
+#   python scripts/m1_sample_qc.py --expr data/TCGA-STAD.star_counts.mat
+#   python M1_antigen_discovery/tank_rank.py --expr ... --sample_keep dataprocessed/M1_sample_keep.txt
+import os, sys, argparse
+
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+proc_dir = os.path.join(BASE, 'dataprocessed')
+tab_dir = os.path.join(BASE, 'resultstables')
+fig_dir = os.path.join(BASE, 'resultsfigures')
+
+CHUNK_GENES = 4096
+DEFAULT_PCS = 10
+DEFAULT_OUTLIER_PCS = 5
+DEFAULT_ALPHA = 0.01
+DEFAULT_MAX_EXCLUDE = 0.1
+
+
+def _chunks(n, chunk=CHUNK_GENES):
+    return [slice(i, min(i + chunk, n)) for i in range(0, n, chunk)]
+
+
+def _block(X, rows, s, log1p):
+    import numpy as np
+    x = np.asarray(X[rows[s]], dtype=np.float64)
+    return np.log1p(x) if log1p else x
+
+
+def gene_moments(X, log1p=False, workers=1):
+    """一遍流式：每个基因的均值、方差(ddof=1)、检出率(>0)"""
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    rows = np.arange(X.shape[0])
+
+    def block(s):
+        x = _block(X, rows, s, log1p)
+        return s, x.mean(axis=1), x.var(axis=1, ddof=1), (x > 0).mean(axis=1)
+
+    mu, var, det = (np.empty(X.shape[0]) for _ in range(3))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for s, m, v, d in ex.map(block, _chunks(X.shape[0])):
+            mu[s], var[s], det[s] = m, v, d
+    return mu, var, det
+
+
+def randomized_pca(X, rows, mu, n_pcs=DEFAULT_PCS, oversample=10, n_iter=7, seed=0, log1p=False, workers=1):
+    """
+    样本 PCA：中心化后的 X[rows]（基因 x 样本）的随机截断 SVD。
+    返回 (scores: 样本 x k, sdev²: 每个 PC 的方差, 基因载荷: len(rows) x k)。
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    n = X.shape[1]
+    k = min(n_pcs, n - 1, len(rows))
+    l = min(k + oversample, n, len(rows))
+    mu = np.asarray(mu, dtype=np.float64)
+    chunks = _chunks(len(rows))
+    rng = np.random.default_rng(seed)
+
+    def mult_M(W):
+        Y = np.empty((len(rows), W.shape[1]))
+        cw = W.sum(axis=0)
+
+        def block(s):
+            Y[s] = _block(X, rows, s, log1p) @ W - np.outer(mu[s], cw)
+
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(block, chunks))
+        return Y
+
+    def mult_Mt(Y):
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            parts = list(ex.map(lambda s: _block(X, rows, s, log1p).T @ Y[s], chunks))
+        return sum(parts) - np.outer(np.ones(n), mu @ Y)
+
+    Q, _ = np.linalg.qr(mult_M(rng.standard_normal((n, l))))
+    for _ in range(n_iter):
+        Z, _ = np.linalg.qr(mult_Mt(Q))
+        Q, _ = np.linalg.qr(mult_M(Z))
+    B = mult_Mt(Q).T                                    # l x 样本 = Qᵀ M
+    Ub, S, Vt = np.linalg.svd(B, full_matrices=False)
+    scores = Vt[:k].T * S[:k]
+    # 符号约定：每个 PC 载荷绝对值最大的基因取正（与 sklearn svd_flip 一致，结果可复现）
+    U = Q @ Ub[:, :k]
+    sign = np.sign(U[np.argmax(np.abs(U), axis=0), np.arange(k)])
+    sign[sign == 0] = 1
+    return scores * sign, S[:k] ** 2 / (n - 1), U * sign
+
+
+def outlier_scores(scores, n_use=DEFAULT_OUTLIER_PCS, alpha=DEFAULT_ALPHA, max_exclude=DEFAULT_MAX_EXCLUDE):
+    """前 n_use 个 PC 的稳健 z；d² ~ χ²(n_use)；p < alpha / N 判为离群（最多排除 max_exclude 比例，取最极端者）"""
+    import numpy as np
+    from scipy.stats import chi2
+    s = scores[:, :n_use]
+    med = np.median(s, axis=0)
+    mad = 1.4826 * np.median(np.abs(s - med), axis=0)
+    mad[mad == 0] = np.nan
+    z = (s - med) / mad
+    d2 = np.nansum(z * z, axis=1)
+    p = chi2.sf(d2, s.shape[1])
+    flag = p < alpha / len(p)
+    cap = int(np.floor(max_exclude * len(p)))
+    if flag.sum() > cap:
+        keep_flag = np.argsort(p, kind='stable')[:cap]
+        flag[:] = False
+        flag[keep_flag] = True
+    return np.sqrt(d2), p, flag, z
+
+
+def sample_qc(df, n_pcs=DEFAULT_PCS, outlier_pcs=DEFAULT_OUTLIER_PCS, alpha=DEFAULT_ALPHA,
+              max_exclude=DEFAULT_MAX_EXCLUDE, top_var=5000, min_detect_prop=0.1, log1p=False, seed=0, workers=1):
+    """
+    df: 基因 x 样本（DataFrame，可为 memmap 支撑）。返回 (qc 表, 解释方差比例, 使用的基因数)。
+    先按检出率过滤、再取方差最大的 top_var 个基因（0 = 全部）做 PCA。
+    """
+    import numpy as np
+    import pandas as pd
+    from tcga_samples import sample_type
+    X = df.to_numpy()
+    with span('qc_moments') as sp:
+        mu, var, det = gene_moments(X, log1p, workers)
+        ok = np.flatnonzero((det >= min_detect_prop) & (var > 0))
+        if top_var and len(ok) > top_var:
+            ok = ok[np.argsort(-var[ok], kind='stable')[:top_var]]
+        rows = np.sort(ok)
+        sp.set(genes=int(len(rows)))
+    if len(rows) < 2:
+        raise SystemExit('样本 QC：过滤后可用基因不足（检查 --min_detect_prop / 输入尺度）。')
+    with span('qc_pca', pcs=n_pcs):
+        scores, ev, _ = randomized_pca(X, rows, mu[rows], n_pcs, seed=seed, log1p=log1p, workers=workers)
+    total = float(var[rows].sum())
+    with span('qc_outliers'):
+        d, p, flag, _ = outlier_scores(scores, min(outlier_pcs, scores.shape[1]), alpha, max_exclude)
+    qc = pd.DataFrame(scores, index=pd.Index(df.columns, name='sample'),
+                      columns=[f'PC{i + 1}' for i in range(scores.shape[1])])
+    qc['outlier_score'] = d
+    qc['p_outlier'] = p
+    qc['outlier'] = flag
+    qc['sample_type'] = [sample_type(s) for s in df.columns]
+    return qc, ev / total, int(len(rows))
+
+
+def write_lists(qc, keep_path, exclude_path=None):
+    os.makedirs(os.path.dirname(os.path.abspath(keep_path)), exist_ok=True)
+    with open(keep_path, 'w', encoding='utf-8') as f:
+        f.write(''.join(f'{s}\n' for s in qc.index[~qc['outlier']]))
+    if exclude_path:
+        with open(exclude_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(f'{s}\n' for s in qc.index[qc['outlier']]))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Streaming randomized PCA sample QC: PCs, outlier scores, keep / exclude lists')
+    ap.add_argument('--expr', required=True, help='STAR matrix or star_reader cache dir (streamed via memmap)')
+    ap.add_argument('--n_pcs', type=int, default=DEFAULT_PCS)
+    ap.add_argument('--outlier_pcs', type=int, default=DEFAULT_OUTLIER_PCS, help='PCs used for the outlier distance')
+    ap.add_argument('--alpha', type=float, default=DEFAULT_ALPHA, help='family-wise level (Bonferroni over samples)')
+    ap.add_argument('--max_exclude', type=float, default=DEFAULT_MAX_EXCLUDE, help='never exclude more than this fraction')
+    ap.add_argument('--top_var', type=int, default=5000, help='most variable genes used for PCA (0 = all passing genes)')
+    ap.add_argument('--min_detect_prop', type=float, default=0.1)
+    ap.add_argument('--log1p', action='store_true', help='log1p before PCA (not needed for log2(count+1) input)')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--workers', type=int, default=max(1, min(8, os.cpu_count() or 1)))
+    ap.add_argument('--out', default=os.path.join(tab_dir, 'M1_sample_qc.tsv'))
+    ap.add_argument('--keep', default=os.path.join(proc_dir, 'M1_sample_keep.txt'), help='samples passing QC (for --sample_keep)')
+    ap.add_argument('--exclude', default=os.path.join(proc_dir, 'M1_sample_exclude.txt'))
+    ap.add_argument('--plot', default=os.path.join(fig_dir, 'M1_sample_qc_pca.png'), help="PC1/PC2 plot ('' to skip)")
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    from star_reader import read_star_matrix, is_log_scale
+    with span('load') as sp:
+        df = sp.shape(read_star_matrix(args.expr, workers=args.workers, mmap=True))
+    log1p = args.log1p and not is_log_scale(args.expr)
+    qc, evr, n_genes = sample_qc(df, args.n_pcs, args.outlier_pcs, args.alpha, args.max_exclude, args.top_var,
+                                 args.min_detect_prop, log1p, args.seed, args.workers)
+
+    with span('write'):
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        qc.sort_values('outlier_score', ascending=False).to_csv(args.out, sep='\t')
+        write_lists(qc, args.keep, args.exclude)
+        if args.plot:
+            os.environ.setdefault('MPLBACKEND', 'Agg')
+            import matplotlib.pyplot as plt
+            os.makedirs(os.path.dirname(os.path.abspath(args.plot)), exist_ok=True)
+            o = qc['outlier'].to_numpy()
+            plt.figure(figsize=(4.8, 4.2))
+            plt.scatter(qc['PC1'][~o], qc['PC2'][~o], s=10, c='0.5', alpha=0.7, linewidths=0, label='kept')
+            plt.scatter(qc['PC1'][o], qc['PC2'][o], s=18, c='tab:red', marker='x', label='outlier')
+            plt.xlabel(f'PC1 ({100 * evr[0]:.1f}%)'); plt.ylabel(f'PC2 ({100 * evr[1]:.1f}%)')
+            plt.title(f'Sample QC: {int(o.sum())} / {len(o)} outliers'); plt.legend(fontsize=7)
+            plt.tight_layout(); plt.savefig(args.plot, dpi=160); plt.close()
+
+    n_out = int(qc['outlier'].sum())
+    print(f'[OK] 样本 QC：{len(qc)} 样本，{n_genes} 基因，前 {len(evr)} 个 PC 解释方差 {100 * evr.sum():.1f}%，离群 {n_out} 个')
+    if n_out:
+        print(qc[qc['outlier']].sort_values('outlier_score', ascending=False)[['outlier_score', 'p_outlier', 'sample_type']].to_string())
+    for p in (args.out, args.keep, args.exclude, args.plot):
+        if p:
+            print(' -', p)
+
+
+if __name__ == '__main__':
+    main()
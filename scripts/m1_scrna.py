@@ -0,0 +1,196 @@
+# scripts/m1_scrna.py
+# 单细胞佐证：把 data/SC/sc_counts.tsv（细胞x基因）流式读入 CSR 稀疏矩阵，并缓存为二进制 .npz，
+# 然后按细胞类型统计 TANK 靶点的表达（检出率 / 均值 / 表达份额），用于验证 CLDN18 的细胞特异性。
+import os, sys, argparse
+# numpy / pandas / scipy 在函数内按需导入，保证 --help 与 aicar.py 分发秒开
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+d_sc = os.path.join(BASE, 'data', 'SC')
+tab_dir = os.path.join(BASE, 'resultstables')
+
+COUNTS = os.path.join(d_sc, 'sc_counts.tsv')
+META = os.path.join(d_sc, 'sc_meta.tsv')
+TANK_TARGETS = os.path.join(BASE, 'tank_out', 'TANK_targets.tsv')
+PROBEMAP = os.path.join(BASE, 'M1_antigen_discovery', 'gencode.v36.annotation.gtf.gene.probemap')
+DEFAULT_TARGETS = ["ENSG00000066405", "ENSG00000141736", "ENSG00000120217"]  # CLDN18, ERBB2, CD274
+CELLTYPE_COLS = ["cell_type", "celltype", "CellType", "cell_type_major", "annotation", "cluster"]
+
+
+def cache_path_for(path):
+    return os.path.splitext(path)[0] + '.csr.npz'
+
+
+def stream_counts_to_csr(path, chunk_cells=1000, sep='\t'):
+    """逐块读取 细胞x基因 文本矩阵，每块转成 CSR 后再纵向拼接；峰值内存 ~ 一个块的稠密大小"""
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
+    blocks, cells = [], []
+    genes = None
+    reader = pd.read_csv(path, sep=sep, header=0, index_col=0, chunksize=chunk_cells, compression='infer')
+    for chunk in reader:
+        if genes is None:
+            genes = chunk.columns.astype(str).to_numpy()
+        vals = chunk.to_numpy(dtype=np.float32, na_value=0.0)
+        blocks.append(sparse.csr_matrix(vals))
+        cells.extend(chunk.index.astype(str).tolist())
+    if genes is None:
+        raise SystemExit(f"Empty single-cell matrix: {path}")
+    X = sparse.vstack(blocks, format='csr') if len(blocks) > 1 else blocks[0]
+    return X, np.asarray(cells), genes
+
+
+def save_csr_cache(path, X, cells, genes):
+    import numpy as np
+    X = X.tocsr()
+    np.savez(path, data=X.data, indices=X.indices, indptr=X.indptr, shape=np.asarray(X.shape),
+             cells=cells.astype(str), genes=genes.astype(str))
+
+
+def load_csr_cache(path):
+    import numpy as np
+    from scipy import sparse
+    z = np.load(path, allow_pickle=False)
+    X = sparse.csr_matrix((z['data'], z['indices'], z['indptr']), shape=tuple(z['shape']))
+    return X, z['cells'], z['genes']
+
+
+def load_sc_counts(path, chunk_cells=1000, use_cache=True):
+    """优先读二进制缓存（比源文件新时），否则流式解析并写缓存。返回 (X[cells x genes] CSR, cells, genes)"""
+    cache = cache_path_for(path)
+    if use_cache and os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return load_csr_cache(cache)
+    X, cells, genes = stream_counts_to_csr(path, chunk_cells=chunk_cells)
+    if use_cache:
+        save_csr_cache(cache, X, cells, genes)
+    return X, cells, genes
+
+
+def pick_celltype_col(meta, requested=None):
+    if requested:
+        if requested not in meta.columns:
+            raise SystemExit(f"{requested} not in sc_meta columns: {list(meta.columns)}")
+        return requested
+    for c in CELLTYPE_COLS:
+        if c in meta.columns:
+            return c
+    raise SystemExit(f"sc_meta.tsv 缺少细胞类型列（尝试过 {CELLTYPE_COLS}），请用 --celltype_col 指定。")
+
+
+def load_targets(args):
+    import pandas as pd
+    if args.targets:
+        return list(args.targets)
+    if os.path.exists(args.tank_targets):
+        t = pd.read_csv(args.tank_targets, sep='\t')
+        if 'target' in t.columns and len(t):
+            return t['target'].astype(str).tolist()
+    return list(DEFAULT_TARGETS)
+
+
+def resolve_targets(targets, genes, probemap=None):
+    """靶点可为 Ensembl 或 symbol；单细胞矩阵通常用 symbol，必要时用 gencode probemap 转换"""
+    import pandas as pd
+    col = {g: i for i, g in enumerate(genes)}
+    col.update({g.split('.')[0]: i for i, g in enumerate(genes) if g.startswith('ENSG')})
+    ens2sym = {}
+    if probemap and os.path.exists(probemap):
+        pm = pd.read_csv(probemap, sep='\t', usecols=[0, 1])
+        pm.columns = ['ensembl', 'gene']
+        ens2sym = dict(zip(pm['ensembl'].str.split('.').str[0], pm['gene']))
+    found, missing = [], []
+    for t in targets:
+        key = t.split('.')[0] if t.startswith('ENSG') else t
+        if key in col:
+            found.append((t, key, col[key]))
+        elif ens2sym.get(key) in col:
+            found.append((t, ens2sym[key], col[ens2sym[key]]))
+        else:
+            missing.append(t)
+    return found, missing
+
+
+def celltype_target_stats(X, celltypes, target_cols, target_size=1e4):
+    """
+    稀疏归约：用 (类型 x 细胞) 指示矩阵 G 乘以靶点列子矩阵，
+    一次得到每个细胞类型的 求和 / 检出数 / 文库归一化均值，不需要稠密化整个矩阵。
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
+    codes, types = pd.factorize(pd.Series(celltypes).astype(str), sort=True)
+    n = X.shape[0]
+    G = sparse.csr_matrix((np.ones(n, dtype=np.float32), (codes, np.arange(n))), shape=(len(types), n))
+    ncell = np.asarray(G.sum(axis=1)).ravel()
+
+    libsize = np.asarray(X.sum(axis=1)).ravel()
+    scale = np.divide(target_size, libsize, out=np.zeros_like(libsize, dtype=np.float64), where=libsize > 0)
+
+    Xt = X[:, target_cols].tocsr()
+    sums = np.asarray((G @ Xt).todense())
+    det = np.asarray((G @ (Xt > 0).astype(np.float32)).todense())
+    norm = np.asarray((G @ sparse.diags(scale) @ Xt).todense())
+
+    tot = sums.sum(axis=0, keepdims=True)
+    share = np.divide(sums, tot, out=np.zeros_like(sums), where=tot > 0)
+    return types.to_numpy(), ncell, sums / ncell[:, None], norm / ncell[:, None], det / ncell[:, None], share
+
+
+def main():
+    ap = argparse.ArgumentParser(description="scRNA corroboration of TANK targets (sparse, bounded memory)")
+    ap.add_argument('--counts', default=COUNTS, help='cells x genes counts (.tsv/.tsv.gz)')
+    ap.add_argument('--meta', default=META, help='cell metadata (first column = cell ID)')
+    ap.add_argument('--celltype_col', help='cell type column in meta (auto if omitted)')
+    ap.add_argument('--targets', nargs='+', help='Targets (Ensembl or symbol); default: TANK_targets.tsv')
+    ap.add_argument('--tank_targets', default=TANK_TARGETS)
+    ap.add_argument('--probemap', default=PROBEMAP, help='gencode probemap for Ensembl -> symbol')
+    ap.add_argument('--chunk_cells', type=int, default=1000, help='cells parsed per streaming block')
+    ap.add_argument('--no_cache', action='store_true', help='do not read/write the binary CSR cache')
+    ap.add_argument('--outdir', default=tab_dir)
+    args = ap.parse_args()
+
+    if not (os.path.exists(args.counts) and os.path.exists(args.meta)):
+        print('[错误] 缺少 sc_counts.tsv 或 sc_meta.tsv，请先按 m1_fetch_scrna.py 的提示放好文件。')
+        sys.exit(1)
+
+    import pandas as pd
+    X, cells, genes = load_sc_counts(args.counts, chunk_cells=args.chunk_cells, use_cache=not args.no_cache)
+    meta = pd.read_csv(args.meta, sep='\t', index_col=0)
+    meta.index = meta.index.astype(str)
+    ct_col = pick_celltype_col(meta, args.celltype_col)
+
+    # 只保留有注释的细胞（行切片仍是稀疏的）
+    ct = meta[ct_col].reindex(cells)
+    keep = ct.notna().to_numpy()
+    if not keep.any():
+        raise SystemExit("No overlap between sc_counts cell IDs and sc_meta index.")
+    X, ct = X[keep], ct[keep].to_numpy()
+
+    found, missing = resolve_targets(load_targets(args), genes, args.probemap)
+    if not found:
+        raise SystemExit(f"None of the targets found in single-cell genes: {missing}")
+
+    types, ncell, mean, mean_cp10k, det, share = celltype_target_stats(X, ct, [c for _, _, c in found])
+    rows = []
+    for j, (t, g, _) in enumerate(found):
+        for i, tp in enumerate(types):
+            rows.append({'target': t, 'gene': g, 'cell_type': tp, 'n_cells': int(ncell[i]),
+                         'detect_rate': det[i, j], 'mean': mean[i, j], 'mean_cp10k': mean_cp10k[i, j],
+                         'expr_share': share[i, j]})
+    out = pd.DataFrame(rows).sort_values(['target', 'mean_cp10k'], ascending=[True, False])
+
+    os.makedirs(args.outdir, exist_ok=True)
+    out_tsv = os.path.join(args.outdir, 'M1_scRNA_target_celltype.tsv')
+    out.to_csv(out_tsv, sep='\t', index=False)
+
+    print(f'[OK] scRNA: {X.shape[0]} cells x {X.shape[1]} genes, nnz={X.nnz} ({100.0 * X.nnz / max(1, X.shape[0] * X.shape[1]):.2f}% dense)')
+    for t, g, _ in found:
+        top = out[out['target'] == t].iloc[0]
+        print(f'  {t} ({g}): top cell type = {top["cell_type"]}  detect_rate={top["detect_rate"]:.3f}  expr_share={top["expr_share"]:.3f}')
+    if missing:
+        print('[WARN] Targets not found in single-cell genes:', ', '.join(missing))
+    print(' -', out_tsv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# scripts/m1_spatial.py
+# 空间转录组佐证：读入 data/SPATIAL/sp_counts.tsv（spot x 基因）与 sp_meta.tsv（坐标/组织区域），
+# 用 KD 树构建 spot 近邻稀疏图，按基因计算 Moran's I 空间自相关，以及肿瘤区 vs 正常区的特异性。
+# 多张切片（meta 中的 slide 列，或多个输入目录）在进程池中并行处理。
+import os, sys, argparse
+
+from m1_scrna import load_sc_counts, resolve_targets, DEFAULT_TARGETS, PROBEMAP, TANK_TARGETS
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+d_sp = os.path.join(BASE, 'data', 'SPATIAL')
+tab_dir = os.path.join(BASE, 'resultstables')
+
+COORD_COLS = [("x", "y"), ("pxl_col_in_fullres", "pxl_row_in_fullres"), ("imagecol", "imagerow"),
+              ("array_col", "array_row")]
+REGION_COLS = ["region", "tissue_region", "annotation", "pathology"]
+SLIDE_COLS = ["slide", "section", "sample"]
+TUMOR_LABELS = ["tumor", "tumour"]
+NORMAL_LABELS = ["normal"]
+
+
+def pick_col(meta, candidates, what, requested=None):
+    if requested:
+        if requested not in meta.columns:
+            raise SystemExit(f"{requested} not in sp_meta columns: {list(meta.columns)}")
+        return requested
+    for c in candidates:
+        if c in meta.columns:
+            return c
+    if what is None:
+        return None
+    raise SystemExit(f"sp_meta.tsv 缺少{what}列（尝试过 {candidates}）。")
+
+
+def pick_coord_cols(meta):
+    for cx, cy in COORD_COLS:
+        if cx in meta.columns and cy in meta.columns:
+            return cx, cy
+    raise SystemExit(f"sp_meta.tsv 缺少坐标列（尝试过 {COORD_COLS}）。")
+
+
+def knn_graph(coords, k=6, radius=None):
+    """KD 树近邻 -> 行标准化的稀疏权重矩阵 W (spot x spot)，不含自身"""
+    import numpy as np
+    from scipy import sparse
+    from scipy.spatial import cKDTree
+    tree = cKDTree(coords)
+    n = coords.shape[0]
+    if radius:
+        pairs = tree.query_pairs(r=radius, output_type='ndarray')
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    else:
+        kk = min(k + 1, n)
+        _, idx = tree.query(coords, k=kk)
+        idx = idx.reshape(n, kk)
+        # 坐标重复时自身不一定排在第 0 列：显式去掉自身，每行保留前 kk-1 个其他 spot
+        keep = idx != np.arange(n)[:, None]
+        keep &= np.cumsum(keep, axis=1) <= kk - 1
+        rows = np.nonzero(keep)[0]
+        cols = idx[keep]
+    W = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    deg = np.asarray(W.sum(axis=1)).ravel()
+    inv = np.divide(1.0, deg, out=np.zeros_like(deg), where=deg > 0)
+    return sparse.diags(inv) @ W
+
+
+def morans_i(X, W):
+    """
+    全基因 Moran's I（正态假设下的 z / p）。中心化通过代数展开完成，X 保持稀疏：
+    z'Wz = x'Wx - m·(1'Wx) - m·(x'W1) + m²·S0
+    """
+    import numpy as np
+    from scipy import stats
+    n = X.shape[0]
+    X = X.tocsr().astype(np.float64)
+    m = np.asarray(X.mean(axis=0)).ravel()
+    WX = W @ X
+    xWx = np.asarray(X.multiply(WX).sum(axis=0)).ravel()
+    colW = np.asarray(W.sum(axis=0)).ravel()
+    rowW = np.asarray(W.sum(axis=1)).ravel()
+    oneWx = colW @ X
+    xW1 = X.T @ rowW
+    S0 = W.sum()
+    num = xWx - m * np.asarray(oneWx).ravel() - m * np.asarray(xW1).ravel() + m * m * S0
+    ss = np.asarray(X.multiply(X).sum(axis=0)).ravel() - n * m * m
+    with np.errstate(divide='ignore', invalid='ignore'):
+        I = np.where(ss > 0, (n / S0) * num / ss, np.nan)
+
+    # 方差（正态近似）只依赖于 W
+    Ws = W + W.T
+    S1 = 0.5 * Ws.multiply(Ws).sum()
+    S2 = np.sum((rowW + colW) ** 2)
+    EI = -1.0 / (n - 1)
+    VI = (n * n * S1 - n * S2 + 3 * S0 * S0) / ((n * n - 1) * S0 * S0) - EI * EI
+    z = (I - EI) / np.sqrt(VI)
+    p = 2 * stats.norm.sf(np.abs(z))
+    return I, z, p
+
+
+def region_specificity(X, regions, tumor_labels=TUMOR_LABELS, normal_labels=NORMAL_LABELS):
+    """
+    肿瘤区 / 正常区 spot 指示矩阵 x 表达矩阵，一次得到两区均值与检出率。
+    区域标签按整词匹配（不区分大小写）：'non-tumor'、'peritumoral' 不算肿瘤区。
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
+    reg = pd.Series(regions).astype(str).str.strip().str.lower()
+    tmask = reg.isin([t.lower() for t in tumor_labels]).to_numpy()
+    nmask = reg.isin([t.lower() for t in normal_labels]).to_numpy() & ~tmask
+    R = sparse.csr_matrix(np.vstack([tmask, nmask]).astype(np.float64))
+    n = np.maximum(np.asarray(R.sum(axis=1)).ravel(), 1)
+    sums = np.asarray((R @ X).todense())
+    det = np.asarray((R @ (X > 0).astype(np.float64)).todense())
+    mean_t, mean_n = sums[0] / n[0], sums[1] / n[1]
+    tot = sums[0] + sums[1]
+    share = np.divide(sums[0], tot, out=np.full_like(tot, np.nan), where=tot > 0)
+    return {
+        'tumor_mean': mean_t, 'normal_mean': mean_n,
+        'log2fc': np.log2((mean_t + 1.0) / (mean_n + 1.0)),
+        'tumor_detect': det[0] / n[0], 'normal_detect': det[1] / n[1],
+        'tumor_share': share, 'n_tumor': int(tmask.sum()), 'n_normal': int(nmask.sum()),
+    }
+
+
+def process_slide(job):
+    import pandas as pd
+    slide, X, coords, regions, genes, k, radius, labels = job
+    W = knn_graph(coords, k=k, radius=radius)
+    I, z, p = morans_i(X, W)
+    spec = region_specificity(X, regions, *labels)
+    n_t, n_n = spec.pop('n_tumor'), spec.pop('n_normal')
+    df = pd.DataFrame({'moran_I': I, 'moran_z': z, 'moran_p': p, **spec}, index=pd.Index(genes, name='gene'))
+    df.insert(0, 'slide', slide)
+    return slide, df, (X.shape[0], n_t, n_n, W.nnz)
+
+
+def iter_slide_jobs(indir, args):
+    import numpy as np
+    import pandas as pd
+    counts = os.path.join(indir, 'sp_counts.tsv')
+    meta_p = os.path.join(indir, 'sp_meta.tsv')
+    if not (os.path.exists(counts) and os.path.exists(meta_p)):
+        print(f'[警告] {indir} 缺少 sp_counts.tsv 或 sp_meta.tsv，跳过。')
+        return
+    X, spots, genes = load_sc_counts(counts, chunk_cells=args.chunk_spots, use_cache=not args.no_cache)
+    meta = pd.read_csv(meta_p, sep='\t', index_col=0)
+    meta.index = meta.index.astype(str)
+    meta = meta.reindex(spots)
+    keep = meta.notna().any(axis=1).to_numpy()
+    X, meta = X[keep], meta[keep]
+    cx, cy = pick_coord_cols(meta)
+    reg_col = pick_col(meta, REGION_COLS, '组织区域', args.region_col)
+    slide_col = pick_col(meta, SLIDE_COLS, None, args.slide_col)
+    tag = os.path.basename(os.path.normpath(indir))
+    groups = meta.groupby(slide_col, sort=True).indices if slide_col else {tag: np.arange(len(meta))}
+    for slide, rows in groups.items():
+        sub = meta.iloc[rows]
+        yield (str(slide), X[rows], sub[[cx, cy]].to_numpy(dtype=float), sub[reg_col].to_numpy(),
+               genes, args.k, args.radius, (args.tumor_labels, args.normal_labels))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Spatial neighborhood engine: Moran's I + tumor/normal region specificity")
+    ap.add_argument('--inputs', nargs='+', default=[d_sp], help='dirs containing sp_counts.tsv + sp_meta.tsv')
+    ap.add_argument('--region_col', help='tissue region column in sp_meta (auto if omitted)')
+    ap.add_argument('--tumor_labels', nargs='+', default=TUMOR_LABELS,
+                    help='region values counted as tumor (exact, case-insensitive)')
+    ap.add_argument('--normal_labels', nargs='+', default=NORMAL_LABELS,
+                    help='region values counted as normal (exact, case-insensitive)')
+    ap.add_argument('--slide_col', help='slide/section column for multi-slide inputs (auto if present)')
+    ap.add_argument('--k', type=int, default=6, help='k nearest neighbours (Visium hex grid: 6)')
+    ap.add_argument('--radius', type=float, help='use radius neighbours instead of kNN (coordinate units)')
+    ap.add_argument('--targets', nargs='+', help='candidate antigens (default: TANK_targets.tsv)')
+    ap.add_argument('--tank_targets', default=TANK_TARGETS)
+    ap.add_argument('--probemap', default=PROBEMAP)
+    ap.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    ap.add_argument('--chunk_spots', type=int, default=2000)
+    ap.add_argument('--no_cache', action='store_true')
+    ap.add_argument('--outdir', default=tab_dir)
+    args = ap.parse_args()
+
+    import numpy as np
+    import pandas as pd
+    jobs = [j for d in args.inputs for j in iter_slide_jobs(d, args)]
+    if not jobs:
+        print('[错误] 没有可用的空间数据，请先按 m1_fetch_spatial.py 的提示放好文件。')
+        sys.exit(1)
+
+    results = []
+    if args.workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(jobs))) as ex:
+            results = list(ex.map(process_slide, jobs))
+    else:
+        results = [process_slide(j) for j in jobs]
+
+    os.makedirs(args.outdir, exist_ok=True)
+    per_slide = pd.concat([df for _, df, _ in results])
+    out_all = os.path.join(args.outdir, 'M1_spatial_gene_stats.tsv')
+    per_slide.to_csv(out_all, sep='\t')
+
+    # 候选抗原跨切片汇总
+    targets = args.targets
+    if not targets:
+        targets = pd.read_csv(args.tank_targets, sep='\t')['target'].astype(str).tolist() \
+            if os.path.exists(args.tank_targets) else list(DEFAULT_TARGETS)
+    genes = np.asarray(jobs[0][4])
+    found, missing = resolve_targets(targets, genes, args.probemap)
+    # 按 resolve_targets 返回的列号取矩阵中的原始基因名（可能带版本号），而不是去版本后的键
+    cand = per_slide[per_slide.index.isin([genes[c] for _, _, c in found])].reset_index()
+    summ = cand.groupby('gene').agg(n_slides=('slide', 'nunique'), moran_I_mean=('moran_I', 'mean'),
+                                    frac_slides_p05=('moran_p', lambda s: float((s < 0.05).mean())),
+                                    log2fc_mean=('log2fc', 'mean'), tumor_share_mean=('tumor_share', 'mean'))
+    out_cand = os.path.join(args.outdir, 'M1_spatial_targets.tsv')
+    summ.sort_values('moran_I_mean', ascending=False).to_csv(out_cand, sep='\t')
+
+    print('[OK] Spatial:')
+    for slide, _, (n, n_t, n_n, nnz) in results:
+        print(f'  slide={slide}: spots={n} tumor={n_t} normal={n_n} graph_edges={nnz}')
+    for g, row in summ.iterrows():
+        print(f'  {g}: Moran I={row["moran_I_mean"]:.3f}  log2FC(T/N)={row["log2fc_mean"]:.3f}  tumor_share={row["tumor_share_mean"]:.3f}')
+    if missing:
+        print('[WARN] Targets not found in spatial genes:', ', '.join(missing))
+    print(' -', out_all)
+    print(' -', out_cand)
+
+
+if __name__ == '__main__':
+    main()
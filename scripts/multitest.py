@@ -0,0 +1,20 @@
+# scripts/multitest.py
+# 多重检验校正（向量化，NaN 安全），供 M1 置换检验与 M4 差异表达共用。
+
+
+def bh_fdr(p):
+    """Benjamini-Hochberg；NaN 保持 NaN，只在非 NaN 的 p 上计数"""
+    import numpy as np
+    p = np.asarray(p, dtype=float)
+    q = np.full_like(p, np.nan)
+    ok = ~np.isnan(p)
+    m = int(ok.sum())
+    if m == 0:
+        return q
+    order = np.argsort(p[ok])
+    ranked = p[ok][order] * m / np.arange(1, m + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    out = np.empty(m)
+    out[order] = np.minimum(ranked, 1.0)
+    q[ok] = out
+    return q
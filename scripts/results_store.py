@@ -0,0 +1,240 @@
+# scripts/results_store.py
+# 列式二进制结果库：TANK 排名与 M4 表（DE / 截断点扫描）在写 TSV 的同时写一份 <名字>.res 目录，
+#   meta.json          行数、键列名、列清单（dtype / 文件）、排序依据
+#   keys.npy           行键（按排名顺序，定长 unicode）
+#   keys_sorted.npy    排过序的键 + keys_order.npy（对应行号）：基因 -> 行号 的二分索引
+#   rank.npy           预排好的名次（第 i 行 = 第 i+1 名）
+#   <列>.npy           每列一个文件（数值 / 布尔 / 定长字符串），全部可 memmap
+# 查询只 memmap 用到的列：某基因的名次是一次二分查找 + 读一行；top-K（可带过滤）按名次顺序分块扫描，够数即停；
+# join 用另一个库的键索引逐键定位，不读整表。
+#
+#   python scripts/results_store.py tank_out/TANK_ranked.res --gene ENSG00000066405 CLDN18
+#   python scripts/results_store.py tank_out/TANK_ranked.res --top 50 --where "detect_prop>=0.3" \
+#       --join M4_feedback_simulation/out/M4_DE_tumor_vs_normal.res --join_columns logFC fdr_mod
+import os, re, json, argparse
+
+STORE_META = 'meta.json'
+STORE_SUFFIX = '.res'
+SCAN_ROWS = 65536
+_OPS = {'>=': 'ge', '<=': 'le', '==': 'eq', '!=': 'ne', '>': 'gt', '<': 'lt'}
+_WHERE = re.compile(r'^\s*([^<>=!\s]+)\s*(>=|<=|==|!=|>|<)\s*(.+?)\s*$')
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, STORE_META))
+
+
+def store_path(tsv_path):
+    """xxx.tsv -> xxx.res（与 TSV 并排）"""
+    return os.path.splitext(tsv_path)[0] + STORE_SUFFIX
+
+
+def _column_array(s):
+    import numpy as np
+    import pandas as pd
+    if pd.api.types.is_bool_dtype(s):
+        return s.to_numpy(dtype=bool)
+    if pd.api.types.is_numeric_dtype(s):
+        return s.to_numpy(dtype=np.float64 if pd.api.types.is_float_dtype(s) else np.int64)
+    v = s.fillna('').astype(str).to_numpy()
+    return np.asarray(v, dtype=f'U{max(1, max((len(x) for x in v), default=1))}')
+
+
+def write_store(df, path, kind='', sort_by=None, extra=None):
+    """
+    DataFrame（索引为键，行已按名次排好）-> 结果库目录。sort_by 只作记录（如 'score desc'）。
+    重复键保留第一行（名次最高者）参与索引，其余行仍在库中。
+    """
+    import numpy as np
+    if is_store(path):
+        import shutil
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+    keys = np.asarray(df.index.astype(str), dtype=f'U{max(1, max((len(str(k)) for k in df.index), default=1))}')
+    order = np.argsort(keys, kind='stable')
+    ks = keys[order]
+    first = np.concatenate([[True], ks[1:] != ks[:-1]]) if len(ks) else np.zeros(0, dtype=bool)
+    np.save(os.path.join(path, 'keys.npy'), keys)
+    np.save(os.path.join(path, 'keys_sorted.npy'), ks[first])
+    np.save(os.path.join(path, 'keys_order.npy'), order[first].astype(np.int64))
+    np.save(os.path.join(path, 'rank.npy'), np.arange(1, len(df) + 1, dtype=np.int64))
+    cols = {}
+    for i, c in enumerate(df.columns):
+        fn = f'c{i:03d}.npy'
+        arr = _column_array(df[c])
+        np.save(os.path.join(path, fn), arr)
+        cols[str(c)] = {'file': fn, 'dtype': str(arr.dtype)}
+    meta = {'kind': kind, 'key': df.index.name or 'key', 'n_rows': int(len(df)), 'sort_by': sort_by,
+            'columns': cols}
+    meta.update(extra or {})
+    with open(os.path.join(path, STORE_META), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=1)
+    return path
+
+
+def parse_where(exprs):
+    """['detect_prop>=0.3', 'gene_type==protein_coding'] -> [(列, 比较, 值文本)]；值按列类型在比较时转换"""
+    out = []
+    for e in exprs or []:
+        m = _WHERE.match(e)
+        if not m:
+            raise SystemExit(f'无法解析过滤条件: {e!r}（形如 detect_prop>=0.3）')
+        col, op, val = m.groups()
+        out.append((col, op, val.strip('\'"')))
+    return out
+
+
+class ResultStore(object):
+    """结果库的只读视图；列按需 memmap"""
+
+    def __init__(self, path):
+        if not is_store(path):
+            raise SystemExit(f'不是结果库目录: {path}')
+        self.path = path
+        with open(os.path.join(path, STORE_META), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.n = self.meta['n_rows']
+        self._cache = {}
+
+    @property
+    def columns(self):
+        return list(self.meta['columns'])
+
+    def _load(self, fn):
+        import numpy as np
+        if fn not in self._cache:
+            self._cache[fn] = np.load(os.path.join(self.path, fn), mmap_mode='r')
+        return self._cache[fn]
+
+    def column(self, name):
+        if name == 'rank':
+            return self._load('rank.npy')
+        if name not in self.meta['columns']:
+            raise KeyError(f'{name!r} not in {self.path} (columns: {", ".join(self.columns)})')
+        return self._load(self.meta['columns'][name]['file'])
+
+    def rows_of(self, keys):
+        """键列表 -> 行号数组（找不到为 -1）；二分查找 memmap 的排序键"""
+        import numpy as np
+        ks, order = self._load('keys_sorted.npy'), self._load('keys_order.npy')
+        q = np.asarray([str(k) for k in keys], dtype=str)
+        if not len(ks) or not len(q):
+            return np.full(len(q), -1, dtype=np.int64)
+        # 比定长键更长的查询不可能命中；不能截断到库的宽度再比（否则 'ENSG...405.13' 会命中 'ENSG...405'）
+        fits = np.char.str_len(q) <= ks.dtype.itemsize // 4
+        q = np.where(fits, q, '').astype(ks.dtype)
+        j = np.minimum(np.searchsorted(ks, q), len(ks) - 1)
+        hit = fits & (ks[j] == q)
+        return np.where(hit, np.asarray(order[j]), -1)
+
+    def rank_of(self, key):
+        """名次（1-based），不在库中返回 None"""
+        r = int(self.rows_of([key])[0])
+        return r + 1 if r >= 0 else None
+
+    def frame(self, rows, columns=None):
+        """按行号取出若干列 -> DataFrame（索引为键，含 rank 列）"""
+        import numpy as np
+        import pandas as pd
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = self.columns if columns is None else list(columns)
+        data = {'rank': rows + 1}
+        for c in cols:
+            data[c] = np.asarray(self.column(c)[rows])
+        return pd.DataFrame(data, index=pd.Index(np.asarray(self._load('keys.npy')[rows]), name=self.meta['key']))
+
+    def lookup(self, keys, columns=None):
+        """键列表 -> DataFrame（找不到的键不出现）"""
+        r = self.rows_of(keys)
+        return self.frame(r[r >= 0], columns)
+
+    def _mask(self, s, where):
+        import numpy as np
+        ok = np.ones(s.stop - s.start, dtype=bool)
+        for col, op, val in where:
+            x = np.asarray(self.column(col)[s])
+            v = val if x.dtype.kind == 'U' else (val.lower() in ('1', 'true') if x.dtype.kind == 'b' else float(val))
+            ok &= getattr(x, f'__{_OPS[op]}__')(v)
+        return ok
+
+    def top_k(self, k, where=None, columns=None):
+        """名次前 k 且满足全部过滤条件的行；按名次顺序分块扫描，够 k 行即停"""
+        import numpy as np
+        where = parse_where(where) if where and isinstance(where[0], str) else (where or [])
+        hits = []
+        for a in range(0, self.n, SCAN_ROWS):
+            s = slice(a, min(a + SCAN_ROWS, self.n))
+            hits.append(a + np.flatnonzero(self._mask(s, where)) if where else np.arange(s.start, s.stop))
+            if sum(len(h) for h in hits) >= k:
+                break
+        rows = np.concatenate(hits)[:k] if hits else np.zeros(0, dtype=np.int64)
+        return self.frame(rows, columns)
+
+    def join(self, df, other, columns=None, prefix=None):
+        """df（索引为键，如 top_k 的结果）按键左连接另一个库的若干列（含其 rank，列名加前缀）"""
+        import numpy as np
+        other = other if isinstance(other, ResultStore) else ResultStore(other)
+        prefix = prefix if prefix is not None else (other.meta.get('kind') or os.path.basename(other.path)) + '_'
+        cols = other.columns if columns is None else list(columns)
+        r = other.rows_of(df.index)
+        out = df.copy()
+        ok = r >= 0
+        out[prefix + 'rank'] = np.where(ok, r + 1, -1)
+        for c in cols:
+            v = other.column(c)
+            col = np.asarray(v[np.where(ok, r, 0)]) if len(v) else np.zeros(len(r))
+            if col.dtype.kind == 'f':
+                col = np.where(ok, col, np.nan)
+            elif col.dtype.kind in 'iub':
+                col = np.where(ok, col.astype(np.float64), np.nan)
+            else:
+                col = np.where(ok, col, '')
+            out[prefix + c] = col
+        return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Query a columnar results store (TANK ranking, M4 DE / cutpoint tables)')
+    ap.add_argument('store', help='<name>.res directory (written next to TANK_ranked.tsv / M4 tables)')
+    ap.add_argument('--gene', nargs='*', default=[], help='keys to look up (rank + columns)')
+    ap.add_argument('--top', type=int, default=0, help='top-K rows (after --where filters)')
+    ap.add_argument('--where', nargs='*', default=[], help="filters such as 'detect_prop>=0.3' 'fdr_mod<0.05'")
+    ap.add_argument('--columns', nargs='*', default=None, help='columns to show (default: all)')
+    ap.add_argument('--join', nargs='*', default=[], help='other stores joined on the key')
+    ap.add_argument('--join_columns', nargs='*', default=None, help='columns taken from the joined stores (each store contributes those it has)')
+    ap.add_argument('--out', default='', help='write the result as TSV')
+    ap.add_argument('--info', action='store_true', help='print store metadata and columns')
+    args = ap.parse_args()
+
+    import pandas as pd
+    st = ResultStore(args.store)
+    if args.info or not (args.gene or args.top):
+        print(f"{args.store}: {st.n} rows, key={st.meta['key']}, kind={st.meta.get('kind') or '-'}, "
+              f"sorted by {st.meta.get('sort_by') or 'row order'}")
+        for c, m in st.meta['columns'].items():
+            print(f'  {c}\t{m["dtype"]}')
+        if not (args.gene or args.top):
+            return
+    parts = []
+    if args.gene:
+        found = st.lookup(args.gene, args.columns)
+        missing = [g for g in args.gene if g not in set(found.index)]
+        if missing:
+            print('[WARN] not in store:', ', '.join(missing))
+        parts.append(found)
+    if args.top:
+        parts.append(st.top_k(args.top, args.where, args.columns))
+    res = pd.concat(parts) if len(parts) > 1 else parts[0]
+    for other in args.join:
+        ot = ResultStore(other)
+        cols = None if args.join_columns is None else [c for c in args.join_columns if c in ot.columns]
+        res = st.join(res, ot, cols)
+    with pd.option_context('display.width', 200, 'display.max_columns', 30):
+        print(res.to_string())
+    if args.out:
+        res.to_csv(args.out, sep='\t')
+        print(' -', args.out)
+
+
+if __name__ == '__main__':
+    main()
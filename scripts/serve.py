@@ -0,0 +1,337 @@
+# scripts/serve.py
+# 常驻分析服务：表达矩阵、样本分组（TCGA 条形码）、生存表只加载一次，之后在本机 HTTP 上毫秒级回答查询。
+# ThreadingHTTPServer 每个请求一个线程（numpy / BLAS 计算期间释放 GIL）；结果按 (接口, 参数) 做 LRU 缓存，
+# TANK 全基因排名按配置缓存（同一配置只算一次，之后查任意基因的名次都是字典查找）。
+#
+#   GET /health
+#   GET /rank?gene=CLDN18&stat=var&log1p=0&min_detect_prop=0.1&detect_thresh=1.0&dup_agg=none   TANK 名次（同 tank_rank.py）
+#   GET /summary?gene=ENSG00000066405                                              tumor / normal 汇总 + Welch t
+#   GET /survival?gene=CLDN18&cut=median|optimal&minprop=0.1                       KM 分组 log-rank（同 m4_km_stad）
+#   GET /immune?gene=CLDN18                                                        免疫代理 Spearman（同 m4_immune_proxy）
+#
+#   python scripts/serve.py --expr data/TCGA-STAD.star_counts.mat --pheno data/TCGA-STAD_curated_survival.txt
+#   curl 'http://127.0.0.1:8765/rank?gene=CLDN18'
+import os, sys, json, time, argparse, threading
+from collections import OrderedDict
+
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(BASE, 'M1_antigen_discovery'))
+sys.path.insert(0, os.path.join(BASE, 'M4_feedback_simulation', 'scripts'))
+PROBEMAP = os.path.join(BASE, 'M1_antigen_discovery', 'gencode.v36.annotation.gtf.gene.probemap')
+
+DEFAULT_PORT = 8765
+CACHE_SIZE = 4096
+IMMUNE_GENES = ["ENSG00000153563", "ENSG00000172116", "ENSG00000100479", "ENSG00000180644"]  # CD8A/B,GZMB,PRF1
+
+
+class QueryError(Exception):
+    """参数或基因无效（HTTP 400 / 404）"""
+
+    def __init__(self, msg, status=400):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+class ResultCache(object):
+    """线程安全的 LRU（键为接口名 + 排序后的参数）"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+class Store(object):
+    """常驻数据：float64 表达矩阵（基因 x 样本）、基因 / symbol 索引、tumor/normal 分组、barcode15 与生存对齐"""
+
+    def __init__(self, expr, pheno=None, probemap=PROBEMAP, workers=None):
+        import numpy as np
+        import pandas as pd
+        from star_reader import read_star_matrix, is_log_scale
+        from tcga_samples import sample_group, barcode15
+        df = read_star_matrix(expr, workers=workers, dtype=np.float64)
+        self.expr_path = expr
+        self.X = df.to_numpy()
+        self.genes = np.asarray(df.index)
+        self.samples = np.asarray(df.columns)
+        # 重复 ID（去版本号后的 _PAR_Y 等）全部保留给 TANK 排名（同 tank_rank 的 dup_agg）；单基因查询取第一行
+        self.row = {}
+        for i, g in enumerate(self.genes):
+            self.row.setdefault(g, i)
+        self.symbol = {}
+        if probemap and os.path.exists(probemap):
+            pm = pd.read_csv(probemap, sep='\t', usecols=[0, 1])
+            pm.columns = ['ensembl', 'gene']
+            for e, s in zip(pm['ensembl'].str.split('.').str[0], pm['gene']):
+                if e in self.row:
+                    self.symbol.setdefault(s, e)
+        self.log_scale = is_log_scale(expr)
+        grp = [sample_group(s) for s in self.samples]
+        self.tumor = np.array([g == 'tumor' for g in grp])
+        self.normal = np.array([g == 'normal' for g in grp])
+        # barcode15 取均值（与 m4_km_stad / m4_immune_proxy 一致）：样本 -> barcode15 的平均矩阵
+        codes, self.b15 = pd.factorize(pd.Index([barcode15(s) for s in self.samples]))
+        A = np.zeros((len(self.samples), len(self.b15)))
+        A[np.arange(len(codes)), codes] = 1.0
+        self.avg = A / A.sum(axis=0)
+        self.surv = None
+        if pheno:
+            from m4_km_stad import load_survival, merge_survival
+            df15 = pd.DataFrame({'pos': np.arange(len(self.b15))}, index=self.b15)
+            self.surv = merge_survival(df15, load_survival(pheno)).reset_index(drop=True)
+        self.rank_lock = threading.Lock()
+        self.rankings = {}
+        self.proxy_lock = threading.Lock()
+        self.proxy = None
+
+    def resolve(self, gene):
+        if not gene:
+            raise QueryError('missing parameter: gene')
+        key = gene.split('.')[0] if gene.startswith('ENSG') else gene
+        if key in self.row:
+            return key, self.row[key]
+        if key in self.symbol:
+            return self.symbol[key], self.row[self.symbol[key]]
+        raise QueryError(f'gene not in matrix: {gene}', 404)
+
+    def per_patient(self, x):
+        """单个基因：log1p（缓存已是 log 尺度时跳过）后按 barcode15 取均值"""
+        import numpy as np
+        x = x if self.log_scale else np.log1p(x)
+        return x @ self.avg
+
+    # ---- TANK ----
+    def ranking(self, stat='var', log1p=False, min_detect_prop=0.1, detect_thresh=1.0, winsor_alpha=0.01, dup_agg='none'):
+        """与 tank_rank.main 相同的去重 / 过滤 / 变换 / 打分，返回按 score 降序的 DataFrame（按配置缓存）"""
+        import numpy as np
+        import pandas as pd
+        from tank_rank import detect_filter, score_frame, drop_duplicates
+        cfg = (stat, bool(log1p and not self.log_scale), float(min_detect_prop), float(detect_thresh), float(winsor_alpha),
+               dup_agg)
+        with self.rank_lock:
+            if cfg in self.rankings:
+                return self.rankings[cfg]
+            stat, log1p, min_detect_prop, detect_thresh, winsor_alpha, dup_agg = cfg
+            df = drop_duplicates(pd.DataFrame(self.X, index=self.genes, copy=False), how=dup_agg)
+            df = detect_filter(df, detect_thresh, min_detect_prop)
+            if log1p:
+                df = np.log1p(df)
+            ranked = score_frame(df, stat, winsor_alpha, detect_thresh, min_detect_prop).sort_values('score', ascending=False)
+            ranked['rank'] = np.arange(1, len(ranked) + 1)
+            self.rankings[cfg] = ranked
+            return ranked
+
+    def rank(self, gene, stat='var', log1p='0', min_detect_prop='0.1', detect_thresh='1.0', winsor_alpha='0.01',
+             dup_agg='none'):
+        if stat not in ('var', 'mad', 'winsor'):
+            raise QueryError("stat must be one of var / mad / winsor")
+        if dup_agg not in ('none', 'mean', 'sum', 'max', 'first'):
+            raise QueryError("dup_agg must be one of none / mean / sum / max / first")
+        gid, _ = self.resolve(gene)
+        ranked = self.ranking(stat, log1p in ('1', 'true', 'yes'), float(min_detect_prop), float(detect_thresh),
+                              float(winsor_alpha), dup_agg)
+        out = {'gene': gid, 'n_genes': int(len(ranked)), 'stat': stat}
+        if gid not in ranked.index:
+            out.update(rank=None, note='filtered out by min_detect_prop / detect_thresh')
+            return out
+        r = ranked.loc[[gid]].iloc[0]  # dup_agg=none 时重复 ID 取名次最高的一行
+        out.update(rank=int(r['rank']), percentile=100.0 * float(r['rank']) / len(ranked),
+                   score=float(r['score']), mean=float(r['mean']), detect_prop=float(r['detect_prop']))
+        return out
+
+    # ---- tumor / normal ----
+    def summary(self, gene):
+        import numpy as np
+        from scipy import stats
+        gid, i = self.resolve(gene)
+        x = self.X[i]
+        out = {'gene': gid}
+        for name, m in (('tumor', self.tumor), ('normal', self.normal)):
+            v = x[m]
+            out[name] = {'n': int(len(v)), 'mean': float(v.mean()) if len(v) else None,
+                         'median': float(np.median(v)) if len(v) else None,
+                         'sd': float(v.std(ddof=1)) if len(v) > 1 else None,
+                         'detect': float((v > 0).mean()) if len(v) else None}
+        if self.tumor.sum() > 1 and self.normal.sum() > 1:
+            t, p = stats.ttest_ind(x[self.tumor], x[self.normal], equal_var=False)
+            out.update(logFC=float(x[self.tumor].mean() - x[self.normal].mean()), t_welch=float(t), p_welch=float(p))
+        return out
+
+    # ---- survival ----
+    def survival(self, gene, cut='median', minprop='0.1'):
+        import numpy as np
+        if self.surv is None:
+            raise QueryError('no survival table loaded (start the service with --pheno)', 404)
+        if cut not in ('median', 'optimal'):
+            raise QueryError('cut must be median or optimal')
+        gid, i = self.resolve(gene)
+        x = self.per_patient(self.X[i])[self.surv['pos'].to_numpy()]
+        time_, event = self.surv['time'].to_numpy(dtype=float), self.surv['event'].to_numpy(dtype=float)
+        out = {'gene': gid, 'n': int(len(x)), 'events': int(event.sum()), 'cut_method': cut}
+        if cut == 'optimal':
+            from m4_cutpoint_scan import logrank_scan
+            scan = logrank_scan(x, time_, event, minprop=float(minprop))
+            if scan is None:
+                raise QueryError(f'no admissible cutpoint for {gid}', 404)
+            c = scan['cutpoint']
+            out.update(p_lau92=scan['p_lau92'], p_lau94=scan['p_lau94'], z=scan['z'])
+        else:
+            c = float(np.median(x))
+        high = x >= c
+        if high.all() or not high.any():
+            raise QueryError(f'{gid}: degenerate split at {c:.4g}', 404)
+        from lifelines.statistics import logrank_test
+        p = logrank_test(time_[high], time_[~high], event_observed_A=event[high], event_observed_B=event[~high]).p_value
+        out.update(cutpoint=float(c), n_high=int(high.sum()), n_low=int((~high).sum()),
+                   events_high=int(event[high].sum()), events_low=int(event[~high].sum()), p_logrank=float(p))
+        return out
+
+    # ---- immune proxy ----
+    def immune(self, gene):
+        import numpy as np
+        from scipy.stats import spearmanr
+        gid, i = self.resolve(gene)
+        with self.proxy_lock:
+            if self.proxy is None:
+                missing = [g for g in IMMUNE_GENES if g not in self.row]
+                if missing:
+                    raise QueryError('immune proxy genes missing from matrix: ' + ', '.join(missing), 404)
+                imm = np.vstack([self.per_patient(self.X[self.row[g]]) for g in IMMUNE_GENES])
+                z = (imm - imm.mean(axis=1, keepdims=True)) / imm.std(axis=1, ddof=1, keepdims=True)
+                self.proxy = z.mean(axis=0)
+            proxy = self.proxy
+        x = self.per_patient(self.X[i])
+        ok = np.isfinite(x) & np.isfinite(proxy)
+        rho, p = spearmanr(x[ok], proxy[ok])
+        return {'gene': gid, 'n': int(ok.sum()), 'spearman_rho': float(rho), 'p': float(p)}
+
+    def health(self):
+        return {'expr': self.expr_path, 'genes': int(len(self.genes)), 'samples': int(len(self.samples)),
+                'tumor': int(self.tumor.sum()), 'normal': int(self.normal.sum()),
+                'survival': None if self.surv is None else int(len(self.surv)),
+                'tank_configs_cached': len(self.rankings)}
+
+
+ENDPOINTS = ('rank', 'summary', 'survival', 'immune')
+
+
+def json_safe(obj):
+    """NaN / inf -> None（标准 JSON 没有 NaN；如常数基因的 p_welch）"""
+    if isinstance(obj, float):
+        return obj if obj == obj and obj not in (float('inf'), float('-inf')) else None
+    if isinstance(obj, dict):
+        return {k: json_safe(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [json_safe(v) for v in obj]
+    return obj
+
+
+def make_handler(store, cache):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status, obj):
+            body = json.dumps(json_safe(obj), allow_nan=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            t0 = time.perf_counter()
+            u = urlparse(self.path)
+            name = u.path.strip('/')
+            params = {k: v[-1] for k, v in parse_qs(u.query).items()}
+            if name == 'health':
+                out = dict(store.health(), cache_hits=cache.hits, cache_misses=cache.misses)
+                return self._send(200, out)
+            if name not in ENDPOINTS:
+                return self._send(404, {'error': f'unknown endpoint /{name}', 'endpoints': ['health', *ENDPOINTS]})
+            key = (name, tuple(sorted(params.items())))
+            res, cached = cache.get(key), True
+            try:
+                if res is None:
+                    cached = False
+                    res = getattr(store, name)(**params)
+                    cache.put(key, res)
+            except QueryError as e:
+                return self._send(e.status, {'error': str(e)})
+            except (TypeError, ValueError) as e:
+                return self._send(400, {'error': f'bad parameters: {e}'})
+            except Exception as e:
+                # 其余异常（LinAlgError、lifelines 报错等）也要回一个响应，不能让连接直接断掉
+                self.log_error('%s failed: %s: %s', self.path, type(e).__name__, e)
+                return self._send(500, {'error': f'{type(e).__name__}: {e}'})
+            self._send(200, dict(res, cached=cached, ms=round(1000 * (time.perf_counter() - t0), 3)))
+
+        def log_message(self, fmt, *a):
+            if not self.server.quiet:
+                sys.stderr.write('[serve] ' + fmt % a + '\n')
+
+    return Handler
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Resident localhost service: expression matrix stays loaded, queries answered over HTTP')
+    ap.add_argument('--expr', required=True, help='STAR matrix or star_reader cache dir (cache loads fastest)')
+    ap.add_argument('--pheno', help='survival table (enables /survival)')
+    ap.add_argument('--probemap', default=PROBEMAP, help='gencode probemap for symbol lookups')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=DEFAULT_PORT)
+    ap.add_argument('--cache_size', type=int, default=CACHE_SIZE)
+    ap.add_argument('--preload', action='store_true', help='compute the default TANK ranking before serving')
+    ap.add_argument('--quiet', action='store_true', help='no per-request log lines')
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    from http.server import ThreadingHTTPServer
+    with span('load') as sp:
+        store = Store(args.expr, args.pheno, args.probemap)
+        sp.shape(store.X)
+    with span('warmup'):
+        # 首次查询不再付 scipy / lifelines 的导入开销
+        import scipy.stats, lifelines.statistics  # noqa: F401
+        if args.preload:
+            store.ranking()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(store, ResultCache(args.cache_size)))
+    server.daemon_threads = True
+    server.quiet = args.quiet
+    h = store.health()
+    print(f'[OK] 服务已启动 http://{args.host}:{server.server_port}  '
+          f'({h["genes"]} 基因 x {h["samples"]} 样本, tumor={h["tumor"]} normal={h["normal"]}, survival={h["survival"]})')
+    print('  接口: /health /rank /summary /survival /immune   (Ctrl-C 退出)')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
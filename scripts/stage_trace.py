@@ -0,0 +1,188 @@
+# scripts/stage_trace.py
+"""
+轻量的分阶段计时 / 内存记录（仅依赖标准库）。
+
+    from stage_trace import span, traced, add_trace_args, setup_trace
+    with span("load") as sp:
+        df = pd.read_csv(...)
+        sp.shape(df)            # 记录行/列数
+
+开启方式（默认关闭，关闭时 span() 返回共享的空对象，开销可忽略）：
+  - 环境变量 AICAR_TRACE=<trace.json 或目录>，AICAR_PROFILE=<cProfile 输出 .prof>
+  - 或脚本参数 --trace / --profile（见 add_trace_args）
+目录形式时写入 <目录>/<脚本名>.trace.json，便于一条流水线多个脚本共用一个设置。
+输出 JSON：每个阶段的 wall_s / cpu_s / peak_rss_mb / rows / cols / 嵌套深度。
+"""
+import atexit, json, os, sys, time
+from datetime import datetime
+
+ENV_TRACE = "AICAR_TRACE"
+ENV_PROFILE = "AICAR_PROFILE"
+
+_state = {"enabled": False, "trace": None, "profile": None, "profiler": None,
+          "spans": [], "stack": [], "t0": None, "registered": False}
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r / (1024.0 * 1024.0) if sys.platform == "darwin" else r / 1024.0
+    except ImportError:
+        return None
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def shape(self, obj):
+        return obj
+
+    def set(self, **kw):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ("name", "info", "w0", "c0")
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+        _state["stack"].append(self.name)
+        self.w0 = time.perf_counter()
+        self.c0 = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.w0
+        cpu = time.process_time() - self.c0
+        _state["stack"].pop()
+        rec = {"stage": self.name, "parent": "/".join(_state["stack"]) or None,
+               "start_s": round(self.w0 - _state["t0"], 6), "wall_s": round(wall, 6), "cpu_s": round(cpu, 6),
+               "peak_rss_mb": _peak_rss_mb()}
+        rec.update(self.info)
+        if exc_type is not None:
+            rec["error"] = exc_type.__name__
+        _state["spans"].append(rec)
+        return False
+
+    def shape(self, obj):
+        """记录 DataFrame/ndarray 的行列数，原样返回对象"""
+        shp = getattr(obj, "shape", None)
+        if shp is not None:
+            self.info["rows"] = int(shp[0])
+            if len(shp) > 1:
+                self.info["cols"] = int(shp[1])
+        else:
+            try:
+                self.info["rows"] = len(obj)
+            except TypeError:
+                pass
+        return obj
+
+    def set(self, **kw):
+        self.info.update(kw)
+
+
+def enabled():
+    return _state["enabled"]
+
+
+def span(name, **info):
+    if not _state["enabled"]:
+        return _NULL
+    return _Span(name, dict(info))
+
+
+def traced(name=None):
+    """装饰器版本：@traced("score")"""
+    def deco(fn):
+        label = name or fn.__name__
+
+        def wrapper(*a, **kw):
+            if not _state["enabled"]:
+                return fn(*a, **kw)
+            with _Span(label, {}):
+                return fn(*a, **kw)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        wrapper.__wrapped__ = fn
+        return wrapper
+    return deco
+
+
+def _trace_file(path):
+    if path and (os.path.isdir(path) or path.endswith(os.sep)):
+        script = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+        return os.path.join(path, f"{script}.trace.json")
+    return path
+
+
+def enable(trace=None, profile=None):
+    if _state["enabled"]:
+        # 已由环境变量开启：命令行参数优先
+        if trace:
+            _state["trace"] = _trace_file(trace)
+        if not profile or _state["profiler"] is not None:
+            return
+    else:
+        _state.update(enabled=True, trace=_trace_file(trace), t0=time.perf_counter())
+    _state["profile"] = profile
+    if profile:
+        import cProfile
+        _state["profiler"] = cProfile.Profile()
+        _state["profiler"].enable()
+    if not _state["registered"]:
+        atexit.register(flush)
+        _state["registered"] = True
+
+
+def flush():
+    """写出 trace JSON 和（可选）cProfile；进程退出时自动调用"""
+    if not _state["enabled"]:
+        return
+    prof = _state["profiler"]
+    if prof is not None:
+        prof.disable()
+        os.makedirs(os.path.dirname(os.path.abspath(_state["profile"])), exist_ok=True)
+        prof.dump_stats(_state["profile"])
+        _state["profiler"] = None
+    if _state["trace"]:
+        doc = {"script": os.path.basename(sys.argv[0]) if sys.argv else None, "argv": sys.argv[1:],
+               "finished": datetime.now().isoformat(timespec="seconds"),
+               "total_wall_s": round(time.perf_counter() - _state["t0"], 6),
+               "total_cpu_s": round(time.process_time(), 6), "peak_rss_mb": _peak_rss_mb(),
+               "profile": _state["profile"], "spans": _state["spans"]}
+        os.makedirs(os.path.dirname(os.path.abspath(_state["trace"])), exist_ok=True)
+        with open(_state["trace"], "w", encoding="utf-8") as f:
+            json.dump(doc, f, indent=2)
+    _state["enabled"] = False
+
+
+def add_trace_args(ap):
+    ap.add_argument("--trace", help=f"write per-stage timing JSON here (or set {ENV_TRACE})")
+    ap.add_argument("--profile", help=f"also dump cProfile stats here (or set {ENV_PROFILE})")
+    return ap
+
+
+def setup_trace(args=None):
+    trace = getattr(args, "trace", None) or os.environ.get(ENV_TRACE) or None
+    profile = getattr(args, "profile", None) or os.environ.get(ENV_PROFILE) or None
+    if trace or profile:
+        enable(trace, profile)
+
+
+# 仅通过环境变量开启时（例如没有 argparse 的脚本），导入即生效
+if os.environ.get(ENV_TRACE) or os.environ.get(ENV_PROFILE):
+    setup_trace()
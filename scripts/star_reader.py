@@ -0,0 +1,215 @@
+# scripts/star_reader.py
+# STAR counts 矩阵（基因 x 样本，TSV / TSV.GZ / CSV）的并行读取引擎（首次加载比 pd.read_csv 快）：
+#   - 主线程流水线式解压（zlib 解压时释放 GIL），切成按行对齐的文本块；
+#   - 线程池并行解析各块（pandas C 解析器在分词 / 转浮点阶段释放 GIL），解析时即去掉 Ensembl 版本号；
+#   - 全部块解析完后按总行数一次性分配 float32（或指定 dtype）数组，按顺序拷入。
+# 另提供二进制矩阵缓存（目录：matrix.npy + genes.txt + samples.txt + meta.json），
+# read_star_matrix 直接识别缓存目录，可 mmap 读取；后续归一化 / QC / 批次校正都写这种格式。
+#
+#   python scripts/star_reader.py --expr data/TCGA-STAD.star_counts.tsv.gz --out data/TCGA-STAD.star_counts.mat
+import os, argparse, json
+
+# numpy / pandas 在函数内按需导入，保证 --help 与 aicar.py 分发秒开
+
+BLOCK_BYTES = 8 << 20          # 每个解析块约 8 MB 文本
+CACHE_MATRIX = 'matrix.npy'
+CACHE_GENES = 'genes.txt'
+CACHE_SAMPLES = 'samples.txt'
+CACHE_META = 'meta.json'
+
+
+def default_workers():
+    return max(1, min(8, os.cpu_count() or 1))
+
+
+def is_matrix_cache(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, CACHE_MATRIX))
+
+
+def open_binary(path):
+    if str(path).endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def strip_version_ids(ids):
+    """ENSG00000066405.13 -> ENSG00000066405（只处理 ENSG 前缀，与 tank_rank 的规则一致）"""
+    return [s.split('.', 1)[0] if s.startswith('ENSG') else s for s in ids]
+
+
+def iter_line_blocks(f, block_bytes=BLOCK_BYTES):
+    """按字节读入，切在最后一个换行处；尾部残行留给下一块"""
+    rest = b''
+    while True:
+        buf = f.read(block_bytes)
+        if not buf:
+            break
+        buf = rest + buf
+        cut = buf.rfind(b'\n')
+        if cut < 0:
+            rest = buf
+            continue
+        rest = buf[cut + 1:]
+        yield buf[:cut + 1]
+    if rest.strip():
+        yield rest
+
+
+def parse_block(block, sep, ncols, dtype, strip_version):
+    """一个文本块 -> (行 ID 列表, ndarray[rows x ncols])"""
+    import io
+    import numpy as np
+    import pandas as pd
+    dtypes = {0: str}
+    dtypes.update({i: dtype for i in range(1, ncols + 1)})
+    df = pd.read_csv(io.BytesIO(block), sep=sep, header=None, index_col=0, dtype=dtypes,
+                     engine='c', low_memory=False)
+    if df.shape[1] != ncols:
+        raise ValueError(f"expected {ncols} value columns, got {df.shape[1]}")
+    ids = df.index.astype(str).tolist()
+    if strip_version:
+        ids = strip_version_ids(ids)
+    return ids, df.to_numpy(dtype=dtype, copy=False)
+
+
+def read_star_text(path, workers=None, strip_version=True, dtype=None, block_bytes=BLOCK_BYTES):
+    import numpy as np
+    import pandas as pd
+    from collections import deque
+    from itertools import chain
+    from concurrent.futures import ThreadPoolExecutor
+    dtype = np.dtype(dtype or np.float32)
+    workers = workers or default_workers()
+    with open_binary(path) as f:
+        header = f.readline().decode('utf-8').rstrip('\r\n')
+        if not header:
+            raise SystemExit(f"Empty expression matrix: {path}")
+        sep = '\t' if header.count('\t') >= header.count(',') else ','
+        names = header.split(sep)
+        blocks = iter_line_blocks(f, block_bytes)
+        first = next(blocks, None)
+        if first is None:
+            raise SystemExit(f"Expression matrix has a header but no rows: {path}")
+        # 表头比数据行少一列时（R write.table 风格），表头全部是样本名
+        width = first[:first.find(b'\n') if b'\n' in first else len(first)].decode('utf-8').count(sep) + 1
+        if width == len(names) + 1:
+            index_name, samples = None, names
+        else:
+            index_name, samples = names[0] or None, names[1:]
+        ncols = len(samples)
+
+        parts = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            for blk in chain([first], blocks):
+                pending.append(ex.submit(parse_block, blk, sep, ncols, dtype, strip_version))
+                # 限制在途块数，解压不会无限领先于解析
+                while len(pending) > 2 * workers:
+                    parts.append(pending.popleft().result())
+            while pending:
+                parts.append(pending.popleft().result())
+
+    nrows = sum(len(ids) for ids, _ in parts)
+    X = np.empty((nrows, ncols), dtype=dtype)
+    ids_all = []
+    r = 0
+    for ids, vals in parts:
+        X[r:r + len(ids)] = vals
+        r += len(ids)
+        ids_all.extend(ids)
+    parts.clear()
+    return pd.DataFrame(X, index=pd.Index(ids_all, name=index_name),
+                        columns=pd.Index(samples), copy=False)
+
+
+def create_matrix_cache(outdir, genes, samples, dtype='float32', index_name=None, extra=None):
+    """先写 genes / samples / meta，返回 matrix.npy 的可写 memmap，供按基因块流式写入"""
+    import numpy as np
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, CACHE_GENES), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(map(str, genes)) + '\n')
+    with open(os.path.join(outdir, CACHE_SAMPLES), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(map(str, samples)) + '\n')
+    meta = {'index_name': index_name, 'shape': [len(genes), len(samples)], 'dtype': str(np.dtype(dtype))}
+    meta.update(extra or {})
+    with open(os.path.join(outdir, CACHE_META), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=1)
+    return np.lib.format.open_memmap(os.path.join(outdir, CACHE_MATRIX), mode='w+', dtype=dtype,
+                                     shape=(len(genes), len(samples)))
+
+
+def save_matrix_cache(df, outdir, extra=None):
+    """DataFrame(基因 x 样本) -> 缓存目录；extra 写入 meta.json（如归一化方法）"""
+    X = df.to_numpy()
+    M = create_matrix_cache(outdir, df.index, df.columns, dtype=X.dtype, index_name=df.index.name, extra=extra)
+    M[:] = X
+    M.flush()
+    del M
+    return outdir
+
+
+def _read_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [s.rstrip('\r\n') for s in f if s.strip()]
+
+
+def load_matrix_cache(path, mmap=False, strip_version=True, dtype=None):
+    import numpy as np
+    import pandas as pd
+    X = np.load(os.path.join(path, CACHE_MATRIX), mmap_mode='r' if mmap else None)
+    if dtype is not None and X.dtype != np.dtype(dtype):
+        X = X.astype(dtype)
+    genes = _read_lines(os.path.join(path, CACHE_GENES))
+    samples = _read_lines(os.path.join(path, CACHE_SAMPLES))
+    meta = read_cache_meta(path)
+    if strip_version:
+        genes = strip_version_ids(genes)
+    return pd.DataFrame(X, index=pd.Index(genes, name=meta.get('index_name')),
+                        columns=pd.Index(samples), copy=False)
+
+
+def read_cache_meta(path):
+    p = os.path.join(path, CACHE_META)
+    if not os.path.exists(p):
+        return {}
+    with open(p, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def is_log_scale(path):
+    """缓存目录里的矩阵已是对数尺度（m1_normalize 的 log2 / VST 输出）时，下游不应再做 log1p"""
+    return is_matrix_cache(path) and bool(read_cache_meta(path).get('log_scale', False))
+
+
+def read_star_matrix(path, workers=None, strip_version=True, dtype=None, mmap=False):
+    """
+    读入 基因 x 样本 表达矩阵，返回 DataFrame（默认 float32）。
+    path 可以是 .tsv / .tsv.gz / .csv 文本，也可以是 save_matrix_cache 写出的缓存目录。
+    """
+    if is_matrix_cache(path):
+        return load_matrix_cache(path, mmap=mmap, strip_version=strip_version, dtype=dtype)
+    return read_star_text(path, workers=workers, strip_version=strip_version, dtype=dtype)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Parallel STAR counts reader; converts a text matrix into the binary matrix cache')
+    ap.add_argument('--expr', required=True, help='genes x samples matrix (.tsv/.tsv.gz/.csv)')
+    ap.add_argument('--out', help='cache directory (default: <expr>.mat)')
+    ap.add_argument('--workers', type=int, default=default_workers())
+    ap.add_argument('--dtype', choices=['float32', 'float64'], default='float32')
+    ap.add_argument('--keep_version', action='store_true', help='keep Ensembl version suffixes')
+    args = ap.parse_args()
+
+    from stage_trace import span
+    with span('load') as sp:
+        df = sp.shape(read_star_matrix(args.expr, workers=args.workers, strip_version=not args.keep_version,
+                                       dtype=args.dtype))
+    out = args.out or (args.expr[:-3] if args.expr.endswith('.gz') else args.expr) + '.mat'
+    with span('write'):
+        save_matrix_cache(df, out, extra={'source': os.path.abspath(args.expr)})
+    print(f'[OK] {df.shape[0]} genes x {df.shape[1]} samples ({args.dtype}) -> {out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# scripts/tcga_samples.py
+# TCGA 条形码解析（仅标准库）：样本类型、病人 / 样本级截断、测序板号（批次）。
+#   TCGA-AB-1234-01A-11R-A29S-31
+#   项目-TSS-参与者-样本类型+vial-portion+analyte-plate-center
+import re
+
+# https://gdc.cancer.gov/resources-tcga-users/tcga-code-tables/sample-type-codes
+SAMPLE_TYPES = {
+    "01": "Primary Tumor", "02": "Recurrent Tumor", "03": "Primary Blood Derived Cancer",
+    "05": "Additional - New Primary", "06": "Metastatic", "07": "Additional Metastatic",
+    "10": "Blood Derived Normal", "11": "Solid Tissue Normal", "12": "Buccal Cell Normal",
+}
+TUMOR, NORMAL = "Primary Tumor", "Solid Tissue Normal"
+
+
+def barcode15(x):
+    """样本级（TCGA-XX-XXXX-01A 的前 15 位：TCGA-XX-XXXX-01）"""
+    return str(x)[:15]
+
+
+def patient_id(x):
+    return str(x)[:12]
+
+
+def sample_type_code(barcode):
+    parts = str(barcode).split("-")
+    if len(parts) >= 4:
+        code = re.sub(r"[^0-9]", "", parts[3])[:2]
+        if len(code) == 2:
+            return code
+    return None
+
+
+def sample_type(barcode):
+    """'01' -> Primary Tumor，'11' -> Solid Tissue Normal；无法解析返回 None"""
+    return SAMPLE_TYPES.get(sample_type_code(barcode))
+
+
+def sample_group(barcode):
+    """粗分组：tumor（01-09）/ normal（10-19）/ None"""
+    code = sample_type_code(barcode)
+    if code is None:
+        return None
+    n = int(code)
+    if 1 <= n <= 9:
+        return "tumor"
+    if 10 <= n <= 19:
+        return "normal"
+    return None
+
+
+def assign_groups(samples, tumor_codes, normal_codes):
+    """按样本类型代码分组 -> int8 数组：1 = tumor_codes，0 = normal_codes，-1 = 其他（numpy 在函数内导入）"""
+    import numpy as np
+    codes = [sample_type_code(s) for s in samples]
+    g = np.full(len(samples), -1, dtype=np.int8)
+    g[[c in tumor_codes for c in codes]] = 1
+    g[[c in normal_codes for c in codes]] = 0
+    return g
+
+
+def plate_id(barcode):
+    """测序板号（第 6 段，如 A29S），作为批次标签；缺失返回 None"""
+    parts = str(barcode).split("-")
+    return parts[5] if len(parts) >= 6 and parts[5] else None
@@ -0,0 +1,208 @@
+# scripts/tx2gene.py
+# 转录本 -> 基因聚合（稀疏映射），保留指定基因的异构体行（如 CLDN18.1 / CLDN18.2）。
+# 映射来自本地 gencode 注释（GTF 的 transcript 行，或 transcript<TAB>gene 的两列表 / Xena transcript probemap），
+# 构造成 基因 x 转录本 的 0/1 稀疏矩阵 M，一次稀疏乘法 M @ X 完成全部聚合；
+# 聚合在线性尺度上做（log2(x+p) 先还原为 x，求和后再取 log2(x+p)），与输入同一尺度写出。
+# 输出为 star_reader 缓存目录：前面是基因行，后面是保留的异构体行（行名为去版本号的 ENST），
+# 另附 features.tsv（id / level / gene_id / gene_name / transcript_name / alias），
+# 因此 TANK、M4 safety 等可直接用 --targets ENST00000343735 / --gene ENST00000343735 分析 CLDN18.2。
+#
+#   python scripts/tx2gene.py --expr data/TCGA-STAD.transcript_tpm.tsv.gz --annotation gencode.v36.annotation.gtf.gz \
+#       --pseudocount 0.001 --isoforms CLDN18 --out dataprocessed/STAD_tx2gene.mat
+import os, sys, re, argparse
+
+from star_reader import read_star_matrix, create_matrix_cache, default_workers, open_binary
+from stage_trace import span, add_trace_args, setup_trace
+
+BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+proc_dir = os.path.join(BASE, 'dataprocessed')
+ANNOTATION = os.path.join(BASE, 'M1_antigen_discovery', 'gencode.v36.annotation.gtf.gz')
+FEATURES = 'features.tsv'
+CHUNK_SAMPLES = 64
+
+# 常用异构体别名（RefSeq NM_016369 = CLDN18.1 / A1.1 肺型，NM_001002026 = CLDN18.2 / A2.1 胃型）
+ISOFORM_ALIASES = {'ENST00000183605': 'CLDN18.1', 'ENST00000343735': 'CLDN18.2'}
+
+_ATTR = re.compile(r'(\S+) "([^"]*)"')
+
+
+def strip_version(ids):
+    """ENSG / ENST 的版本号去除（ENST00000343735.8 -> ENST00000343735；PAR_Y 后缀保留）"""
+    return [re.sub(r'^(ENS[GT]\d+)\.\d+', r'\1', str(s)) for s in ids]
+
+
+def parse_gtf(path):
+    """GTF（可 .gz）的 transcript 行 -> DataFrame(transcript_id, gene_id, gene_name, transcript_name, transcript_type)"""
+    import io
+    import pandas as pd
+    rows = []
+    with open_binary(path) as fb, io.TextIOWrapper(fb, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            parts = line.split('\t', 8)
+            if len(parts) < 9 or parts[2] != 'transcript':
+                continue
+            a = dict(_ATTR.findall(parts[8]))
+            rows.append((a.get('transcript_id'), a.get('gene_id'), a.get('gene_name'),
+                         a.get('transcript_name'), a.get('transcript_type')))
+    return pd.DataFrame(rows, columns=['transcript_id', 'gene_id', 'gene_name', 'transcript_name', 'transcript_type'])
+
+
+def load_tx2gene(path, cache_dir=proc_dir):
+    """
+    GTF 首次解析后缓存为 dataprocessed/tx2gene_<名字>.tsv（比 GTF 新则直接复用）；
+    也接受现成的表：前两列为 transcript / gene，可选 gene_name、transcript_name 列。
+    """
+    import pandas as pd
+    name = os.path.basename(path)
+    if '.gtf' in name:
+        cached = os.path.join(cache_dir, f'tx2gene_{name.split(".gtf")[0]}.tsv')
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+            tx = pd.read_csv(cached, sep='\t', dtype=str)
+        else:
+            tx = parse_gtf(path)
+            os.makedirs(cache_dir, exist_ok=True)
+            tx.to_csv(cached, sep='\t', index=False)
+    else:
+        tx = pd.read_csv(path, sep='\t', dtype=str)
+        tx = tx.rename(columns={tx.columns[0]: 'transcript_id', tx.columns[1]: 'gene_id'})
+        for c in ('gene_name', 'transcript_name', 'transcript_type'):
+            if c not in tx.columns:
+                tx[c] = None
+    tx['transcript_id'] = strip_version(tx['transcript_id'])
+    tx['gene_id'] = strip_version(tx['gene_id'])
+    return tx.drop_duplicates('transcript_id').set_index('transcript_id')
+
+
+def mapping_matrix(transcripts, tx):
+    """
+    基因 x 转录本 的 CSR 0/1 矩阵。返回 (M, genes, mapped)：genes 为出现过的基因（按注释顺序），
+    mapped 标记矩阵中能在注释里找到的转录本（其余不参与聚合）。
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
+    gene_of = tx['gene_id'].reindex(transcripts)
+    mapped = gene_of.notna().to_numpy()
+    codes, genes = pd.factorize(gene_of[mapped], sort=False)
+    cols = np.flatnonzero(mapped)
+    M = sparse.csr_matrix((np.ones(len(cols), dtype=np.float64), (codes, cols)),
+                          shape=(len(genes), len(transcripts)))
+    return M, np.asarray(genes), mapped
+
+
+def isoform_rows(transcripts, tx, keep):
+    """保留异构体的转录本位置：keep 为基因 ID / symbol 列表，或 ['all']"""
+    import numpy as np
+    if not keep:
+        return np.array([], dtype=np.int64)
+    info = tx.reindex(transcripts)
+    if 'all' in keep:
+        hit = info['gene_id'].notna()
+    else:
+        keep = set(strip_version(keep))
+        hit = info['gene_id'].isin(keep) | info['gene_name'].isin(keep)
+    idx = np.flatnonzero(hit.to_numpy())
+    order = np.lexsort((np.asarray(transcripts)[idx], info['gene_id'].to_numpy()[idx].astype(str)))
+    return idx[order]
+
+
+def aggregate_into(X, M, iso, out, input_scale='log2p1', pseudocount=1.0, workers=1):
+    """
+    按样本列块：线性化 -> M @ X（基因行）+ 异构体行原样拷贝 -> 还原为输入尺度，写入 out（memmap）。
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    G = M.shape[0]
+
+    def block(c):
+        x = np.asarray(X[:, c], dtype=np.float64)
+        lin = np.clip(np.exp2(x) - pseudocount, 0.0, None) if input_scale == 'log2' else x
+        g = M @ lin
+        out[:G, c] = np.log2(g + pseudocount) if input_scale == 'log2' else g
+        out[G:, c] = x[iso]
+
+    chunks = [slice(i, min(i + CHUNK_SAMPLES, X.shape[1])) for i in range(0, X.shape[1], CHUNK_SAMPLES)]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(block, chunks))
+
+
+def feature_table(genes, iso_ids, tx):
+    import pandas as pd
+    names = tx.reset_index().drop_duplicates('gene_id').set_index('gene_id')['gene_name']
+    g = pd.DataFrame({'id': genes, 'level': 'gene', 'gene_id': genes,
+                      'gene_name': names.reindex(genes).to_numpy(), 'transcript_name': None, 'alias': None})
+    info = tx.reindex(iso_ids)
+    t = pd.DataFrame({'id': iso_ids, 'level': 'transcript', 'gene_id': info['gene_id'].to_numpy(),
+                      'gene_name': info['gene_name'].to_numpy(), 'transcript_name': info['transcript_name'].to_numpy(),
+                      'alias': [ISOFORM_ALIASES.get(i) for i in iso_ids]})
+    return pd.concat([g, t], ignore_index=True)
+
+
+def read_features(cache_dir):
+    """tx2gene 输出缓存的 features.tsv（不存在返回 None）"""
+    import pandas as pd
+    path = os.path.join(cache_dir, FEATURES)
+    return pd.read_csv(path, sep='\t', dtype=str) if os.path.exists(path) else None
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Aggregate a transcript x samples matrix to genes (sparse tx->gene map), keeping isoform rows')
+    ap.add_argument('--expr', required=True, help='transcript x samples matrix (.tsv/.tsv.gz) or star_reader cache dir')
+    ap.add_argument('--annotation', default=ANNOTATION,
+                    help='gencode GTF (.gtf/.gtf.gz) or a transcript<TAB>gene table (e.g. Xena transcript probemap)')
+    ap.add_argument('--input_scale', choices=['log2', 'linear'], default='log2',
+                    help='log2: values are log2(x + pseudocount) (Xena / toil); linear: counts or TPM')
+    ap.add_argument('--pseudocount', type=float, default=1.0, help='1 for log2(count+1), 0.001 for toil log2(tpm+0.001)')
+    ap.add_argument('--isoforms', nargs='*', default=['CLDN18'],
+                    help="genes (symbol or Ensembl) whose transcript rows are kept; 'all' keeps every transcript")
+    ap.add_argument('--out', help='output cache dir (default: dataprocessed/<expr>_tx2gene.mat)')
+    ap.add_argument('--workers', type=int, default=default_workers())
+    add_trace_args(ap)
+    args = ap.parse_args()
+    setup_trace(args)
+
+    import numpy as np
+    if not os.path.exists(args.annotation):
+        raise SystemExit(f'找不到注释文件: {args.annotation}（请下载 gencode GTF 或用 --annotation 指定）')
+
+    with span('load') as sp:
+        df = sp.shape(read_star_matrix(args.expr, workers=args.workers, strip_version=False, mmap=True))
+        transcripts = strip_version(df.index)
+    with span('mapping') as sp:
+        tx = load_tx2gene(args.annotation)
+        M, genes, mapped = mapping_matrix(transcripts, tx)
+        iso = isoform_rows(transcripts, tx, args.isoforms)
+        iso_ids = [transcripts[i] for i in iso]
+        sp.shape(M)
+    if not mapped.any():
+        raise SystemExit('矩阵行名与注释中的 transcript_id 没有交集（请确认是转录本层矩阵）。')
+
+    stem = os.path.basename(args.expr.rstrip('/\\')).split('.')[0]
+    out = args.out or os.path.join(proc_dir, f'{stem}_tx2gene.mat')
+    rows = list(genes) + iso_ids
+    with span('aggregate') as sp:
+        meta = {'source': os.path.abspath(args.expr), 'annotation': os.path.abspath(args.annotation),
+                'tx2gene': {'input_scale': args.input_scale, 'pseudocount': args.pseudocount,
+                            'n_genes': int(len(genes)), 'n_isoforms': len(iso_ids),
+                            'n_unmapped': int((~mapped).sum())}}
+        O = create_matrix_cache(out, rows, df.columns, dtype='float32', index_name='Ensembl_ID', extra=meta)
+        aggregate_into(df.to_numpy(), M, iso, O, args.input_scale, args.pseudocount, args.workers)
+        O.flush()
+        sp.shape(O)
+        del O
+        feature_table(np.asarray(genes), iso_ids, tx).to_csv(os.path.join(out, FEATURES), sep='\t', index=False)
+
+    print(f'[OK] 转录本 -> 基因：{len(transcripts)} 转录本 -> {len(genes)} 基因 + {len(iso_ids)} 个异构体行，'
+          f'{df.shape[1]} 样本')
+    if (~mapped).any():
+        print(f'[WARN] {int((~mapped).sum())} 个转录本不在注释中，未参与聚合。')
+    for t in iso_ids:
+        if t in ISOFORM_ALIASES:
+            print(f'  {ISOFORM_ALIASES[t]} = {t}')
+    print(' -', out)
+
+
+if __name__ == '__main__':
+    main()